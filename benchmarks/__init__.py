@@ -0,0 +1 @@
+"""Benchmarks of the pipeline stages on synthetic loan books."""
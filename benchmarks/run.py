@@ -0,0 +1,368 @@
+"""Wall time, peak RSS and throughput of every pipeline stage.
+
+Each data size runs in a fresh process on a synthetic loan book (generated
+once into ``--data-dir`` with a fixed seed, see ``benchmarks.synthetic``) and
+times the stages in notebook order:
+
+    load_csv, filter_status, parse_dates, parse_dates_memo, engineer,
+    get_dummies, dropna_reset_index, encode, then fit and predict_proba of
+    dt, lr, rf, knn, knn_ann and the soft VotingClassifier
+
+``parse_dates`` is the notebook's ``pd.to_datetime``, ``parse_dates_memo``
+its replacement (``preprocessing.credit_year``). The stages parsing strings
+start every repeat with empty parse memos, as a new process does, so a
+repeat doesn't time the dictionary lookups of values the previous one parsed.
+
+Peak RSS is sampled from /proc/self/statm while the stage runs and reported
+as the increase over the RSS at its start. Model stages train on at most
+``--model-rows`` rows (brute force KNN is quadratic), the rows actually used
+are part of each result. Results are one JSON document, two of them can be
+compared with the ``compare`` command.
+
+The import time of the stage modules is measured too, each in a fresh
+interpreter (stage ``import <module>``, size 0), against ``IMPORT_BUDGETS``:
+a batch job or worker process pays it before doing anything. The result
+lists the heavy libraries the import pulled in, e.g. plotting or the sklearn
+estimators loaded by a scoring module. The ``imports`` command runs only
+these and fails when a module is over its budget.
+
+Usage::
+
+    python -m benchmarks.run --sizes 100000 1000000 10000000 -o results.json
+    python -m benchmarks.run compare baseline.json results.json --threshold 0.1
+    python -m benchmarks.run imports --repeat 5
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.ensemble import VotingClassifier
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.model_selection import train_test_split
+from sklearn.neighbors import KNeighborsClassifier
+
+from benchmarks import synthetic
+from credit_loan import loader, preprocessing
+from credit_loan.prepare import engineer
+from credit_loan.preprocessing import LoanPreprocessor
+from credit_loan.profiling import rss
+from credit_loan.training import make_models
+
+
+SIZES = [100_000, 1_000_000, 10_000_000]
+MODELS = ['dt', 'lr', 'rf', 'knn', 'knn_ann', 'voting']
+
+# seconds, cold import in a new interpreter, the fastest of a few runs.
+# sklearn alone takes about a second, no stage module imports it: fitting or
+# loading a model does. evaluation and charts import pandas only to build a frame
+IMPORT_BUDGETS = {
+    'credit_loan.__main__': 0.1,
+    'credit_loan.forest': 0.6,
+    'credit_loan.evaluation': 0.6,
+    'credit_loan.charts': 0.6,
+    'credit_loan.score': 1.6,
+    'credit_loan.service': 1.6,
+    'credit_loan.matrix': 1.6,
+    'credit_loan.report': 1.6,
+    'credit_loan.training': 1.6,
+}
+HEAVY_MODULES = ['matplotlib', 'seaborn', 'sklearn', 'sklearn.ensemble', 'sklearn.neighbors', 'sklearn.tree',
+                 'sklearn.metrics', 'sklearn.model_selection', 'scipy.stats']
+
+_IMPORT_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  'modules': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+class _PeakRSS:
+    """Sample the RSS in a background thread while the block runs."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start = self.peak = 0
+        self._done = threading.Event()
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, rss())
+
+    def __enter__(self):
+        self.start = self.peak = rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss())
+
+
+class Recorder:
+    """Run stages, keep one result dict per stage."""
+
+    def __init__(self, size, repeat=1):
+        self.size = size
+        self.repeat = repeat
+        self.results = []
+
+    def __call__(self, stage, func, *args, rows=None, setup=None):
+        """Return ``func(*args)``, timed ``repeat`` times; ``rows`` is the stage input size.
+
+        ``setup`` is called before every repeat, untimed.
+        """
+        times, peaks = [], []
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            with _PeakRSS() as memory:
+                start = time.perf_counter()
+                out = func(*args)
+                times.append(time.perf_counter() - start)
+            peaks.append(memory.peak - memory.start)
+        seconds = float(np.median(times))
+        rows = len(args[0]) if rows is None else rows
+        self.results.append({
+            'size': self.size,
+            'stage': stage,
+            'rows': int(rows),
+            'seconds': seconds,
+            'min_seconds': float(min(times)),
+            'rows_per_s': rows / seconds if seconds > 0 else None,
+            'peak_rss_mb': max(peaks) / 2 ** 20,
+            'rss_mb': rss() / 2 ** 20,
+        })
+        print(f'{self.size:>10,} {stage:<22} {seconds:9.3f}s {max(peaks) / 2 ** 20:9.1f}MB', file=sys.stderr)
+        return out
+
+
+def import_times(budgets=IMPORT_BUDGETS, repeat=3):
+    """Cold import time of every module of ``budgets``, the fastest of ``repeat`` fresh interpreters.
+
+    The fastest run is the one least disturbed by the rest of the machine,
+    the median of a few cold starts still moves by tens of percent.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+    results = []
+    for module, budget in budgets.items():
+        runs = []
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, '-c', _IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)],
+                                 capture_output=True, text=True, env=env, check=True).stdout
+            runs.append(json.loads(out.splitlines()[-1]))
+        times = [run['seconds'] for run in runs]
+        seconds = float(min(times))
+        peak_mb = max(run['maxrss_kb'] for run in runs) / 2 ** 10
+        results.append({
+            'size': 0,
+            'stage': f'import {module}',
+            'rows': 0,
+            'seconds': seconds,
+            'min_seconds': seconds,
+            'rows_per_s': None,
+            'peak_rss_mb': peak_mb,
+            'rss_mb': peak_mb,
+            'budget': budget,
+            'over_budget': seconds > budget,
+            'heavy_modules': runs[0]['modules'],
+        })
+        flag = '  OVER BUDGET' if seconds > budget else ''
+        print(f'{0:>10,} {"import " + module:<34} {seconds:9.3f}s (budget {budget:.2f}s){flag}', file=sys.stderr)
+    return results
+
+
+def _dataset(data_dir, size, seed):
+    path = os.path.join(data_dir, f'loans-{size}-seed{seed}.csv')
+    if not os.path.exists(path):
+        os.makedirs(data_dir, exist_ok=True)
+        synthetic.write_csv(path + '.tmp', size, seed)
+        os.replace(path + '.tmp', path)
+    return path
+
+
+def _clear_memos():
+    for memo in preprocessing.MEMOS.values():
+        memo.clear()
+
+
+def _notebook_dates(data, columns):
+    return [pd.to_datetime(data[col], format='%b-%y').dt.year for col in columns]
+
+
+def _memo_dates(data, columns):
+    return [preprocessing.credit_year(data[col]) for col in columns]
+
+
+def _notebook_final(data):
+    # the notebook's get_dummies, outside of LoanPreprocessor
+    categorical = pd.DataFrame({col: data[col].cat.remove_unused_categories() for col in preprocessing.to_dummies})
+    dummies = pd.get_dummies(categorical)
+    numeric = data.drop(columns=preprocessing.to_dummies + ['loan_ending'])
+    numeric['term'] = preprocessing.term_months(data['term'])
+    numeric['grade'] = preprocessing.grade_number(data['grade'])
+    return pd.concat([numeric, dummies.drop(columns=preprocessing.drop_dummies), data['loan_ending']], axis=1)
+
+
+def _fit_predict(record, name, model, train_X, train_y, val_X):
+    record(f'{name}_fit', model.fit, train_X, train_y)
+    record(f'{name}_predict', model.predict_proba, val_X)
+    return model
+
+
+def run_size(path, size, model_rows=200_000, models=MODELS, repeat=1, seed=0):
+    """Results of every stage for the loan book at ``path``."""
+    # lbfgs stops at max_iter on the unscaled features, as in the notebook
+    warnings.simplefilter('ignore', ConvergenceWarning)
+    record = Recorder(size, repeat)
+    data = record('load_csv', loader.load_loans, path, list(loader.COLUMNS), 100_000, False, rows=size)
+    data = record('filter_status', loader.filter_status, data)
+    data = data.drop(columns='loan_status')
+
+    dates = ['earliest_cr_line', 'last_credit_pull_d']
+    record('parse_dates', _notebook_dates, data, dates)
+    record('parse_dates_memo', _memo_dates, data, dates, setup=_clear_memos)
+    data = record('engineer', engineer, data, setup=_clear_memos)
+    final_data = record('get_dummies', _notebook_final, data)
+    final_data = record('dropna_reset_index', lambda d: d.dropna().reset_index(drop=True), final_data)
+    # a new preprocessor every repeat, its memos start empty
+    record('encode', lambda d: LoanPreprocessor(output='sparse').fit_transform(d), data)
+
+    if not models:
+        return record.results
+    if len(final_data) > model_rows:
+        final_data = final_data.sample(model_rows, random_state=seed)
+    X = final_data.drop(columns='loan_ending')
+    y = final_data['loan_ending']
+    train_X, val_X, train_y, val_y = train_test_split(X, y, random_state=seed)
+
+    candidates = make_models(random_state=seed)
+    # make_models builds the approximate KNN, knn is the notebook's original brute force
+    candidates['knn_ann'] = candidates['knn']
+    candidates['knn'] = KNeighborsClassifier()
+    for name in [m for m in MODELS if m != 'voting' and m in models]:
+        _fit_predict(record, name, candidates[name], train_X, train_y, val_X)
+    if 'voting' in models:
+        voting = VotingClassifier([('knn', candidates['knn_ann']), ('rf', candidates['rf']), ('lr', candidates['lr'])],
+                                  voting='soft')
+        _fit_predict(record, 'voting', voting, train_X, train_y, val_X)
+    return record.results
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'sklearn': sklearn.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'git': _git_revision(),
+    }
+
+
+def run(sizes=SIZES, data_dir='benchmark-data', model_rows=200_000, models=MODELS, repeat=1, seed=0,
+        imports=True):
+    """Benchmark every size, each in its own process so peaks don't carry over."""
+    results = import_times(repeat=max(repeat, 3)) if imports else []
+    for size in sizes:
+        path = _dataset(data_dir, size, seed)
+        with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as pool:
+            results += pool.submit(run_size, path, size, model_rows, models, repeat, seed).result()
+    config = {'sizes': list(sizes), 'model_rows': model_rows, 'models': list(models),
+              'repeat': repeat, 'seed': seed, 'imports': imports}
+    return {'environment': environment(), 'config': config, 'results': results}
+
+
+def compare(baseline, current, threshold=0.1, min_seconds=0.05):
+    """Per stage seconds and peak RSS of two runs, with a regression flag.
+
+    Stages faster than ``min_seconds`` in both runs are timer noise and never
+    flagged.
+    """
+    key = ['size', 'stage']
+    merged = pd.DataFrame(baseline['results']).merge(pd.DataFrame(current['results']), on=key,
+                                                     suffixes=('_base', '_new'))
+    merged['time_ratio'] = merged['seconds_new'] / merged['seconds_base']
+    merged['rss_diff_mb'] = merged['peak_rss_mb_new'] - merged['peak_rss_mb_base']
+    merged['regression'] = ((merged['time_ratio'] > 1 + threshold)
+                            & (merged[['seconds_base', 'seconds_new']].max(axis=1) >= min_seconds))
+    return merged[key + ['seconds_base', 'seconds_new', 'time_ratio', 'peak_rss_mb_base',
+                         'peak_rss_mb_new', 'rss_diff_mb', 'regression']]
+
+
+def _load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['compare']:
+        parser = argparse.ArgumentParser(prog='benchmarks.run compare',
+                                         description='Compare two benchmark result files.')
+        parser.add_argument('baseline')
+        parser.add_argument('current')
+        parser.add_argument('--threshold', type=float, default=0.1,
+                            help='relative slowdown flagged as a regression (default: 0.1)')
+        parser.add_argument('--min-seconds', type=float, default=0.05,
+                            help='stages faster than this are never flagged (default: 0.05)')
+        args = parser.parse_args(argv[1:])
+        table = compare(_load(args.baseline), _load(args.current), args.threshold, args.min_seconds)
+        print(table.to_string(index=False, float_format='%.3f'))
+        sys.exit(1 if table['regression'].any() else 0)
+    if argv[:1] == ['imports']:
+        parser = argparse.ArgumentParser(prog='benchmarks.run imports',
+                                         description='Cold import time of the stage modules against their budget.')
+        parser.add_argument('modules', nargs='*', help='modules to time (default: every budgeted one)')
+        parser.add_argument('--repeat', type=int, default=3, help='interpreters per module, the fastest is reported')
+        args = parser.parse_args(argv[1:])
+        budgets = {m: IMPORT_BUDGETS.get(m, float('inf')) for m in args.modules} if args.modules else IMPORT_BUDGETS
+        results = import_times(budgets, args.repeat)
+        sys.exit(1 if any(row['over_budget'] for row in results) else 0)
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--data-dir', default='benchmark-data',
+                        help='where the synthetic CSVs are generated and reused')
+    parser.add_argument('--model-rows', type=int, default=200_000,
+                        help='rows the model stages use at most (default: 200000)')
+    parser.add_argument('--models', nargs='*', default=MODELS, choices=MODELS)
+    parser.add_argument('--repeat', type=int, default=1, help='runs per stage, the median is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-imports', dest='imports', action='store_false',
+                        help="don't measure the import time of the stage modules")
+    parser.add_argument('-o', '--output', default='benchmark-results.json')
+    args = parser.parse_args(argv)
+
+    report = run(args.sizes, args.data_dir, args.model_rows, args.models, args.repeat, args.seed, args.imports)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
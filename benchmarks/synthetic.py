@@ -0,0 +1,189 @@
+"""Synthetic loan book with the schema of ``loan_data_2007_2014.csv``.
+
+Same 75 columns, value formats ('Jan-85' dates, ' 36 months' terms, '10+
+years'...), category frequencies and null rates as the real 2007 - 2014
+file, so every stage of the pipeline runs on it unchanged. Rows are generated
+in fixed blocks seeded by (seed, block), the output only depends on the seed
+and the row count.
+
+Usage::
+
+    python -m benchmarks.synthetic 1000000 loans_1m.csv
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from credit_loan.loader import NULL_COLUMNS
+
+
+BLOCK_ROWS = 100_000
+
+COLUMNS = ['Unnamed: 0', 'id', 'member_id', 'loan_amnt', 'funded_amnt', 'funded_amnt_inv', 'term',
+           'int_rate', 'installment', 'grade', 'sub_grade', 'emp_title', 'emp_length', 'home_ownership',
+           'annual_inc', 'verification_status', 'issue_d', 'loan_status', 'pymnt_plan', 'url', 'desc',
+           'purpose', 'title', 'zip_code', 'addr_state', 'dti', 'delinq_2yrs', 'earliest_cr_line',
+           'inq_last_6mths', 'mths_since_last_delinq', 'mths_since_last_record', 'open_acc', 'pub_rec',
+           'revol_bal', 'revol_util', 'total_acc', 'initial_list_status', 'out_prncp', 'out_prncp_inv',
+           'total_pymnt', 'total_pymnt_inv', 'total_rec_prncp', 'total_rec_int', 'total_rec_late_fee',
+           'recoveries', 'collection_recovery_fee', 'last_pymnt_d', 'last_pymnt_amnt', 'next_pymnt_d',
+           'last_credit_pull_d', 'collections_12_mths_ex_med', 'mths_since_last_major_derog',
+           'policy_code', 'application_type', 'annual_inc_joint', 'dti_joint',
+           'verification_status_joint', 'acc_now_delinq', 'tot_coll_amt', 'tot_cur_bal', 'open_acc_6m',
+           'open_il_6m', 'open_il_12m', 'open_il_24m', 'mths_since_rcnt_il', 'total_bal_il', 'il_util',
+           'open_rv_12m', 'open_rv_24m', 'max_bal_bc', 'all_util', 'total_rev_hi_lim', 'inq_fi',
+           'total_cu_tl', 'inq_last_12m']
+
+# value counts of the real file
+LOAN_STATUS = {
+    'Current': 224226,
+    'Fully Paid': 184739,
+    'Charged Off': 42475,
+    'Late (31-120 days)': 6900,
+    'In Grace Period': 3146,
+    'Does not meet the credit policy. Status:Fully Paid': 1988,
+    'Late (16-30 days)': 1218,
+    'Default': 832,
+    'Does not meet the credit policy. Status:Charged Off': 761,
+}
+GRADE = {'A': .16, 'B': .29, 'C': .27, 'D': .16, 'E': .08, 'F': .03, 'G': .01}
+EMP_LENGTH = {'10+ years': .32, '2 years': .09, '3 years': .08, '< 1 year': .08, '5 years': .07,
+              '1 year': .06, '4 years': .06, '7 years': .06, '6 years': .06, '8 years': .05,
+              '9 years': .04, None: .045}
+HOME_OWNERSHIP = {'MORTGAGE': .505, 'RENT': .404, 'OWN': .0895, 'OTHER': .0004, 'NONE': .0001}
+VERIFICATION_STATUS = {'Verified': .36, 'Source Verified': .32, 'Not Verified': .32}
+PURPOSE = {'debt_consolidation': .588, 'credit_card': .223, 'home_improvement': .057, 'other': .051,
+           'major_purchase': .021, 'small_business': .015, 'car': .012, 'medical': .010,
+           'moving': .006, 'vacation': .005, 'wedding': .005, 'house': .005, 'educational': .001,
+           'renewable_energy': .001}
+STATES = ['CA', 'NY', 'TX', 'FL', 'IL', 'NJ', 'PA', 'OH', 'GA', 'VA', 'NC', 'MI', 'MA', 'MD', 'AZ',
+          'WA', 'CO', 'MN', 'MO', 'CT', 'NV', 'IN', 'OR', 'WI', 'TN', 'AL', 'LA', 'SC', 'KY', 'KS',
+          'OK', 'AR', 'UT', 'NM', 'HI', 'WV', 'NH', 'RI', 'DC', 'MT', 'DE', 'AK', 'WY', 'SD', 'VT',
+          'MS', 'ME', 'NE', 'ID', 'IA']
+MONTHS = np.array(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])
+
+
+def _choice(rng, weights, n):
+    values = list(weights)
+    p = np.asarray(list(weights.values()), dtype=float)
+    return np.asarray(values, dtype=object)[rng.choice(len(values), n, p=p / p.sum())]
+
+
+def _month_year(rng, first_year, last_year, n):
+    years = rng.integers(first_year, last_year + 1, n) % 100
+    return np.char.add(np.char.add(MONTHS[rng.integers(0, 12, n)], '-'),
+                       np.char.zfill(years.astype(str), 2)).astype(object)
+
+
+def _sometimes(rng, values, rate):
+    """``values`` with a fraction ``1 - rate`` replaced by NaN."""
+    values = np.asarray(values, dtype=float)
+    values[rng.random(len(values)) >= rate] = np.nan
+    return values
+
+
+def generate_block(n, seed=0, block=0, start=0):
+    """``n`` synthetic loans, ``start`` is the row number of the first one."""
+    rng = np.random.default_rng([seed, block])
+    index = np.arange(start, start + n)
+    grade = _choice(rng, GRADE, n)
+    grade_rank = pd.Series(grade).map({g: i for i, g in enumerate(GRADE)}).to_numpy()
+
+    loan_amnt = (rng.gamma(2.2, 6500, n) // 25 * 25).clip(500, 35000).astype(np.int64)
+    term_months = np.where(rng.random(n) < .28 + .05 * grade_rank, 60, 36)
+    int_rate = (6 + 3.2 * grade_rank + rng.normal(0, 1.2, n)).clip(5.4, 26.1).round(2)
+    monthly_rate = int_rate / 1200
+    installment = (loan_amnt * monthly_rate / (1 - (1 + monthly_rate) ** -term_months)).round(2)
+    annual_inc = rng.lognormal(11.05, .5, n).round(0)
+    annual_inc[rng.random(n) < 1e-5] = np.nan
+
+    data = {col: np.full(n, np.nan) for col in NULL_COLUMNS}
+    data.update({
+        'Unnamed: 0': index,
+        'id': 1_000_000 + index * 37,
+        'member_id': 1_200_000 + index * 41,
+        'loan_amnt': loan_amnt,
+        'funded_amnt': loan_amnt,
+        'funded_amnt_inv': (loan_amnt - rng.exponential(50, n)).clip(0).round(2),
+        'term': np.where(term_months == 60, ' 60 months', ' 36 months'),
+        'int_rate': int_rate,
+        'installment': installment,
+        'grade': grade,
+        'sub_grade': np.char.add(grade.astype(str), rng.integers(1, 6, n).astype(str)),
+        'emp_title': np.where(rng.random(n) < .94, 'Manager', None),
+        'emp_length': _choice(rng, EMP_LENGTH, n),
+        'home_ownership': _choice(rng, HOME_OWNERSHIP, n),
+        'annual_inc': annual_inc,
+        'verification_status': _choice(rng, VERIFICATION_STATUS, n),
+        'issue_d': _month_year(rng, 2007, 2014, n),
+        'loan_status': _choice(rng, LOAN_STATUS, n),
+        'pymnt_plan': 'n',
+        'url': np.char.add('https://www.lendingclub.com/browse/loanDetail.action?loan_id=',
+                           (1_000_000 + index * 37).astype(str)),
+        'desc': np.where(rng.random(n) < .27, 'Borrower added on 12/22/11 > I need to consolidate', None),
+        'purpose': _choice(rng, PURPOSE, n),
+        'title': 'Debt consolidation',
+        'zip_code': np.char.add(rng.integers(10, 999, n).astype(str), 'xx'),
+        'addr_state': np.asarray(STATES, dtype=object)[rng.integers(0, len(STATES), n)],
+        'dti': rng.gamma(4, 4.3, n).clip(0, 40).round(2),
+        'delinq_2yrs': _sometimes(rng, rng.poisson(.28, n), .99994),
+        'earliest_cr_line': _month_year(rng, 1950, 2011, n),
+        'inq_last_6mths': _sometimes(rng, rng.poisson(.8, n), .99994),
+        'mths_since_last_delinq': _sometimes(rng, rng.integers(0, 120, n), .463),
+        'mths_since_last_record': _sometimes(rng, rng.integers(0, 120, n), .134),
+        'open_acc': _sometimes(rng, rng.poisson(11, n) + 1, .99994),
+        'pub_rec': _sometimes(rng, rng.poisson(.16, n), .99994),
+        'revol_bal': rng.gamma(1.3, 12000, n).astype(np.int64),
+        'revol_util': _sometimes(rng, rng.beta(2.2, 2, n) * 100, .9993).round(1),
+        'total_acc': _sometimes(rng, rng.poisson(25, n) + 1, .99994),
+        'initial_list_status': np.where(rng.random(n) < .65, 'f', 'w'),
+        'last_credit_pull_d': _month_year(rng, 2007, 2016, n),
+        'collections_12_mths_ex_med': _sometimes(rng, rng.poisson(.01, n), .9997),
+        'mths_since_last_major_derog': _sometimes(rng, rng.integers(0, 150, n), .212),
+        'policy_code': 1,
+        'application_type': 'INDIVIDUAL',
+        'acc_now_delinq': _sometimes(rng, rng.poisson(.004, n), .99994),
+        'tot_coll_amt': _sometimes(rng, np.where(rng.random(n) < .25, rng.exponential(300, n), 0), .849).round(0),
+        'tot_cur_bal': _sometimes(rng, rng.gamma(1.1, 125000, n), .849).round(0),
+        'total_rev_hi_lim': _sometimes(rng, rng.gamma(1.8, 17000, n), .849).round(0),
+    })
+
+    # what happened after the loan was issued (leakage columns), loosely consistent
+    total_pymnt = (installment * rng.uniform(1, term_months, n)).round(2)
+    data.update({
+        'out_prncp': (loan_amnt * rng.uniform(0, 1, n)).round(2),
+        'out_prncp_inv': (loan_amnt * rng.uniform(0, 1, n)).round(2),
+        'total_pymnt': total_pymnt,
+        'total_pymnt_inv': total_pymnt,
+        'total_rec_prncp': (total_pymnt * .8).round(2),
+        'total_rec_int': (total_pymnt * .2).round(2),
+        'total_rec_late_fee': np.where(rng.random(n) < .02, 15.0, 0.0),
+        'recoveries': np.where(rng.random(n) < .05, rng.exponential(900, n), 0).round(2),
+        'collection_recovery_fee': np.where(rng.random(n) < .05, rng.exponential(90, n), 0).round(2),
+        'last_pymnt_d': np.where(rng.random(n) < .999, _month_year(rng, 2008, 2016, n), None),
+        'last_pymnt_amnt': (installment * rng.uniform(.5, 3, n)).round(2),
+        'next_pymnt_d': np.where(rng.random(n) < .51, _month_year(rng, 2016, 2016, n), None),
+    })
+    return pd.DataFrame(data, columns=COLUMNS)
+
+
+def write_csv(path, n_rows, seed=0):
+    """Write ``n_rows`` synthetic loans to ``path`` block by block."""
+    for block, start in enumerate(range(0, n_rows, BLOCK_ROWS)):
+        frame = generate_block(min(BLOCK_ROWS, n_rows - start), seed, block, start)
+        frame.to_csv(path, mode='w' if block == 0 else 'a', header=block == 0, index=False)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic loan book CSV.')
+    parser.add_argument('rows', type=int)
+    parser.add_argument('output')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    write_csv(args.output, args.rows, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,29 +16,49 @@
 # %%
 from sklearn.metrics import classification_report
 from sklearn.metrics import confusion_matrix
-from sklearn.ensemble import VotingClassifier
-from sklearn.linear_model import LogisticRegression
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.neighbors import KNeighborsClassifier
-from sklearn import tree
-from sklearn.model_selection import cross_val_score
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import roc_curve, auc
-import matplotlib.pyplot as plt  # graph
-import seaborn as sns  # cool graph
 import pandas as pd  # data processing, CSV file I/O (e.g. pd.read_csv)
 import numpy as np  # linear algebra
+from credit_loan.artifact import ScoringModel
+from credit_loan.audit import DropAudit
+from credit_loan.bundle import save_bundle
+from credit_loan.charts import ChartBook, bars, heatmap, histogram, kde, risk_line, roc
+from credit_loan.evaluation import bootstrap, curve
+from credit_loan.explain import Explainer
+from credit_loan.matrix import write_matrix
+from credit_loan.loader import GOOD_LOAN, LEAKAGE_COLUMNS, NULL_COLUMNS, SCHEMA, load_loans
+from credit_loan.forest import FlatForest
+from credit_loan.preprocessing import LoanPreprocessor, credit_year, emp_length_years, term_months
+from credit_loan import profiling
+from credit_loan.report import risk_table
+from credit_loan.sampling import stratified_split
+from credit_loan.tuning import HalvingSearch
+from credit_loan.training import PrefitVotingClassifier, cross_validate_models, fit_models, make_models
+import os
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 
 filepath = 'loan_data_2007_2014.csv'
 
+# "today" for the date features, the data is from 2007 - 2014
+AS_OF = 2016
+
+# It's my habit to collect dropped data, pass output_dir to also keep their values
+audit = DropAudit()
+
+# per stage time / memory / shapes of this run, see tracer.to_frame() at the end
+tracer = profiling.enable()
+
+# charts are shown one by one, CREDIT_LOAN_REPORT=<dir> renders them to files (PNG, SVG, index.html) instead
+charts = ChartBook(os.environ.get('CREDIT_LOAN_REPORT'))
+
 # %%
-raw_data = pd.read_csv(filepath, low_memory=False)
+# only the columns worth exploring are read, with compact dtypes (see credit_loan.loader.SCHEMA),
+# and the loans that are still running are dropped chunk by chunk
+data = load_loans(filepath, columns=list(SCHEMA))
 
 # %%
-raw_data.info()
+data.info()
 
 # %% [markdown]
 # Seperti yang bisa kita lihat, ada banyak data kosong dan hilang, terutama di bagian terakhir kolom. Kita harus menghapus kolom ini, dan "Unnamed: 0" yang disadap yang merupakan salinan indeks.
@@ -47,19 +67,8 @@ raw_data.info()
 # As we can see, there's many null and missing data, especially in the last bit of columns. We should drop these columns, and the bugged  which is a copy of an index.
 
 # %%
-# print the name of columns with missing values (so I can copy paste :D)
-missing_values = raw_data.isnull().mean()
-missing_values[missing_values == 1].index
-
-# %%
-# Obvious column to drop because it contains nothing
-drop_col = ['Unnamed: 0', 'annual_inc_joint', 'dti_joint', 'verification_status_joint',
-            'open_acc_6m', 'open_il_6m', 'open_il_12m', 'open_il_24m',
-            'mths_since_rcnt_il', 'total_bal_il', 'il_util', 'open_rv_12m',
-            'open_rv_24m', 'max_bal_bc', 'all_util', 'inq_fi', 'total_cu_tl',
-            'inq_last_12m']
-
-data = raw_data.drop(columns=drop_col, axis=1)
+# Obvious column to drop because it contains nothing, the loader never reads them
+NULL_COLUMNS
 
 # %%
 # loan status is our target data, so we want to check it
@@ -73,23 +82,14 @@ data.loan_status.value_counts()
 # - Risky loans / bad loans = ["Charged Off", "Late (31-120 days)", "Late (16-30 days)", "Default", "Does not meet the credit policy. Status:Charged Off"]
 
 # %%
-# define values
-ambiguous = ['Current', 'In Grace Period']
-good_loan = ['Fully Paid',
-             'Does not meet the credit policy. Status:Fully Paid']
-
-# drop rows that contain ambiguous ending
-data = data[data.loan_status.isin(ambiguous) == False]
-
-# create new column to classify ending
-data['loan_ending'] = np.where(
-    data['loan_status'].isin(good_loan), 'good', 'bad')
+# rows that contain ambiguous ending are dropped by the loader, and 'loan_ending'
+# is 'good' for these statuses and 'bad' otherwise
+GOOD_LOAN
 
 # %%
 # check the balance
-plt.title('good vs bad loans balance')
-sns.barplot(x=data.loan_ending.value_counts().index,
-            y=data.loan_ending.value_counts().values)
+charts.add(bars(data.loan_ending.value_counts().index,
+                data.loan_ending.value_counts().values, title='good vs bad loans balance'))
 
 # %% [markdown]
 # ## Column understanding & data leakage
@@ -132,11 +132,10 @@ data.columns
 # Jadi, kami akan menghilangkan kolom-kolom yang berisi Kebocoran Data dan kami hanya akan menyimpan kolom dengan data yang dapat diperoleh sebelum pinjaman diinvestasikan.
 
 # %%
-leakage_col = ['issue_d', 'loan_status', 'pymnt_plan', 'out_prncp', 'out_prncp_inv', 'total_pymnt', 'total_pymnt_inv',
-               'total_rec_prncp', 'total_rec_int', 'total_rec_late_fee', 'recoveries', 'collection_recovery_fee',
-               'last_pymnt_d', 'last_pymnt_amnt', 'next_pymnt_d']
+# the loader never reads LEAKAGE_COLUMNS, loan_status is only kept to build 'loan_ending'
+print(LEAKAGE_COLUMNS)
 
-data.drop(columns=leakage_col, axis=1, inplace=True)
+data.drop(columns='loan_status', axis=1, inplace=True)
 
 # %%
 # check duplicated data suspect based on common sense
@@ -154,9 +153,7 @@ data[['loan_amnt', 'funded_amnt', 'funded_amnt_inv']].describe()
 # %%
 # based on the output, the data is so similar, and we can remove 2 of them + the other columns explained above.
 drop_col = ['funded_amnt', 'funded_amnt_inv', 'id', 'member_id', 'url', 'desc']
-dropped_data = data[drop_col]
-
-data.drop(columns=drop_col, axis=1, inplace=True)
+data = audit.drop(data, drop_col, 'redundant')
 
 # %% [markdown]
 # ## Exploring Data Analysis+ Feature Engineering
@@ -193,9 +190,7 @@ data['major_derogatory'] = np.where(
 # dropping cols
 drop_col = ['mths_since_last_delinq',
             'mths_since_last_record', 'mths_since_last_major_derog']
-dropped_data = pd.concat([dropped_data, data[drop_col]], axis=1)
-
-data.drop(columns=drop_col, axis=1, inplace=True)
+data = audit.drop(data, drop_col, 'personal_record')
 
 # %% [markdown]
 # __2. Variabel yang agak kabur__
@@ -217,21 +212,17 @@ print(pd.pivot_table(data, index='loan_ending', values=cols, aggfunc=np.max))
 data[cols].describe()
 
 # %%
-plt.figure(figsize=(10, 6))
-
 # I use "> 0" because 75% of the data is 0... so the plot below just use < 25% of the data
-sns.kdeplot(data=data[(data['tot_coll_amt'] < 100000) & (
-    data['tot_coll_amt'] > 0)], x='tot_coll_amt', hue='loan_ending')
+charts.add(kde(data[(data['tot_coll_amt'] < 100000) & (
+    data['tot_coll_amt'] > 0)], x='tot_coll_amt', hue='loan_ending', figsize=(10, 6)))
 
 # %%
-plt.figure(figsize=(10, 6))
-sns.kdeplot(data=data[data['tot_cur_bal'] < 800000],
-            x='tot_cur_bal', hue='loan_ending')
+charts.add(kde(data[data['tot_cur_bal'] < 800000],
+               x='tot_cur_bal', hue='loan_ending', figsize=(10, 6)))
 
 # %%
-plt.figure(figsize=(10, 6))
-sns.kdeplot(data=data[data['total_rev_hi_lim'] < 250000],
-            x='total_rev_hi_lim', hue='loan_ending')
+charts.add(kde(data[data['total_rev_hi_lim'] < 250000],
+               x='total_rev_hi_lim', hue='loan_ending', figsize=(10, 6)))
 
 # %% [markdown]
 # Inilah yang kami temukan sejauh ini:
@@ -245,8 +236,7 @@ sns.kdeplot(data=data[data['total_rev_hi_lim'] < 250000],
 # %%
 drop_col = ['tot_coll_amt', 'tot_cur_bal', 'total_rev_hi_lim']
 
-dropped_data = pd.concat([dropped_data, data[drop_col]], axis=1)
-data.drop(drop_col, inplace=True, axis=1)
+data = audit.drop(data, drop_col, 'vague')
 
 # %% [markdown]
 # __3. Data dengan nilai unik kecil__
@@ -265,16 +255,11 @@ data.drop(['policy_code', 'application_type'], inplace=True, axis=1)
 # %%
 
 
-def risk_pct_chart(x):
-    ratio = (data.groupby(x)['loan_ending']  # group by
-             .value_counts(normalize=True)  # calculate the ratio
-             .mul(100)  # multiply by 100 to be percent
-             .rename('risky_pct')  # rename column as percent
-             .reset_index())
-
-    sns.lineplot(data=ratio[ratio['loan_ending'] == 'bad'], x=x, y='risky_pct')
-    plt.title(x)
-    plt.show()
+def risk_pct_chart(x, risk=None, figsize=None):
+    # risk is a risk_table of all the charted columns, computed once per loop
+    if risk is None:
+        risk = risk_table(data, x)
+    charts.add(risk_line(risk, x, figsize))
 
 
 # %%
@@ -286,8 +271,9 @@ small_unique = ['term', 'initial_list_status', 'major_derogatory',
                 'verification_status', 'home_ownership', 'acc_now_delinq', 'grade',
                 'collections_12_mths_ex_med']
 
+risk = risk_table(data, small_unique)
 for cols in small_unique:
-    risk_pct_chart(cols)
+    risk_pct_chart(cols, risk)
 
 # %% [markdown]
 # What can we conclude here?
@@ -312,12 +298,12 @@ for cols in small_unique:
 
 # %%
 # numerical
-num_data = data.select_dtypes(exclude='object')
+num_data = data.select_dtypes(exclude=['object', 'category'])
 num_data.columns
 
 # %%
 # categorical
-cat_data = data.select_dtypes(include='object')
+cat_data = data.select_dtypes(include=['object', 'category'])
 cat_data.columns
 
 # %% [markdown]
@@ -341,31 +327,18 @@ cat_data[cols].head()
 data['emp_length'].unique()
 
 # %%
-emp_map = {
-    '< 1 year': '0',
-    '1 year': '1',
-    '2 years': '2',
-    '3 years': '3',
-    '4 years': '4',
-    '5 years': '5',
-    '6 years': '6',
-    '7 years': '7',
-    '8 years': '8',
-    '9 years': '9',
-    '10+ years': '10'
-}
-
-data['emp_length'] = data['emp_length'].map(emp_map).fillna('0').astype(int)
+# '< 1 year' -> 0 ... '10+ years' -> 10, missing -> 0 (credit_loan.preprocessing.emp_map),
+# each distinct value is parsed once
+data['emp_length'] = emp_length_years(data['emp_length']).astype(int)
 data['emp_length'].unique()
 
 # %%
-# Pick just year from earliest credit line
-data['earliest_cr_yr'] = pd.to_datetime(
-    data['earliest_cr_line'], format="%b-%y").dt.year
+with profiling.stage('credit_dates', data):
+    # Pick just year from earliest credit line ('%b-%y', each distinct month parsed once)
+    data['earliest_cr_yr'] = credit_year(data['earliest_cr_line'])
 
-# calculate year since last inquiry
-data['yr_since_last_inq'] = 2016 - \
-    pd.to_datetime(data['last_credit_pull_d'], format="%b-%y").dt.year
+    # calculate year since last inquiry
+    data['yr_since_last_inq'] = AS_OF - credit_year(data['last_credit_pull_d'])
 
 data[['emp_length', 'earliest_cr_yr', 'yr_since_last_inq']].describe()
 
@@ -375,14 +348,15 @@ data[['emp_length', 'earliest_cr_yr', 'yr_since_last_inq']].describe()
 # Hal ini terjadi karena pd.to_datetime menggunakan 'unix' (epoch) sebagai asal atau 1970, jadi tidak ada tanggal sebelum tahun 1970, dan tanggal sebelum tahun 1970, misal. 1969, 1968, dijadikan 2068, 2067, dst.
 
 # %%
-data = data[data['earliest_cr_yr'] < 2016]
+data = data[data['earliest_cr_yr'] < AS_OF]
 # I use 2016 as the filter because the data is from 2007 - 2014, so the latest credit line should be around 2014-2015.
 
 # %%
 to_chart = ['emp_length', 'earliest_cr_yr', 'yr_since_last_inq']
 
+risk = risk_table(data, to_chart)
 for cols in to_chart:
-    risk_pct_chart(cols)
+    risk_pct_chart(cols, risk)
 
 # %% [markdown]
 # Kesimpulan:
@@ -392,14 +366,14 @@ for cols in to_chart:
 
 # %%
 to_drop = ['earliest_cr_line', 'last_credit_pull_d']
-dropped_data = pd.concat([dropped_data, data[to_drop]], axis=1)
+audit.record(data, to_drop, 'dates')
 
 # numerical
-num_data = data.drop(to_drop, axis=1).select_dtypes(exclude='object')
+num_data = data.drop(to_drop, axis=1).select_dtypes(exclude=['object', 'category'])
 print('num data: ', num_data.columns)
 
 # categorical
-cat_data = data.drop(to_drop, axis=1).select_dtypes(include='object')
+cat_data = data.drop(to_drop, axis=1).select_dtypes(include=['object', 'category'])
 print('cat data: ', cat_data.columns)
 
 # end of numerical vs categorical cleaning :D
@@ -418,14 +392,11 @@ print('cat data: ', cat_data.columns)
 # %%
 # 1. distribution
 for i in num_data.columns:
-    plt.hist(num_data[i])
-    plt.title(i)
-    plt.show()
+    charts.add(histogram(num_data[i], title=i))
 
 # %%
 # 2. correlation
-plt.figure(figsize=(14, 6))
-sns.heatmap(data=num_data.corr(), annot=True)
+charts.add(heatmap(num_data.corr(), figsize=(14, 6)))
 
 # %%
 # 3. pivot table
@@ -460,10 +431,7 @@ cat_data.nunique()
 
 # %%
 to_drop = ['zip_code', 'title', 'emp_title']
-# It's my habit to collect dropped data
-dropped_data = pd.concat([dropped_data, data[to_drop]], axis=1)
-
-cat_data.drop(to_drop, axis=1, inplace=True)
+cat_data = audit.drop(cat_data, to_drop, 'high_cardinality')
 
 # %%
 cat_data.columns
@@ -472,9 +440,9 @@ cat_data.columns
 to_chart = ['grade', 'sub_grade', 'home_ownership',
             'verification_status', 'purpose', 'addr_state']
 
+risk = risk_table(data, to_chart)
 for cols in to_chart:
-    plt.figure(figsize=(14, 4))
-    risk_pct_chart(cols)
+    risk_pct_chart(cols, risk, figsize=(14, 4))
 
 # %% [markdown]
 # Kesimpulan:
@@ -486,8 +454,7 @@ for cols in to_chart:
 # Bagaimanapun, kita akan mengubah semua data kategorikal menjadi data numerik, dan karena grade dan subgrade sama, saya akan menghapus subgrade untuk mengurangi jumlah total kolom.
 
 # %%
-dropped_data = pd.concat([dropped_data, data['sub_grade']], axis=1)
-cat_data.drop('sub_grade', axis=1, inplace=True)
+cat_data = audit.drop(cat_data, 'sub_grade', 'sub_grade')
 cat_data.nunique()
 
 # %% [markdown]
@@ -504,7 +471,7 @@ cat_data.nunique()
 
 # %%
 # 1. transforming 'term'
-cat_data['term'] = cat_data['term'].str.replace(' months', '').astype(int)
+cat_data['term'] = term_months(cat_data['term']).astype(int)
 
 # %%
 cat_data['grade'].unique()
@@ -521,14 +488,17 @@ grade_map = {
     'G': 7,
 }
 
-cat_data['grade'] = cat_data['grade'].map(grade_map)
+cat_data['grade'] = cat_data['grade'].map(grade_map).astype(int)
 
 # %%
 # 3. one hot encode?
 to_dummies = ['home_ownership', 'verification_status',
               'purpose', 'addr_state', 'initial_list_status']
 
-dummies = pd.get_dummies(cat_data[to_dummies])
+# categories only seen in dropped rows shouldn't become (empty) dummy columns
+with profiling.stage('get_dummies', cat_data) as stage:
+    dummies = stage.output(pd.get_dummies(cat_data[to_dummies].apply(
+        lambda col: col.cat.remove_unused_categories())))
 dummies.drop('initial_list_status_w', axis=1, inplace=True)
 
 # %%
@@ -536,8 +506,7 @@ dummies.head()
 
 # %%
 # dropping columns that already one hot encoded
-dropped_data = pd.concat([dropped_data, cat_data[to_dummies]], axis=1)
-cat_data.drop(to_dummies, axis=1, inplace=True)
+cat_data = audit.drop(cat_data, to_dummies, 'one_hot')
 
 # %%
 # combining categorical data with one hot encoded data
@@ -545,8 +514,9 @@ cat_data_f = pd.concat([cat_data, dummies], axis=1)
 
 # %%
 # combining numerical and categorical data
-final_data = pd.concat([num_data, cat_data_f], axis=1).dropna(
-).reset_index().drop('index', axis=1)
+with profiling.stage('final_data', num_data) as stage:
+    final_data = stage.output(pd.concat([num_data, cat_data_f], axis=1).dropna(
+    ).reset_index().drop('index', axis=1))
 final_data.head()
 
 # %%
@@ -555,14 +525,22 @@ X = final_data.drop('loan_ending', axis=1)
 y = final_data['loan_ending']
 
 # %%
-# splitting for training and model validation, it's important to avoid overfitting
-
-train_X, val_X, train_y, val_y = train_test_split(X, y, random_state=0)
+# splitting for training and model validation, it's important to avoid overfitting.
+# stratified, so both sides keep the 78 / 22 good / bad ratio (credit_loan.sampling also has
+# vintage splits and class-balanced samples of files too big to load)
+train_rows, val_rows = stratified_split(y, test_size=0.25, random_state=0)
+train_X, val_X, train_y, val_y = X.iloc[train_rows], X.iloc[val_rows], y.iloc[train_rows], y.iloc[val_rows]
 
 # %%
 train_y = np.where(train_y == 'good', 1, 0)
 val_y = np.where(val_y == 'good', 1, 0)
 
+# %%
+# both matrices written once as float32 columns and memory-mapped: the estimators and the fit_models workers
+# below all read the same pages instead of converting / receiving their own copy of the frames
+train_X = write_matrix('train.matrix', train_X, train_y).frame()
+val_X = write_matrix('val.matrix', val_X, val_y).frame()
+
 # %% [markdown]
 # # Data Modelling
 
@@ -602,56 +580,54 @@ print(classification_report(val_y, pred_y))
 # - Saya tidak ingin melewatkan banyak hal, jadi saya ingin recall yang 'good' dimaksimalkan. -> berinvestasi sebanyak mungkin pada pinjaman good yang tersedia.
 # - Untuk recall yang 'bad', saya tidak terlalu peduli, asalkan presisi 'bad' lebih tinggi dari 50%.
 
+# %%
+# the models don't depend on each other, so they're all fit at once, one process each
+models, fit_times = fit_models(make_models(), train_X, train_y)
+fit_times
+
 # %%
 # Decision tree
-dt = tree.DecisionTreeClassifier()
-dt.fit(train_X, train_y)
+dt = models['dt']
 pred_y = dt.predict(val_X)
 print(classification_report(val_y, pred_y))
 
 # %%
-# KNN
-knn = KNeighborsClassifier()
-knn.fit(train_X, train_y)
-pred_y = knn.predict(val_X)
+# KNN on scaled + PCA-reduced features with an approximate index (random projection trees).
+# Brute force over the raw columns scans the whole training set per prediction, too slow to score
+# applications one by one, so make_models builds this one. More n_trees = better recall, slower.
+knn = models['knn']
+with profiling.stage('knn_predict', val_X):
+    pred_y = knn.predict(val_X)
 print(classification_report(val_y, pred_y))
 
 # %%
 # Random Forest
-rf = RandomForestClassifier()
-rf.fit(train_X, train_y)
+rf = models['rf']
 pred_y = rf.predict(val_X)
 print(classification_report(val_y, pred_y))
 
+# %%
+# the same forest flattened into a few arrays for batch scoring, the probabilities are identical
+flat_rf = FlatForest.from_sklearn(rf)
+print(np.array_equal(flat_rf.predict_proba(val_X), rf.predict_proba(val_X)), '%.1f MB' % (flat_rf.nbytes / 1e6))
+
 # %%
 # Predict probabilities
 probs = rf.predict_proba(val_X)
 pred_y = probs[:, 1]
 
-# Calculate fpr, tpr, thresholds and AUC
-fpr, tpr, thresholds = roc_curve(val_y, pred_y)
-roc_auc = auc(fpr, tpr)
+# ROC, PR, KS and profit of every threshold, from one sort of the scores
+rf_curve = curve(val_y, pred_y, amount=val_X['loan_amnt'])
 
 # Plot ROC curve
-plt.figure(figsize=(10, 6))
-plt.plot(fpr, tpr, color='darkorange', lw=2,
-         label='ROC curve (area = %0.2f)' % roc_auc)
-plt.plot([0, 1], [0, 1], color='navy', lw=2, linestyle='--')
-plt.xlim([0.0, 1.0])
-plt.ylim([0.0, 1.05])
-plt.xlabel('False Positive Rate')
-plt.ylabel('True Positive Rate')
-plt.title('Receiver Operating Characteristic (ROC)')
-plt.legend(loc="lower right")
-plt.show()
+charts.add(roc(rf_curve['fpr'], rf_curve['tpr']))
 
 # %% [markdown]
 # Evaluasi kurva dan nilai AUC ini untuk menilai apakah model Random Forest cenderung mengalami underfitting atau overfitting. Semakin tinggi nilai AUC, semakin baik performa model. Kurva ROC yang lebih dekat ke sudut kiri atas juga menunjukkan performa yang lebih baik.
 
 # %%
 # Logistic Regression
-lr = LogisticRegression()
-lr.fit(train_X, train_y)
+lr = models['lr']
 pred_y = lr.predict(val_X)
 print(classification_report(val_y, pred_y))
 
@@ -660,34 +636,58 @@ print(classification_report(val_y, pred_y))
 probs = lr.predict_proba(val_X)
 pred_y = probs[:, 1]
 
-# Calculate fpr, tpr, thresholds and AUC
-fpr, tpr, thresholds = roc_curve(val_y, pred_y)
-roc_auc = auc(fpr, tpr)
+# ROC, PR, KS and profit of every threshold, from one sort of the scores
+lr_curve = curve(val_y, pred_y, amount=val_X['loan_amnt'])
 
 # Plot ROC curve
-plt.figure(figsize=(10, 6))
-plt.plot(fpr, tpr, color='darkorange', lw=2,
-         label='ROC curve (area = %0.2f)' % roc_auc)
-plt.plot([0, 1], [0, 1], color='navy', lw=2, linestyle='--')
-plt.xlim([0.0, 1.0])
-plt.ylim([0.0, 1.05])
-plt.xlabel('False Positive Rate')
-plt.ylabel('True Positive Rate')
-plt.title('Receiver Operating Characteristic (ROC)')
-plt.legend(loc="lower right")
-plt.show()
+charts.add(roc(lr_curve['fpr'], lr_curve['tpr']))
 
 # %% [markdown]
 # Evaluasi kurva dan nilai AUC ini untuk menilai apakah model Logistic Regression cenderung mengalami underfitting atau overfitting. Semakin tinggi nilai AUC, semakin baik performa model. Kurva ROC yang lebih dekat ke sudut kiri atas juga menunjukkan performa yang lebih baik.
 
 # %%
-# ensemble soft voting classifier
-voting_clf = VotingClassifier(
-    estimators=[('knn', knn), ('rf', rf), ('lr', lr)], voting='soft')
-voting_clf.fit(train_X, train_y)
+# ensemble soft voting classifier, reusing the models fitted above instead of refitting them
+voting_clf = PrefitVotingClassifier(
+    estimators=[('knn', knn), ('rf', rf), ('lr', lr)])
 pred_y = voting_clf.predict(val_X)
 print(classification_report(val_y, pred_y))
 
+# %%
+# the business metric: margin on the accepted good loans minus the losses on the accepted bad ones, for every
+# threshold of every candidate, with 95% bootstrap intervals (evaluation.MARGIN / LOSS are placeholders)
+val_scores = {name: model.predict_proba(val_X)[:, 1] for name, model in [('rf', rf), ('lr', lr), ('voting_clf', voting_clf)]}
+bootstrap(val_y, val_scores, amount=val_X['loan_amnt'])
+
+# %%
+# persist the candidates with the same preprocessing, so new applications can be scored in batch:
+# python -m credit_loan.score rf.joblib applications.csv scores.csv
+# the .bundle files hold the same models as flat arrays, memory-mapped in milliseconds by scoring workers
+preprocessor = LoanPreprocessor().fit(data)
+for name, model in [('rf', rf), ('lr', lr), ('voting_clf', voting_clf)]:
+    ScoringModel(preprocessor, model, name).save(f'{name}.joblib')
+    save_bundle(ScoringModel(preprocessor, model, name), f'{name}.bundle')
+
+# %%
+# adverse action notices: the 3 features that pushed every declined validation loan towards bad (the LR and
+# forest part of the ensemble, KNN has no per-feature attribution). For a file of applications:
+# python -m credit_loan explain voting_clf.bundle applications.csv reasons.csv --background train.matrix
+explainer = Explainer(voting_clf, preprocessor, background=train_X)
+reasons = explainer.reasons(val_X, top_k=3)
+reasons[reasons['prob_good'] < 0.5].head()
+
+# %%
+# is the validation split representative? 5-fold cross validation on the whole data, every fold of every model in parallel
+cv_scores = cross_validate_models({name: models[name] for name in ['dt', 'rf', 'lr']},
+                                  X, np.where(y == 'good', 1, 0), scoring=['roc_auc', 'precision'])
+cv_scores.groupby('model').mean()
+
+# %%
+# everything above runs with default parameters. Successive halving over the training rows: many rf / lr / knn
+# configurations on a few rows, the best third on 3x more rows, ... then the voting weights on the out-of-fold
+# probabilities. 10 minutes at most, the scores are checkpointed so a rerun only fits what is missing
+search = HalvingSearch(time_budget=600, checkpoint='tuning.ckpt').fit(train_X, train_y)
+search.summary()
+
 # %% [markdown]
 # Oke, jadi, kita punya 3 kandidat yang menjanjikan (berdasarkan kriteria saya sendiri) sebelum kita menyempurnakannya.
 # 1. Random Forest
@@ -707,7 +707,15 @@ print(classification_report(val_y, pred_y))
 # - __Logistic Regression__: Jika Anda memilih Logistic Regression sebagai algoritme, Dari semua pinjaman bad loan yang sebenarnya, model hanya bisa mengenali sebagian kecilnya (7%). Dari semua pinjaman yang diklasifikasikan sebagai bad loan oleh model, sebagian besar dari mereka sebenarnya adalah pinjaman baik (51%).Sebaliknya, model sangat baik dalam mengenali pinjaman baik. Hampir semua pinjaman baik yang sebenarnya dapat diidentifikasi oleh model (98%). Akurasi secara keseluruhan adalah sekitar 79%, yang artinya sebagian besar prediksi model benar.
 
 # %%
-dropped_data.columns
+audit.columns
+
+# %%
+# with CREDIT_LOAN_REPORT set, all the charts above are drawn now
+charts.render()
+
+# %%
+# where the time went; tracer.save_timeline('trace.json') opens in chrome://tracing
+tracer.to_frame()
 
 # %% [markdown]
 # Oke, jadi, abaikan 5 kolom terakhir (satu kolom hot encoded) dari data yang dihilangkan, ada beberapa saran untuk proyek selanjutnya dengan "Credit Loan Data" ini.
@@ -0,0 +1,6 @@
+"""Credit loan risk pipeline.
+
+The exploration lives in ``credit-loan-prediction.py``; this package holds the
+reusable pieces (loading, preprocessing, training and scoring) so they can be
+run in batch jobs without the notebook.
+"""
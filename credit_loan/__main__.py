@@ -0,0 +1,47 @@
+"""Stage entry points of the pipeline, one command per stage.
+
+Only the module of the chosen stage is imported, so ``prep`` and ``report``
+don't pay for the estimators and ``score`` doesn't load the training code.
+Every stage is also its module's own ``python -m credit_loan.<module>``.
+
+Usage::
+
+    python -m credit_loan prep loan_data_2007_2014.csv final.matrix
+    python -m credit_loan tune final.matrix -o tuning.json
+    python -m credit_loan train final.matrix models/ --params tuning.json
+    python -m credit_loan score models/voting.joblib applications.csv scores.parquet
+    python -m credit_loan explain models/voting.joblib applications.csv reasons.csv --background final.matrix
+    python -m credit_loan report loan_data_2007_2014.csv risk.csv
+"""
+import importlib
+import sys
+
+
+STAGES = {
+    'prep': 'credit_loan.matrix',
+    'sample': 'credit_loan.sampling',
+    'tune': 'credit_loan.tuning',
+    'train': 'credit_loan.training',
+    'train-stream': 'credit_loan.incremental',
+    'refresh': 'credit_loan.refresh',
+    'score': 'credit_loan.score',
+    'explain': 'credit_loan.explain',
+    'serve': 'credit_loan.service',
+    'report': 'credit_loan.report',
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in STAGES:
+        stages = ', '.join(STAGES)
+        print(f'usage: python -m credit_loan {{{stages}}} ...', file=sys.stderr)
+        sys.exit(0 if argv[:1] in (['-h'], ['--help']) else 2)
+    stage = argv[0]
+    module = importlib.import_module(STAGES[stage])
+    sys.argv[0] = f'python -m credit_loan {stage}'
+    module.main(argv[1:])
+
+
+if __name__ == '__main__':
+    main()
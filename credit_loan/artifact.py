@@ -0,0 +1,74 @@
+"""Persisted preprocessing + model pair used for scoring new applications."""
+import warnings
+
+import joblib
+import numpy as np
+
+from credit_loan.preprocessing import valid_rows
+
+
+class ScoringModel:
+    """A fitted ``LoanPreprocessor`` and the estimator trained on its output.
+
+    ``score`` takes loader-shaped application records and returns the
+    probability that each loan ends good (class 1, as in the notebook), NaN
+    for rows missing a feature.
+    """
+
+    def __init__(self, preprocessor, model, name=''):
+        self.preprocessor = preprocessor
+        self.model = model
+        self.name = name
+
+        # models fit on final_data in the notebook remember its column names,
+        # they must be the columns the preprocessor produces
+        expected = getattr(model, 'feature_names_in_', None)
+        if expected is not None and list(expected) != list(preprocessor.get_feature_names_out()):
+            raise ValueError(f'{name or type(model).__name__} was trained on different columns than the preprocessor produces')
+
+    @property
+    def feature_names(self):
+        return self.preprocessor.get_feature_names_out()
+
+    def transform(self, records):
+        """Model matrix of ``records`` and the mask of rows that can be scored."""
+        X = self.preprocessor.transform(records)
+        valid = valid_rows(X)
+        return X, valid
+
+    def predict_proba_matrix(self, X):
+        """Probability of a good loan for rows of an already transformed matrix."""
+        with warnings.catch_warnings():
+            # the matrix is unnamed, the column check is done in __init__
+            warnings.filterwarnings('ignore', message='X does not have valid feature names')
+            return self.model.predict_proba(X)[:, 1]
+
+    def _score_matrix(self, X):
+        valid = valid_rows(X)
+        proba = np.full(len(valid), np.nan, dtype=np.float32)
+        if valid.any():
+            proba[valid] = self.predict_proba_matrix(X[valid] if not valid.all() else X)
+        return proba
+
+    def score(self, records):
+        return self._score_matrix(self.preprocessor.transform(records))
+
+    def score_records(self, records):
+        """``score`` for a list of application dicts, see ``transform_records``."""
+        return self._score_matrix(self.preprocessor.transform_records(records))
+
+    def save(self, path):
+        joblib.dump(self, path)
+        return path
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """Load a model saved with ``save``, or a model bundle (always memory-mapped)."""
+        from credit_loan import bundle
+
+        if bundle.is_bundle(path):
+            return bundle.load_bundle(path)
+        model = joblib.load(path, mmap_mode=mmap_mode)
+        if not isinstance(model, cls):
+            raise TypeError(f'{path} does not contain a {cls.__name__}')
+        return model
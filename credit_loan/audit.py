@@ -0,0 +1,63 @@
+"""Lineage of the columns dropped during preparation.
+
+The notebook used to keep every dropped column in a growing ``dropped_data``
+frame, which copied all previously dropped columns at each step and held a
+second full-width frame in memory just to list its columns at the end.
+``DropAudit`` only records the names (and why they were dropped); the values
+are written to disk, one file per step, only when an ``output_dir`` is given.
+"""
+import os
+
+import pandas as pd
+
+
+class DropAudit:
+    """Record dropped columns, optionally spilling their values to disk.
+
+    Parameters
+    ----------
+    output_dir : str, optional
+        When set, the values of every recorded step are written there as
+        ``<step>-<reason>.parquet`` (index kept, so rows can be joined back).
+    """
+
+    def __init__(self, output_dir=None):
+        self.output_dir = output_dir
+        self.steps = []
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+
+    @property
+    def columns(self):
+        """Names of every recorded column, in the order they were dropped."""
+        return [col for _, columns, _ in self.steps for col in columns]
+
+    def record(self, data, columns, reason=''):
+        """Record ``columns`` of ``data`` as dropped, without dropping them."""
+        columns = [columns] if isinstance(columns, str) else list(columns)
+        path = None
+        if self.output_dir is not None:
+            name = f'{len(self.steps):02d}-{reason or "dropped"}.parquet'
+            path = os.path.join(self.output_dir, name)
+            data[columns].to_parquet(path)
+        self.steps.append((reason, columns, path))
+        return columns
+
+    def drop(self, data, columns, reason=''):
+        """Record ``columns`` and return ``data`` without them."""
+        columns = self.record(data, columns, reason)
+        return data.drop(columns=columns)
+
+    def to_frame(self):
+        """One row per dropped column: step, reason and where its values went."""
+        rows = [(step, reason, col, path)
+                for step, (reason, columns, path) in enumerate(self.steps)
+                for col in columns]
+        return pd.DataFrame(rows, columns=['step', 'reason', 'column', 'path'])
+
+    def load(self):
+        """Read the spilled values back into one frame (for inspection only)."""
+        paths = [path for _, _, path in self.steps if path is not None]
+        if not paths:
+            raise ValueError('nothing was written, create the audit with an output_dir')
+        return pd.concat([pd.read_parquet(path) for path in paths], axis=1)
@@ -0,0 +1,336 @@
+"""Versioned single-file model bundle, memory-mapped when loaded.
+
+A pickled ``ScoringModel`` of the voting ensemble is mostly arrays (the
+training rows KNN searches, the nodes of 100 trees) wrapped in Python
+objects, and unpickling copies every one of them in every scoring process. A
+bundle keeps the arrays out of the object graph:
+
+    prefix   magic ``CLBUNDLE``, format version, header length and the
+             BLAKE2 digest of the header
+    header   JSON: the preprocessing vocabulary (dummy columns and their
+             categories, ``emp_map``, ``grade_map``, the numeric features),
+             the fitted state of the model with every numeric array replaced
+             by a reference, the array table (dtype, shape, order, offset),
+             library versions and the BLAKE2 digest of the data section
+    data     the arrays, uncompressed, each starting on a 64-byte boundary
+
+``load_bundle`` maps the file and wraps every array in place (read-only, no
+copy), so a cold load costs the JSON parse and rebuilding a handful of
+objects whatever the model size; the pages are shared by every process
+mapping the same file. The header digest is always checked, the data digest
+(a full read) only with ``verify=True``.
+
+Random forests and decision trees are stored as their ``FlatForest``
+(identical probabilities, internal node values included for
+``credit_loan.explain``). Other estimators are stored as their attributes:
+sklearn and ``credit_loan`` classes only, made of numbers, strings, arrays,
+lists, dicts and nested estimators. That covers ``LogisticRegression``,
+brute force ``KNeighborsClassifier``, ``ApproxKNeighborsClassifier`` with the
+random projection forest index and the voting ensembles; estimators holding
+compiled objects (a KD or ball tree index) can't be bundled.
+
+``ScoringModel.load`` recognizes bundles, so ``credit_loan.score`` and the
+service take them as they are.
+
+Usage::
+
+    python -m credit_loan.bundle pack voting_clf.joblib voting_clf.bundle
+    python -m credit_loan.bundle inspect voting_clf.bundle --verify
+"""
+import argparse
+import hashlib
+import importlib
+import json
+import mmap
+import os
+import struct
+import time
+from importlib.metadata import version
+
+import numpy as np
+
+from credit_loan import preprocessing, profiling
+from credit_loan.artifact import ScoringModel
+from credit_loan.cache import atomic_write
+from credit_loan.forest import FlatForest
+
+
+FORMAT_VERSION = 1
+MAGIC = b'CLBUNDLE'
+ALIGN = 64
+
+# magic, format version, header length, header digest
+_PREFIX = struct.Struct('<8sII16s')
+# classes a bundle may instantiate
+_MODULES = ('sklearn.', 'credit_loan.')
+
+
+def _digest(data=b''):
+    return hashlib.blake2b(data, digest_size=16)
+
+
+def _aligned(offset):
+    return -(-offset // ALIGN) * ALIGN
+
+
+def _flatten_trees(model):
+    from sklearn.ensemble._forest import ForestClassifier
+    from sklearn.tree import BaseDecisionTree
+
+    if isinstance(model, (ForestClassifier, BaseDecisionTree)) and hasattr(model, 'classes_'):
+        # with the internal node values, so reason codes can be computed from the bundle
+        return FlatForest.from_sklearn(model, node_values=True)
+    return model
+
+
+def _state(obj):
+    # sklearn estimators add their version in __getstate__, plain classes
+    # inherit object's (3.11+), which can return None
+    getstate = getattr(type(obj), '__getstate__', None)
+    if getstate is None or getstate is getattr(object, '__getstate__', None):
+        return vars(obj)
+    return obj.__getstate__()
+
+
+class _Encoder:
+    """JSON-able state of an object graph, numeric arrays collected apart."""
+
+    def __init__(self):
+        self.arrays = {}
+
+    def __call__(self, value, path):
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        if isinstance(value, np.generic):
+            return {'__scalar__': value.dtype.str, 'value': value.item()}
+        if isinstance(value, np.ndarray):
+            if value.dtype.kind in 'biuf':
+                self.arrays[path] = value
+                return {'__array__': path}
+            if value.dtype.kind in 'OUS':
+                return {'__values__': value.tolist(), 'dtype': value.dtype.str}
+        if isinstance(value, tuple):
+            return {'__tuple__': [self(v, f'{path}.{i}') for i, v in enumerate(value)]}
+        if isinstance(value, list):
+            return [self(v, f'{path}.{i}') for i, v in enumerate(value)]
+        if isinstance(value, dict) and all(isinstance(k, str) for k in value):
+            return {'__dict__': {k: self(v, f'{path}.{k}') for k, v in value.items()}}
+
+        cls = type(value)
+        if cls.__module__.startswith(_MODULES) and hasattr(value, '__dict__'):
+            value = _flatten_trees(value)
+            cls = type(value)
+            state = _state(value)
+            return {'__object__': f'{cls.__module__}.{cls.__qualname__}',
+                    'state': {k: self(v, f'{path}.{k}') for k, v in state.items()}}
+        raise TypeError(f"can't bundle {cls.__module__}.{cls.__qualname__} at {path}")
+
+
+def _decode(value, arrays):
+    if isinstance(value, list):
+        return [_decode(v, arrays) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if '__array__' in value:
+        return arrays[value['__array__']]
+    if '__scalar__' in value:
+        return np.dtype(value['__scalar__']).type(value['value'])
+    if '__values__' in value:
+        return np.array(value['__values__'], dtype=value['dtype'])
+    if '__tuple__' in value:
+        return tuple(_decode(v, arrays) for v in value['__tuple__'])
+    if '__dict__' in value:
+        return {k: _decode(v, arrays) for k, v in value['__dict__'].items()}
+
+    name = value['__object__']
+    if not name.startswith(_MODULES):
+        raise ValueError(f'bundle refers to {name}, only sklearn and credit_loan classes are loaded')
+    module, _, qualname = name.rpartition('.')
+    cls = getattr(importlib.import_module(module), qualname)
+    obj = cls.__new__(cls)
+    state = {k: _decode(v, arrays) for k, v in value['state'].items()}
+    if hasattr(obj, '__setstate__'):
+        obj.__setstate__(state)
+    else:
+        obj.__dict__.update(state)
+    return obj
+
+
+def _vocabulary(preprocessor):
+    return {
+        'reference_year': preprocessor.reference_year,
+        'output': preprocessor.output,
+        'dummies': preprocessor.dummies,
+        'categories': {col: [str(c) for c in categories] for col, categories in preprocessor.categories_.items()},
+        'feature_names': [str(name) for name in preprocessor.get_feature_names_out()],
+        'numeric_features': preprocessing.NUMERIC_FEATURES,
+        'drop_dummies': preprocessing.drop_dummies,
+        'emp_map': preprocessing.emp_map,
+        'grade_map': preprocessing.grade_map,
+    }
+
+
+def _preprocessor(vocabulary):
+    # the parsing lives in the code, a bundle only loads where it parses the same way
+    current = {'numeric_features': preprocessing.NUMERIC_FEATURES, 'drop_dummies': preprocessing.drop_dummies,
+               'emp_map': preprocessing.emp_map, 'grade_map': preprocessing.grade_map}
+    for name, value in current.items():
+        if vocabulary[name] != value:
+            raise ValueError(f'the bundle was written with a different {name} than credit_loan.preprocessing has')
+    preprocessor = preprocessing.LoanPreprocessor(vocabulary['reference_year'], vocabulary['dummies'],
+                                                  vocabulary['output'])
+    preprocessor._set_vocabulary({col: np.asarray(categories, dtype=object)
+                                  for col, categories in vocabulary['categories'].items()})
+    if list(preprocessor.get_feature_names_out()) != vocabulary['feature_names']:
+        raise ValueError('the vocabulary of the bundle does not give back its feature names')
+    return preprocessor
+
+
+def _layout(arrays, start):
+    table, offset = {}, start
+    for name, array in arrays.items():
+        # Fortran arrays (a frame's columns) are written as their C-ordered transpose
+        order = 'F' if array.flags.f_contiguous and not array.flags.c_contiguous else 'C'
+        offset = _aligned(offset)
+        table[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'order': order,
+                       'offset': offset, 'nbytes': int(array.nbytes)}
+        offset += array.nbytes
+    return table, offset
+
+
+def _chunks(arrays, table, start):
+    # the data section as written: every array preceded by its alignment padding
+    position = start
+    for name, array in arrays.items():
+        spec = table[name]
+        yield b'\0' * (spec['offset'] - position)
+        data = array.T if spec['order'] == 'F' else array
+        yield memoryview(np.ascontiguousarray(data)).cast('B')
+        position = spec['offset'] + spec['nbytes']
+
+
+def save_bundle(model, path):
+    """Write the ``ScoringModel`` ``model`` as a bundle, return ``path``."""
+    encode = _Encoder()
+    state = encode(model.model, 'model')
+    header = {
+        'format': 'credit-loan-bundle',
+        'version': FORMAT_VERSION,
+        'name': model.name,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'libraries': {lib: version(lib) for lib in ['numpy', 'scikit-learn']},
+        'preprocessor': _vocabulary(model.preprocessor),
+        'model': state,
+    }
+    # the data starts after the header, whose length depends on the offsets:
+    # lay out after a guess and grow the guess until the header fits
+    data_start = ALIGN
+    while True:
+        table, end = _layout(encode.arrays, data_start)
+        header.update(arrays=table, data=data_start, size=end)
+        payload = json.dumps({**header, 'checksum': '0' * 32}).encode()
+        if _PREFIX.size + len(payload) <= data_start:
+            break
+        data_start = _aligned(_PREFIX.size + len(payload))
+
+    with profiling.stage('save_bundle'):
+        checksum = _digest()
+        for chunk in _chunks(encode.arrays, table, data_start):
+            checksum.update(chunk)
+        header['checksum'] = checksum.hexdigest()
+        payload = json.dumps(header).encode()
+        payload += b' ' * (data_start - _PREFIX.size - len(payload))
+
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                f.write(_PREFIX.pack(MAGIC, FORMAT_VERSION, len(payload), _digest(payload).digest()))
+                f.write(payload)
+                for chunk in _chunks(encode.arrays, table, data_start):
+                    f.write(chunk)
+
+        atomic_write(path, write)
+    return path
+
+
+def is_bundle(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_header(path):
+    """The header of the bundle at ``path``, checked against its digest."""
+    with open(path, 'rb') as f:
+        prefix = f.read(_PREFIX.size)
+        if len(prefix) < _PREFIX.size or prefix[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a model bundle')
+        _, format_version, length, digest = _PREFIX.unpack(prefix)
+        if format_version != FORMAT_VERSION:
+            raise ValueError(f'{path} is bundle format version {format_version}, expected {FORMAT_VERSION}')
+        payload = f.read(length)
+    if _digest(payload).digest() != digest:
+        raise ValueError(f'{path} has a corrupted header')
+    header = json.loads(payload)
+    size = os.path.getsize(path)
+    if size != header['size']:
+        raise ValueError(f'{path} is {size} bytes, its header says {header["size"]} (truncated?)')
+    return header
+
+
+def _data_checksum(buffer, header):
+    checksum = _digest()
+    checksum.update(memoryview(buffer)[header['data']:])
+    return checksum.hexdigest()
+
+
+def load_bundle(path, verify=False):
+    """The ``ScoringModel`` in the bundle at ``path``, its arrays mapped read-only.
+
+    ``verify`` also reads the whole file to check the data digest.
+    """
+    with profiling.stage('load_bundle'):
+        header = read_header(path)
+        with open(path, 'rb') as f:
+            # the arrays keep the mapping alive, closing the file doesn't unmap it
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if verify and _data_checksum(buffer, header) != header['checksum']:
+            raise ValueError(f'{path} has corrupted arrays, the checksum does not match')
+
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            shape = spec['shape'][::-1] if spec['order'] == 'F' else spec['shape']
+            count = int(np.prod(shape, dtype=np.int64))
+            array = np.frombuffer(buffer, np.dtype(spec['dtype']), count, spec['offset']).reshape(shape)
+            arrays[name] = array.T if spec['order'] == 'F' else array
+        model = _decode(header['model'], arrays)
+        return ScoringModel(_preprocessor(header['preprocessor']), model, header['name'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pack a ScoringModel into a model bundle, or inspect one.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    pack = commands.add_parser('pack', help='write the bundle of a ScoringModel saved with ScoringModel.save')
+    pack.add_argument('model')
+    pack.add_argument('output')
+    inspect = commands.add_parser('inspect', help='print the header summary of a bundle')
+    inspect.add_argument('bundle')
+    inspect.add_argument('--verify', action='store_true', help='also check the checksum of the arrays')
+    args = parser.parse_args(argv)
+
+    if args.command == 'pack':
+        save_bundle(ScoringModel.load(args.model), args.output)
+        return
+    header = read_header(args.bundle)
+    if args.verify:
+        load_bundle(args.bundle, verify=True)
+    arrays = header['arrays']
+    print(f'{args.bundle}: {header["name"]!r}, format {header["version"]}, created {header["created"]}')
+    print(f'  {len(header["preprocessor"]["feature_names"])} features, '
+          f'{len(arrays)} arrays, {sum(a["nbytes"] for a in arrays.values()) / 2 ** 20:.1f} MB')
+    for lib, lib_version in header['libraries'].items():
+        print(f'  {lib} {lib_version}')
+    if args.verify:
+        print(f'  checksum {header["checksum"]} ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Columnar on-disk cache for intermediate frames of the preparation.
+
+Each stage is stored as its own Parquet (or Feather) file, named after the
+stage and a key hashed from the source file contents and the transformation
+config. Editing the CSV or any mapping/drop list produces a new key, so stale
+entries are never read back; they are simply left behind until ``clear``.
+"""
+import hashlib
+import json
+import os
+
+
+FORMATS = {
+    'parquet': ('.parquet', 'read_parquet', 'to_parquet'),
+    'feather': ('.feather', 'read_feather', 'to_feather'),
+}
+
+
+def file_digest(filepath, block_size=1 << 20):
+    """Content hash of ``filepath``."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def config_digest(config):
+    """Stable hash of a JSON-serializable transformation config."""
+    payload = json.dumps(config, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+class StageCache:
+    """Cache of named pipeline stages for one source file and config.
+
+    Hashing a few hundred MB of CSV costs a noticeable fraction of a second,
+    so the source digest is remembered in ``cache_dir`` next to the file's
+    size and mtime and only recomputed when those change.
+    """
+
+    def __init__(self, cache_dir, source, config, fmt='parquet'):
+        if fmt not in FORMATS:
+            raise ValueError(f'unknown cache format {fmt!r}, expected one of {sorted(FORMATS)}')
+        self.cache_dir = cache_dir
+        self.source = source
+        self.config = config
+        self.fmt = fmt
+        os.makedirs(cache_dir, exist_ok=True)
+        self.key = config_digest({'source': self._source_digest(), 'config': config})
+
+    def _source_digest(self):
+        stat = os.stat(self.source)
+        fingerprint = [os.path.abspath(self.source), stat.st_size, stat.st_mtime_ns]
+        index_path = os.path.join(self.cache_dir, 'sources.json')
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+
+        entry = index.get(fingerprint[0])
+        if entry and entry['fingerprint'] == fingerprint:
+            return entry['digest']
+
+        digest = file_digest(self.source)
+        index[fingerprint[0]] = {'fingerprint': fingerprint, 'digest': digest}
+        atomic_write(index_path, lambda path: dump_json(index, path))
+        return digest
+
+    def path(self, stage):
+        suffix = FORMATS[self.fmt][0]
+        return os.path.join(self.cache_dir, f'{stage}-{self.key}{suffix}')
+
+    def __contains__(self, stage):
+        return os.path.exists(self.path(stage))
+
+    def get(self, stage):
+        """Return the cached frame for ``stage`` or None."""
+        if stage not in self:
+            return None
+        import pandas as pd
+
+        return getattr(pd, FORMATS[self.fmt][1])(self.path(stage))
+
+    def put(self, stage, frame):
+        """Store ``frame`` as ``stage``, the index is not kept."""
+        frame = frame.reset_index(drop=True)
+        writer = FORMATS[self.fmt][2]
+        atomic_write(self.path(stage), lambda path: getattr(frame, writer)(path))
+        return frame
+
+    def cached(self, stage, compute):
+        """Return the cached ``stage``, computing and storing it on a miss."""
+        frame = self.get(stage)
+        if frame is None:
+            frame = self.put(stage, compute())
+        return frame
+
+    def clear(self):
+        """Remove every cached stage, including entries of older keys."""
+        suffixes = tuple(suffix for suffix, _, _ in FORMATS.values())
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(suffixes):
+                os.remove(os.path.join(self.cache_dir, name))
+
+
+def dump_json(obj, path):
+    """Write ``obj`` as JSON to ``path``, e.g. as the ``write`` of ``atomic_write``."""
+    with open(path, 'w') as f:
+        json.dump(obj, f)
+
+
+def atomic_write(path, write):
+    """Call ``write(tmp_path)`` and rename the file it wrote to ``path``."""
+    # write next to the target and rename, so a crashed run never leaves a
+    # truncated entry that later runs would read as valid
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
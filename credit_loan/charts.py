@@ -0,0 +1,234 @@
+"""The notebook's charts as small specs, shown inline or rendered to files.
+
+Every chart of the notebook (the ``num_data`` histograms, the
+``risk_pct_chart`` lines, the ``kdeplot``s, the correlation heatmap, the ROC
+curves) is first reduced to a spec: a dict of the few numbers the figure
+needs. Histograms and KDEs are computed from ``np.histogram`` counts (a KDE is
+the counts on a fine grid convolved with a Gaussian kernel), so a spec costs
+one pass over the column and its size doesn't depend on the number of rows.
+
+A ``ChartBook`` without an output directory draws each spec as it is added
+and calls ``plt.show()``, like the notebook. With one, the specs are queued
+and ``render`` draws them on Agg figures (no pyplot, the interactive backend
+is left alone), in a process pool with ``workers``, writes one file per
+chart and format and an ``index.html`` listing them::
+
+    charts = ChartBook('report', formats=('png', 'svg'))
+    charts.add(histogram(data['annual_inc'], title='annual_inc'))
+    charts.render()
+"""
+import html
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+from credit_loan import profiling
+from credit_loan.cache import atomic_write
+
+
+def _finite(values):
+    x = np.asarray(values, dtype=np.float64)
+    return x[np.isfinite(x)]
+
+
+def histogram(values, bins=10, title=None, figsize=None):
+    """``plt.hist(values)``, counted here; NaN are left out."""
+    counts, edges = np.histogram(_finite(values), bins=bins)
+    return {'kind': 'hist', 'title': title or getattr(values, 'name', None), 'figsize': figsize,
+            'counts': counts, 'edges': edges}
+
+
+def _binned_kde(x, lo, hi, grid, bandwidth):
+    counts, edges = np.histogram(x, bins=grid, range=(lo, hi))
+    step = edges[1] - edges[0]
+    half = min(int(np.ceil(4 * bandwidth / step)), grid - 1)
+    kernel = np.exp(-0.5 * (np.arange(-half, half + 1) * step / bandwidth) ** 2)
+    density = np.convolve(counts, kernel)[half:half + grid]
+    return density / (len(x) * bandwidth * np.sqrt(2 * np.pi))
+
+
+def kde(data, x, hue=None, grid=512, cut=3, title=None, figsize=None):
+    """``sns.kdeplot(data=data, x=x, hue=hue)`` from binned counts.
+
+    Scott's bandwidth per hue level, densities scaled by the level's share of
+    the rows (seaborn's ``common_norm``), evaluated on ``grid`` points.
+    """
+    values = data[x].to_numpy(dtype=np.float64, na_value=np.nan)
+    groups = [(None, np.isfinite(values))] if hue is None else [
+        (level, np.isfinite(values) & np.asarray(data[hue] == level)) for level in data[hue].dropna().unique()]
+    total = np.isfinite(values).sum()
+
+    curves, bandwidths = [], []
+    for level, mask in groups:
+        group = values[mask]
+        if len(group) < 2 or group.std() == 0:
+            continue
+        bandwidths.append(group.std(ddof=1) * len(group) ** -0.2)
+        curves.append((level, group))
+    if not curves:
+        raise ValueError(f'{x!r} has too few distinct values for a KDE')
+
+    finite = values[np.isfinite(values)]
+    lo, hi = finite.min() - cut * max(bandwidths), finite.max() + cut * max(bandwidths)
+    levels, densities = [], []
+    for (level, group), bandwidth in zip(curves, bandwidths):
+        levels.append(level)
+        densities.append(_binned_kde(group, lo, hi, grid, bandwidth) * len(group) / total)
+    step = (hi - lo) / grid
+    return {'kind': 'kde', 'title': title, 'figsize': figsize, 'xlabel': x, 'hue': hue,
+            'grid': lo + step * (np.arange(grid) + 0.5), 'levels': levels, 'densities': densities}
+
+
+def heatmap(matrix, title=None, figsize=None):
+    """``sns.heatmap(matrix, annot=True)`` of a square frame, e.g. ``corr()``."""
+    return {'kind': 'heatmap', 'title': title, 'figsize': figsize,
+            'labels': [str(label) for label in matrix.columns], 'values': matrix.to_numpy(dtype=np.float64)}
+
+
+def risk_line(table, feature, figsize=None):
+    """Bad-rate line of ``feature`` from a ``report.risk_table``."""
+    rows = table[table['feature'] == feature]
+    values = rows['value'].tolist()
+    if not all(isinstance(v, (int, float, np.number)) for v in values):
+        values = [str(v) for v in values]
+    return {'kind': 'line', 'title': feature, 'figsize': figsize, 'xlabel': feature, 'ylabel': 'risky_pct',
+            'x': values, 'y': rows['risky_pct'].to_numpy()}
+
+
+def roc(fpr, tpr, roc_auc=None, title='Receiver Operating Characteristic (ROC)', figsize=(10, 6)):
+    """The notebook's ROC plot of a ``roc_curve`` (or ``evaluation.curve``) and its AUC."""
+    fpr, tpr = np.asarray(fpr), np.asarray(tpr)
+    if roc_auc is None:
+        roc_auc = np.trapezoid(tpr, fpr)
+    return {'kind': 'roc', 'title': title, 'figsize': figsize, 'fpr': fpr, 'tpr': tpr, 'auc': float(roc_auc)}
+
+
+def bars(labels, values, title=None, figsize=None):
+    return {'kind': 'bars', 'title': title, 'figsize': figsize,
+            'labels': [str(label) for label in labels], 'values': np.asarray(values)}
+
+
+def draw(spec, ax):
+    """Draw ``spec`` on the matplotlib axes ``ax``."""
+    kind = spec['kind']
+    if kind == 'hist':
+        ax.stairs(spec['counts'], spec['edges'], fill=True)
+    elif kind == 'kde':
+        for level, density in zip(spec['levels'], spec['densities']):
+            ax.plot(spec['grid'], density, label=level)
+        if spec['hue'] is not None:
+            ax.legend(title=spec['hue'])
+        ax.set_xlabel(spec['xlabel'])
+        ax.set_ylabel('Density')
+    elif kind == 'heatmap':
+        values, labels = spec['values'], spec['labels']
+        image = ax.imshow(values, aspect='auto')
+        ax.figure.colorbar(image, ax=ax)
+        ax.set_xticks(range(len(labels)), labels, rotation=90)
+        ax.set_yticks(range(len(labels)), labels)
+        for (i, j), value in np.ndenumerate(values):
+            ax.text(j, i, f'{value:.2g}', ha='center', va='center', fontsize='x-small')
+    elif kind == 'line':
+        ax.plot(spec['x'], spec['y'])
+        ax.set_xlabel(spec['xlabel'])
+        ax.set_ylabel(spec['ylabel'])
+    elif kind == 'roc':
+        ax.plot(spec['fpr'], spec['tpr'], color='darkorange', lw=2, label='ROC curve (area = %0.2f)' % spec['auc'])
+        ax.plot([0, 1], [0, 1], color='navy', lw=2, linestyle='--')
+        ax.set_xlim([0.0, 1.0])
+        ax.set_ylim([0.0, 1.05])
+        ax.set_xlabel('False Positive Rate')
+        ax.set_ylabel('True Positive Rate')
+        ax.legend(loc='lower right')
+    elif kind == 'bars':
+        ax.bar(spec['labels'], spec['values'])
+    else:
+        raise ValueError(f'unknown chart kind {kind!r}')
+    if spec['title']:
+        ax.set_title(spec['title'])
+    return ax
+
+
+def _filename(i, spec):
+    slug = re.sub(r'[^A-Za-z0-9]+', '-', spec['title'] or spec.get('xlabel') or spec['kind']).strip('-').lower()
+    return f'{i:03d}-{slug}'
+
+
+def _render(spec, path, formats):
+    from matplotlib.figure import Figure
+
+    # a bare Figure draws with Agg and isn't tracked by pyplot, nothing to close
+    fig = Figure(figsize=spec['figsize'])
+    draw(spec, fig.subplots())
+    fig.tight_layout()
+    for fmt in formats:
+        fig.savefig(f'{path}.{fmt}', format=fmt)
+    return [f'{os.path.basename(path)}.{fmt}' for fmt in formats]
+
+
+class ChartBook:
+    """Charts of one run, shown one by one or rendered to files.
+
+    Parameters
+    ----------
+    output_dir : str, optional
+        Where ``render`` writes the charts and ``index.html``. None shows every
+        chart as it is added (``plt.show()``), the notebook's behaviour.
+    formats : tuple of str
+        Image formats written per chart, the first one is shown in the index.
+    workers : int, optional
+        Rendering processes, None renders in this process. The pool spawns
+        its workers, which import the ``__main__`` module again: a script
+        rendering with workers must keep its top level under
+        ``if __name__ == '__main__':``, or every worker reruns it.
+    """
+
+    def __init__(self, output_dir=None, formats=('png', 'svg'), workers=None):
+        self.output_dir = output_dir
+        self.formats = tuple(formats)
+        self.workers = workers
+        self.specs = []
+
+    def add(self, spec):
+        if self.output_dir is None:
+            import matplotlib.pyplot as plt
+
+            plt.figure(figsize=spec['figsize'])
+            draw(spec, plt.gca())
+            plt.show()
+        else:
+            self.specs.append(spec)
+        return spec
+
+    def render(self):
+        """Write the queued charts and the index, return the index path (None when showing inline)."""
+        if self.output_dir is None:
+            return None
+        os.makedirs(self.output_dir, exist_ok=True)
+        paths = [os.path.join(self.output_dir, _filename(i, spec)) for i, spec in enumerate(self.specs)]
+        formats = [self.formats] * len(self.specs)
+        with profiling.stage('render_charts', self.specs):
+            if self.workers is None:
+                files = list(map(_render, self.specs, paths, formats))
+            else:
+                # spawn: the workers only get the specs, not a fork of the frames
+                with ProcessPoolExecutor(self.workers, mp_context=get_context('spawn')) as pool:
+                    files = list(pool.map(_render, self.specs, paths, formats))
+
+        index = os.path.join(self.output_dir, 'index.html')
+        atomic_write(index, lambda path: self._write_index(path, files))
+        return index
+
+    def _write_index(self, path, files):
+        items = []
+        for spec, written in zip(self.specs, files):
+            title = html.escape(spec['title'] or spec.get('xlabel') or spec['kind'])
+            links = ' '.join(f'<a href="{html.escape(f)}">{html.escape(f.rsplit(".", 1)[1])}</a>' for f in written)
+            items.append(f'<figure><img src="{html.escape(written[0])}" alt="{title}">'
+                         f'<figcaption>{title} {links}</figcaption></figure>')
+        with open(path, 'w') as f:
+            f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>credit loan charts</title></head>\n'
+                    '<body>\n' + '\n'.join(items) + '\n</body></html>\n')
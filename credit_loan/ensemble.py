@@ -0,0 +1,53 @@
+"""Soft voting ensemble of models trained apart.
+
+Apart from ``training`` because it subclasses sklearn's estimators, which
+importing the training code doesn't need until it fits something.
+"""
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin
+
+
+class PrefitVotingClassifier(ClassifierMixin, BaseEstimator):
+    """Soft voting over estimators that are already fitted.
+
+    ``VotingClassifier.fit`` refits every base model from scratch; this
+    averages the ``predict_proba`` of the given fitted estimators instead, so
+    the ensemble costs nothing to build once its members are trained.
+
+    Parameters
+    ----------
+    estimators : list of (str, estimator)
+        Fitted classifiers sharing the same ``classes_``.
+    weights : list of float, optional
+        Weight of each estimator's probabilities, uniform when None.
+    """
+
+    def __init__(self, estimators, weights=None):
+        self.estimators = estimators
+        self.weights = weights
+
+    @property
+    def classes_(self):
+        classes = self.estimators[0][1].classes_
+        for name, est in self.estimators:
+            if not np.array_equal(est.classes_, classes):
+                raise ValueError(f'{name} was fit on different classes')
+        return classes
+
+    @property
+    def feature_names_in_(self):
+        return self.estimators[0][1].feature_names_in_
+
+    @property
+    def named_estimators_(self):
+        return dict(self.estimators)
+
+    def fit(self, X, y):
+        raise TypeError('the estimators are already fitted, fit them and build a new ensemble')
+
+    def predict_proba(self, X):
+        probas = [est.predict_proba(X) for _, est in self.estimators]
+        return np.average(probas, axis=0, weights=self.weights)
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
@@ -0,0 +1,156 @@
+"""ROC, PR, KS and expected profit by threshold, from one sort of the scores.
+
+A loan is accepted when its score (probability of ``good``) is at least the
+threshold. Sorting the scores once, descending, the cumulative sums of good
+and bad loans at the end of every run of tied scores are the accepted goods
+(true positives) and bads (false positives) at every threshold, which gives
+the whole ROC curve, the precision-recall curve, the KS statistic and the
+profit of every threshold in O(n) after the sort.
+
+Profit is the notebook's business metric: ``margin`` of the amount on every
+accepted good loan minus ``loss`` of the amount on every accepted bad loan
+(per loan when there are no amounts). The defaults are placeholders, set them
+from the lender's numbers.
+
+Bootstrap replicates draw the same resample for every model (paired) as
+multiplicity weights on the rows, so they reuse the sort order instead of
+sorting again; batches of replicates run in a joblib process pool.
+"""
+import numpy as np
+
+from credit_loan import profiling
+
+
+MARGIN = 0.1
+LOSS = 0.5
+
+METRICS = ['auc', 'average_precision', 'ks', 'ks_threshold', 'max_profit', 'profit_threshold',
+           'accept_rate']
+
+
+def _sorted(y_true, score, amount=None):
+    score = np.asarray(score, dtype=np.float64)
+    order = np.argsort(-score, kind='stable')
+    good = np.asarray(y_true, dtype=np.float64)[order]
+    amount = np.ones(len(score)) if amount is None else np.asarray(amount, dtype=np.float64)[order]
+    score = score[order]
+    # last row of every run of tied scores, ties are accepted or rejected together
+    ends = np.r_[np.flatnonzero(np.diff(score)), len(score) - 1] if len(score) else np.empty(0, dtype=np.intp)
+    return order, good, amount, score, ends
+
+
+def _counts(good, amount, ends, weights=None, margin=MARGIN, loss=LOSS):
+    w = np.ones(len(good)) if weights is None else weights
+    tp = np.r_[0, np.cumsum(w * good)[ends]]
+    fp = np.r_[0, np.cumsum(w * (1 - good))[ends]]
+    profit = np.r_[0, np.cumsum(w * amount * (margin * good - loss * (1 - good)))[ends]]
+    return tp, fp, profit
+
+
+def _summary(tp, fp, profit, thresholds):
+    positives, negatives = tp[-1], fp[-1]
+    tpr = tp / positives if positives else np.zeros_like(tp)
+    fpr = fp / negatives if negatives else np.zeros_like(fp)
+    accepted = tp + fp
+    precision = np.divide(tp, accepted, out=np.ones_like(tp), where=accepted > 0)
+    ks = tpr - fpr
+    best_ks, best_profit = int(np.argmax(ks)), int(np.argmax(profit))
+    return {
+        'auc': float(np.trapezoid(tpr, fpr)),
+        # step-wise, like sklearn's average_precision_score
+        'average_precision': float(np.sum(np.diff(tpr) * precision[1:])),
+        'ks': float(ks[best_ks]),
+        'ks_threshold': float(thresholds[best_ks]),
+        'max_profit': float(profit[best_profit]),
+        'profit_threshold': float(thresholds[best_profit]),
+        'accept_rate': float(accepted[best_profit] / accepted[-1]) if accepted[-1] else 0.0,
+    }
+
+
+def curve(y_true, score, amount=None, margin=MARGIN, loss=LOSS):
+    """Every threshold of ``score`` with its ROC, PR and profit values.
+
+    ``y_true`` is 1 for good loans, ``score`` the predicted probability of
+    good and ``amount`` the optional loan amounts profit is weighted with. The
+    first row (threshold inf) accepts nothing, the last accepts everything.
+    """
+    import pandas as pd
+
+    _, good, amount, score, ends = _sorted(y_true, score, amount)
+    tp, fp, profit = _counts(good, amount, ends, margin=margin, loss=loss)
+    accepted = tp + fp
+    table = pd.DataFrame({
+        'threshold': np.r_[np.inf, score[ends]],
+        'tp': tp,
+        'fp': fp,
+        'tpr': tp / tp[-1] if tp[-1] else np.zeros_like(tp),
+        'fpr': fp / fp[-1] if fp[-1] else np.zeros_like(fp),
+        'precision': np.divide(tp, accepted, out=np.ones_like(tp), where=accepted > 0),
+        'accept_rate': accepted / accepted[-1] if accepted[-1] else np.zeros_like(accepted),
+        'profit': profit,
+    })
+    table['recall'] = table['tpr']
+    table['ks'] = table['tpr'] - table['fpr']
+    return table
+
+
+def evaluate(y_true, scores, amount=None, margin=MARGIN, loss=LOSS):
+    """One row of ``METRICS`` per model, ``scores`` is a dict name -> score."""
+    import pandas as pd
+
+    rows = {}
+    with profiling.stage('evaluate', y_true):
+        for name, score in scores.items():
+            _, good, amounts, sorted_score, ends = _sorted(y_true, score, amount)
+            tp, fp, profit = _counts(good, amounts, ends, margin=margin, loss=loss)
+            rows[name] = _summary(tp, fp, profit, np.r_[np.inf, sorted_score[ends]])
+    return pd.DataFrame.from_dict(rows, orient='index')[METRICS]
+
+
+def _replicates(models, n, seeds, margin, loss):
+    rows = []
+    for seed in seeds:
+        weights = np.bincount(np.random.default_rng(seed).integers(0, n, n), minlength=n).astype(np.float64)
+        for name, (order, good, amount, thresholds, ends) in models.items():
+            tp, fp, profit = _counts(good, amount, ends, weights[order], margin, loss)
+            rows.append({'model': name, **_summary(tp, fp, profit, thresholds)})
+    return rows
+
+
+def bootstrap(y_true, scores, amount=None, n_boot=200, alpha=0.05, margin=MARGIN, loss=LOSS,
+              n_jobs=-1, random_state=0, max_nbytes='1M'):
+    """Percentile confidence intervals of ``METRICS`` for every model.
+
+    Returns one row per (model, metric) with the full-sample ``estimate`` and
+    the ``low`` / ``high`` bounds of the ``1 - alpha`` interval.
+    """
+    import pandas as pd
+    from joblib import Parallel, delayed, effective_n_jobs
+
+    n = len(y_true)
+    models = {}
+    for name, score in scores.items():
+        order, good, amounts, sorted_score, ends = _sorted(y_true, score, amount)
+        models[name] = (order, good, amounts, np.r_[np.inf, sorted_score[ends]], ends)
+
+    seeds = np.random.SeedSequence(random_state).spawn(n_boot)
+    # one batch per worker, a replicate alone is too small a task
+    n_batches = max(1, min(n_boot, effective_n_jobs(n_jobs)))
+    batches = [seeds[i::n_batches] for i in range(n_batches)]
+    with profiling.stage('bootstrap', y_true):
+        results = Parallel(n_jobs=n_jobs, max_nbytes=max_nbytes, mmap_mode='r')(
+            delayed(_replicates)(models, n, batch, margin, loss) for batch in batches)
+    replicates = pd.DataFrame([row for rows in results for row in rows])
+
+    estimate = pd.DataFrame.from_dict({
+        name: _summary(*_counts(good, amounts, ends, margin=margin, loss=loss), thresholds)
+        for name, (_, good, amounts, thresholds, ends) in models.items()}, orient='index')
+    # nearest: a threshold can be inf (accept nothing), interpolating would give NaN
+    bounds = replicates.groupby('model')[METRICS].quantile([alpha / 2, 1 - alpha / 2], interpolation='nearest')
+    table = []
+    for name in scores:
+        for metric in METRICS:
+            table.append({'model': name, 'metric': metric, 'estimate': estimate.loc[name, metric],
+                          'low': bounds.loc[(name, alpha / 2), metric],
+                          'high': bounds.loc[(name, 1 - alpha / 2), metric]})
+    return pd.DataFrame(table)
@@ -0,0 +1,308 @@
+"""Reason codes: the features that pushed an application towards "bad".
+
+Adverse action notices need the top reasons behind every declined loan.
+``Explainer`` splits the predicted probability of a good loan into an
+expected value plus one contribution per feature, on the probability scale:
+
+- logistic regression: ``coef * (x - mean)`` on the log-odds, vectorized
+  over the batch and rescaled by ``(p - p0) / (z - z0)`` so they add up to
+  the probability ``p`` minus the probability ``p0`` of the mean
+  application;
+- forests and trees: the path attribution of ``FlatForest.contributions``
+  (numba kernel when installed);
+- voting ensembles: the weighted average of the explainable members. KNN has
+  no per-feature attribution, its share of the vote is left out, so the
+  reasons of an ensemble explain its LR and forest part.
+
+The one-hot columns of a categorical feature are added up into that feature,
+so a reason code is an input column (``int_rate``, ``purpose``, ...). The
+reasons of a row are its ``top_k`` most negative contributions, for the rows
+below ``threshold`` (the declined ones).
+
+``explain_file`` streams a loan file like ``credit_loan.score`` and writes
+the scores with their reason codes; the chunks are encoded, scored and
+explained in a process pool, every worker loading the model once (a bundle
+is memory-mapped, so they share its pages).
+
+Usage::
+
+    python -m credit_loan.explain voting_clf.bundle applications.csv reasons.csv --background final.matrix
+"""
+import argparse
+import collections
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from credit_loan import profiling
+from credit_loan.artifact import ScoringModel
+from credit_loan.forest import FlatForest
+from credit_loan.preprocessing import NUMERIC_FEATURES
+from credit_loan.score import _Writer, iter_applications
+
+
+def _dense(X):
+    if hasattr(X, 'to_numpy'):
+        X = X.to_numpy()
+    return X.toarray() if sp.issparse(X) else np.asarray(X)
+
+
+def _members(model, weight=1.0):
+    """(weight, explainable estimator) pairs of ``model``, ensembles flattened."""
+    from sklearn.ensemble._forest import ForestClassifier
+    from sklearn.tree import BaseDecisionTree
+
+    if hasattr(model, 'named_estimators_'):
+        # VotingClassifier keeps its fitted members apart, PrefitVotingClassifier doesn't
+        fitted = getattr(model, 'estimators_', None) or [est for _, est in model.estimators]
+        weights = getattr(model, 'weights', None)
+        weights = [1.0] * len(fitted) if weights is None else weights
+        total = float(sum(weights))
+        return [member for est, w in zip(fitted, weights) for member in _members(est, weight * w / total)]
+
+    if hasattr(model, 'coef_') and hasattr(model, 'intercept_'):
+        if np.shape(model.coef_)[0] != 1:
+            raise ValueError('only binary logistic regressions can be explained')
+        return [(weight, model)]
+    if isinstance(model, FlatForest):
+        return [(weight, model)]
+    if isinstance(model, (ForestClassifier, BaseDecisionTree)):
+        return [(weight, FlatForest.from_sklearn(model, node_values=True))]
+    # no per-feature attribution (KNN)
+    return []
+
+
+def reason_groups(preprocessor):
+    """Reason code names and the output column -> reason code index map."""
+    names = list(NUMERIC_FEATURES)
+    group = list(range(len(NUMERIC_FEATURES)))
+    if preprocessor.output == 'codes':
+        names += list(preprocessor.categories_)
+        return names, np.arange(len(names))
+    group += [0] * (len(preprocessor.get_feature_names_out()) - len(group))
+    for col, positions in preprocessor.positions_.items():
+        for position in positions[positions >= 0]:
+            group[position] = len(names)
+        names.append(col)
+    return names, np.asarray(group)
+
+
+def linear_contributions(model, X, mean):
+    """Expected value and probability-scale contributions of a binary logistic regression."""
+    coef = np.asarray(model.coef_, dtype=np.float64)[0]
+    intercept = float(np.ravel(model.intercept_)[0])
+    X = _dense(X).astype(np.float64, copy=False)
+    log_odds = (X - mean) * coef
+    z = intercept + X @ coef
+    z0 = intercept + mean @ coef
+    p, p0 = 1 / (1 + np.exp(-z)), 1 / (1 + np.exp(-z0))
+    # the log-odds contributions scaled to add up to p - p0; at z == z0 the
+    # secant is the slope of the sigmoid
+    gap = z - z0
+    near = np.abs(gap) < 1e-12
+    scale = np.where(near, p * (1 - p), (p - p0) / np.where(near, 1.0, gap))
+    return float(p0), log_odds * scale[:, np.newaxis]
+
+
+class Explainer:
+    """Per-feature contributions and reason codes of a fitted model.
+
+    Parameters
+    ----------
+    model : estimator
+        The fitted model (LR, forest, tree or voting ensemble of them), e.g.
+        ``ScoringModel.model``.
+    preprocessor : LoanPreprocessor
+        The fitted preprocessor whose output the model takes, gives the
+        reason code of every column.
+    background : array-like, optional
+        Training matrix (or its column means) the linear contributions are
+        measured from. Without it they are measured from an all-zero
+        application, which no real one looks like.
+    """
+
+    def __init__(self, model, preprocessor, background=None):
+        self.model = model
+        self.preprocessor = preprocessor
+        self.members = _members(model)
+        if not self.members:
+            raise TypeError(f'{type(model).__name__} has no explainable (linear or tree) part')
+        self.reason_codes, group = reason_groups(preprocessor)
+        n_features = len(group)
+        # sums the columns of every reason code
+        self._grouping = np.zeros((n_features, len(self.reason_codes)))
+        self._grouping[np.arange(n_features), group] = 1
+        if background is None:
+            self.mean = np.zeros(n_features)
+        elif np.ndim(background) == 1:
+            self.mean = np.asarray(background, dtype=np.float64)
+        else:
+            background = background.X if hasattr(background, 'frame') else background
+            # column means of the training matrix
+            self.mean = np.asarray(_dense(background).mean(axis=0), dtype=np.float64).ravel()
+        if len(self.mean) != n_features:
+            raise ValueError(f'background has {len(self.mean)} columns, the preprocessor produces {n_features}')
+        self._weight = sum(weight for weight, _ in self.members)
+
+    def contributions(self, X):
+        """``(expected_value, contributions)``, one column per reason code.
+
+        The contributions are on the scale of the probability of a good loan,
+        negative ones push towards bad.
+        """
+        expected_value, total = 0.0, np.zeros((X.shape[0], self._grouping.shape[0]))
+        with profiling.stage('explain', X):
+            for weight, estimator in self.members:
+                if isinstance(estimator, FlatForest):
+                    value, contributions = estimator.contributions(X)
+                else:
+                    value, contributions = linear_contributions(estimator, X, self.mean)
+                expected_value += weight / self._weight * value
+                total += weight / self._weight * contributions
+        return expected_value, total @ self._grouping
+
+    def reasons(self, X, top_k=4, threshold=0.5, proba=None):
+        """``prob_good`` and ``reason_1`` .. ``reason_<top_k>`` of every row.
+
+        Rows at or above ``threshold`` (None explains every row) and the
+        slots without a negative contribution get no reason.
+        """
+        if proba is None:
+            proba = self.model.predict_proba(X)[:, 1]
+        _, contributions = self.contributions(X)
+        return self.reasons_from(contributions, proba, top_k, threshold)
+
+    def reasons_from(self, contributions, proba, top_k=4, threshold=0.5):
+        proba = np.asarray(proba)
+        order = np.argsort(contributions, axis=1, kind='stable')[:, :top_k]
+        codes = np.asarray(self.reason_codes, dtype=object)[order]
+        codes[np.take_along_axis(contributions, order, axis=1) >= 0] = None
+        if threshold is not None:
+            codes[proba >= threshold] = None
+        table = pd.DataFrame(codes, columns=[f'reason_{i + 1}' for i in range(order.shape[1])])
+        table.insert(0, 'prob_good', proba)
+        return table
+
+
+# the worker's model and explainer, loaded once by _init_worker
+_worker = {}
+
+
+def _init_worker(model, background):
+    if isinstance(model, str):
+        model = ScoringModel.load(model)
+    _worker['model'] = model
+    _worker['explainer'] = Explainer(model.model, model.preprocessor, background)
+
+
+def _explain_chunk(chunk, id_column, top_k, threshold):
+    model, explainer = _worker['model'], _worker['explainer']
+    X, valid = model.transform(chunk)
+    proba = np.full(len(chunk), np.nan, dtype=np.float32)
+    contributions = np.zeros((len(chunk), len(explainer.reason_codes)))
+    rows = np.flatnonzero(valid)
+    if len(rows):
+        X = X[rows] if len(rows) < len(chunk) else X
+        proba[rows] = model.predict_proba_matrix(X)
+        contributions[rows] = explainer.contributions(X)[1]
+    table = explainer.reasons_from(contributions, proba, top_k, threshold)
+    # rows missing a feature have no score, so no reason either
+    table.loc[~valid, table.columns[1:]] = None
+    if id_column in chunk:
+        table.insert(0, id_column, chunk[id_column].to_numpy())
+    importance = pd.Series(np.abs(contributions[rows]).sum(axis=0), index=explainer.reason_codes)
+    return table, importance, len(rows)
+
+
+def explain_file(model, input_path, output_path, background=None, top_k=4, threshold=0.5, chunksize=100_000,
+                 id_column='id', n_jobs=None, importance_path=None):
+    """Score and explain ``input_path`` into ``output_path``, return the number of rows.
+
+    ``model`` is a ``ScoringModel`` or the path it was saved to (a path is
+    loaded by every worker instead of being pickled to it). ``background``
+    is the training matrix (or its column means), see ``Explainer``.
+    ``importance_path`` also writes the mean absolute contribution of every
+    reason code over the scored rows (CSV).
+    """
+    if background is not None and hasattr(background, 'frame'):
+        # the workers only need the column means, not the matrix
+        background = np.asarray(background.X.mean(axis=0), dtype=np.float64)
+    n_jobs = n_jobs or os.cpu_count()
+    writer = _Writer(output_path)
+    n_rows = n_scored = 0
+    importance = None
+
+    def collect(result):
+        nonlocal n_rows, n_scored, importance
+        table, chunk_importance, scored = result
+        writer.write(table)
+        n_rows += len(table)
+        n_scored += scored
+        importance = chunk_importance if importance is None else importance + chunk_importance
+
+    chunks = iter_applications(input_path, chunksize, id_column)
+    try:
+        if n_jobs == 1:
+            _init_worker(model, background)
+            for chunk in chunks:
+                collect(_explain_chunk(chunk, id_column, top_k, threshold))
+        else:
+            with ProcessPoolExecutor(n_jobs, mp_context=get_context('spawn'), initializer=_init_worker,
+                                     initargs=(model, background)) as pool:
+                # a few chunks ahead of the writer, memory stays bounded
+                pending = collections.deque()
+                for chunk in chunks:
+                    pending.append(pool.submit(_explain_chunk, chunk, id_column, top_k, threshold))
+                    if len(pending) >= 2 * n_jobs:
+                        collect(pending.popleft().result())
+                while pending:
+                    collect(pending.popleft().result())
+    finally:
+        writer.close()
+
+    if importance_path is not None and importance is not None:
+        importance = (importance / max(n_scored, 1)).sort_values(ascending=False)
+        importance.rename_axis('reason').rename('mean_abs_contribution').reset_index().to_csv(importance_path,
+                                                                                            index=False)
+    return n_rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Score applications with the top reasons of every declined one.')
+    parser.add_argument('model', help='ScoringModel saved with ScoringModel.save, or a model bundle')
+    parser.add_argument('input', help='applications, .csv or .parquet')
+    parser.add_argument('output', help='scores and reason codes, .csv or .parquet')
+    parser.add_argument('--background', help='training matrix directory (python -m credit_loan.matrix), '
+                                             'the linear contributions are measured from its mean')
+    parser.add_argument('--top-k', type=int, default=4, help='reason codes per application (default: 4)')
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='applications scored below it are declined and get reasons (default: 0.5)')
+    parser.add_argument('--all', dest='threshold', action='store_const', const=None,
+                        help='reasons for every application, not only the declined ones')
+    parser.add_argument('--importance', help='also write the mean absolute contribution of every reason (CSV)')
+    parser.add_argument('--chunksize', type=int, default=100_000)
+    parser.add_argument('--id-column', default='id')
+    parser.add_argument('--n-jobs', type=int, help='worker processes (default: one per CPU)')
+    args = parser.parse_args(argv)
+
+    background = None
+    if args.background:
+        from credit_loan.matrix import open_matrix
+
+        background = open_matrix(args.background)
+    start = time.perf_counter()
+    n_rows = explain_file(args.model, args.input, args.output, background, args.top_k, args.threshold,
+                          args.chunksize, args.id_column, args.n_jobs, args.importance)
+    elapsed = time.perf_counter() - start
+    print(f'explained {n_rows} applications in {elapsed:.1f}s ({n_rows / max(elapsed, 1e-9):.0f} rows/s)',
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+"""Flat array export of fitted tree ensembles and a batched inference kernel.
+
+sklearn keeps every tree as its own object with a node struct array, and
+``RandomForestClassifier.predict_proba`` walks the trees one by one. A
+``FlatForest`` concatenates all trees into a handful of contiguous arrays:
+
+- internal nodes: ``feature`` (int32), ``threshold`` (float32), ``left`` and
+  ``right`` (int32, a negative child ``c`` is leaf ``-c - 1``)
+- leaves: ``leaf_value`` (float64 class probabilities)
+- optionally ``node_value``, the class probabilities of the internal nodes,
+  for ``contributions``
+
+and evaluates whole batches of rows against them. With numba installed the
+kernel is compiled and walks each row through every tree in parallel over
+rows; without it, a NumPy kernel moves all rows through all trees together,
+one level per step.
+
+The probabilities are bit-identical to sklearn's: sklearn compares float32
+features with float64 thresholds, which is the same as comparing with the
+largest float32 not above the threshold, and the per-tree probabilities are
+summed in tree order and divided by the number of trees exactly like
+``ForestClassifier.predict_proba`` (with the default ``n_jobs``).
+
+``contributions`` attributes a probability to the features on the paths the
+rows take: every split moves the probability from its node's value to its
+child's, the move is credited to the split feature, and the moves of a path
+add up to its leaf minus its root (path attribution, the per-path
+decomposition TreeSHAP refines; additive, but not Shapley values). Averaged
+over trees, the expected value plus the contributions of a row is its
+probability.
+"""
+from importlib.metadata import version
+
+import numpy as np
+import scipy.sparse as sp
+
+try:
+    import numba
+except ImportError:  # optional, the NumPy kernel is used instead
+    numba = None
+
+
+ARRAYS = ['roots', 'feature', 'threshold', 'left', 'right', 'missing_left', 'leaf_value']
+
+# sklearn >= 1.4 stores normalized class fractions in tree_.value
+# (read from the package metadata, importing sklearn isn't needed to score)
+_NORMALIZED_VALUES = tuple(int(part) for part in version('scikit-learn').split('.')[:2]) >= (1, 4)
+
+
+def _float32_floor(threshold):
+    """Largest float32 <= ``threshold``, so ``x32 <= t32`` iff ``x32 <= t64``."""
+    rounded = threshold.astype(np.float32)
+    above = rounded.astype(np.float64) > threshold
+    rounded[above] = np.nextafter(rounded[above], np.float32(-np.inf))
+    return rounded
+
+
+def _leaf_proba(tree, leaves, n_classes):
+    value = tree.value[leaves, 0, :n_classes].astype(np.float64)
+    if _NORMALIZED_VALUES:
+        return value
+    # older sklearn stores weighted counts and normalizes in predict_proba
+    normalizer = value.sum(axis=1)[:, np.newaxis]
+    normalizer[normalizer == 0.0] = 1.0
+    return value / normalizer
+
+
+def _predict_kernel(X, roots, feature, threshold, left, right, missing_left, leaf_value, out, block_size):
+    n_rows, n_trees = X.shape[0], roots.shape[0]
+    n_blocks = (n_rows + block_size - 1) // block_size
+    for block in numba.prange(n_blocks):
+        start = block * block_size
+        stop = min(start + block_size, n_rows)
+        # one tree at a time over a block of rows keeps that tree's nodes in
+        # cache, and adds the trees up in the order sklearn accumulates them
+        for t in range(n_trees):
+            for i in range(start, stop):
+                node = roots[t]
+                while node >= 0:
+                    x = X[i, feature[node]]
+                    if x <= threshold[node] or (x != x and missing_left[node]):
+                        node = left[node]
+                    else:
+                        node = right[node]
+                for c in range(out.shape[1]):
+                    out[i, c] += leaf_value[-node - 1, c]
+        for i in range(start, stop):
+            for c in range(out.shape[1]):
+                out[i, c] /= n_trees
+
+
+def _contributions_kernel(X, roots, feature, threshold, left, right, missing_left, left_move, right_move, out,
+                          block_size):
+    n_rows, n_trees = X.shape[0], roots.shape[0]
+    n_blocks = (n_rows + block_size - 1) // block_size
+    for block in numba.prange(n_blocks):
+        start = block * block_size
+        stop = min(start + block_size, n_rows)
+        for t in range(n_trees):
+            for i in range(start, stop):
+                node = roots[t]
+                while node >= 0:
+                    x = X[i, feature[node]]
+                    if x <= threshold[node] or (x != x and missing_left[node]):
+                        out[i, feature[node]] += left_move[node]
+                        node = left[node]
+                    else:
+                        out[i, feature[node]] += right_move[node]
+                        node = right[node]
+        for i in range(start, stop):
+            for j in range(out.shape[1]):
+                out[i, j] /= n_trees
+
+
+if numba is not None:
+    _predict_kernel = numba.njit(parallel=True, nogil=True, cache=True)(_predict_kernel)
+    _contributions_kernel = numba.njit(parallel=True, nogil=True, cache=True)(_contributions_kernel)
+
+
+class FlatForest:
+    """A fitted tree classifier ensemble flattened into contiguous arrays.
+
+    Build it with ``FlatForest.from_sklearn(rf)``; it exposes ``classes_``,
+    ``predict_proba`` and ``predict`` so it can replace the forest in a
+    ``ScoringModel``.
+    """
+
+    def __init__(self, roots, feature, threshold, left, right, missing_left, leaf_value, classes,
+                 feature_names_in=None, chunksize=4096, node_value=None):
+        self.roots = roots
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.missing_left = missing_left
+        self.leaf_value = leaf_value
+        self.classes_ = classes
+        if feature_names_in is not None:
+            self.feature_names_in_ = feature_names_in
+        self.chunksize = chunksize
+        self.node_value = node_value
+
+    @classmethod
+    def from_sklearn(cls, model, chunksize=4096, node_values=False):
+        """Flatten a fitted forest (or a single decision tree) classifier.
+
+        ``node_values`` keeps the class probabilities of the internal nodes
+        too, which ``contributions`` needs.
+        """
+        if getattr(model, 'n_outputs_', 1) != 1:
+            raise ValueError('only single-output classifiers can be flattened')
+        estimators = getattr(model, 'estimators_', [model])
+        n_classes = len(model.classes_)
+
+        roots, feature, threshold, left, right, missing_left, leaf_value = [], [], [], [], [], [], []
+        node_value = []
+        n_internal = n_leaves = 0
+        for estimator in estimators:
+            tree = estimator.tree_
+            is_leaf = tree.children_left == -1
+            internal = np.flatnonzero(~is_leaf)
+            leaves = np.flatnonzero(is_leaf)
+
+            # new id of every node of this tree in the flat arrays
+            new_id = np.empty(tree.node_count, dtype=np.int64)
+            new_id[internal] = n_internal + np.arange(len(internal))
+            new_id[leaves] = -(n_leaves + np.arange(len(leaves)) + 1)
+
+            roots.append(new_id[0])
+            feature.append(tree.feature[internal])
+            threshold.append(_float32_floor(tree.threshold[internal]))
+            left.append(new_id[tree.children_left[internal]])
+            right.append(new_id[tree.children_right[internal]])
+            missing = getattr(tree, 'missing_go_to_left', None)
+            missing_left.append(np.zeros(len(internal), dtype=bool) if missing is None
+                                else missing[internal].astype(bool))
+            leaf_value.append(_leaf_proba(tree, leaves, n_classes))
+            if node_values:
+                node_value.append(_leaf_proba(tree, internal, n_classes))
+            n_internal += len(internal)
+            n_leaves += len(leaves)
+
+        return cls(
+            roots=np.asarray(roots, dtype=np.int32),
+            feature=np.concatenate(feature).astype(np.int32),
+            threshold=np.concatenate(threshold),
+            left=np.concatenate(left).astype(np.int32),
+            right=np.concatenate(right).astype(np.int32),
+            missing_left=np.concatenate(missing_left),
+            leaf_value=np.concatenate(leaf_value),
+            classes=np.asarray(model.classes_),
+            feature_names_in=getattr(model, 'feature_names_in_', None),
+            chunksize=chunksize,
+            node_value=np.concatenate(node_value) if node_values else None,
+        )
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in ARRAYS)
+
+    def apply(self, X):
+        """Leaf index reached in every tree, shape (n_rows, n_trees)."""
+        n_rows, n_trees = X.shape[0], self.n_trees
+        node = np.tile(self.roots, n_rows)
+        row = np.repeat(np.arange(n_rows), n_trees)
+        check_missing = self.missing_left.any()
+
+        active = np.flatnonzero(node >= 0)
+        while active.size:
+            at = node[active]
+            x = X[row[active], self.feature[at]]
+            go_left = x <= self.threshold[at]
+            if check_missing:
+                go_left |= np.isnan(x) & self.missing_left[at]
+            node[active] = np.where(go_left, self.left[at], self.right[at])
+            active = active[node[active] >= 0]
+        return (-node - 1).reshape(n_rows, n_trees)
+
+    def _predict_chunk(self, X):
+        if numba is not None:
+            proba = np.zeros((X.shape[0], self.leaf_value.shape[1]), dtype=np.float64)
+            _predict_kernel(np.ascontiguousarray(X), self.roots, self.feature, self.threshold, self.left,
+                            self.right, self.missing_left, self.leaf_value, proba, 256)
+            return proba
+
+        leaves = self.apply(X)
+        proba = np.zeros((X.shape[0], self.leaf_value.shape[1]), dtype=np.float64)
+        # tree by tree, in the order sklearn accumulates them
+        for t in range(self.n_trees):
+            proba += self.leaf_value[leaves[:, t]]
+        proba /= self.n_trees
+        return proba
+
+    def predict_proba(self, X):
+        if hasattr(X, 'to_numpy'):
+            X = X.to_numpy()
+        chunks = []
+        for start in range(0, X.shape[0], self.chunksize):
+            chunk = X[start:start + self.chunksize]
+            chunk = chunk.toarray() if sp.issparse(chunk) else chunk
+            chunks.append(self._predict_chunk(np.asarray(chunk, dtype=np.float32)))
+        if not chunks:
+            return np.empty((0, len(self.classes_)))
+        return np.concatenate(chunks)
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+    def _value(self, node, column):
+        # internal node or leaf (negative) probability of class ``column``
+        is_leaf = node < 0
+        value = np.empty(len(node), dtype=np.float64)
+        value[~is_leaf] = self.node_value[node[~is_leaf], column]
+        value[is_leaf] = self.leaf_value[-node[is_leaf] - 1, column]
+        return value
+
+    def _moves(self, column):
+        # what going left / right adds to the probability, per internal node
+        here = self.node_value[:, column]
+        return self._value(self.left, column) - here, self._value(self.right, column) - here
+
+    def _contributions_chunk(self, X, left_move, right_move):
+        n_rows, n_features = X.shape
+        if numba is not None:
+            out = np.zeros((n_rows, n_features), dtype=np.float64)
+            _contributions_kernel(np.ascontiguousarray(X), self.roots, self.feature, self.threshold, self.left,
+                                  self.right, self.missing_left, left_move, right_move, out, 256)
+            return out
+
+        node = np.tile(self.roots, n_rows)
+        row = np.repeat(np.arange(n_rows), self.n_trees)
+        check_missing = self.missing_left.any()
+        out = np.zeros(n_rows * n_features, dtype=np.float64)
+        active = np.flatnonzero(node >= 0)
+        while active.size:
+            at = node[active]
+            x = X[row[active], self.feature[at]]
+            go_left = x <= self.threshold[at]
+            if check_missing:
+                go_left |= np.isnan(x) & self.missing_left[at]
+            out += np.bincount(row[active] * n_features + self.feature[at],
+                               weights=np.where(go_left, left_move[at], right_move[at]), minlength=len(out))
+            node[active] = np.where(go_left, self.left[at], self.right[at])
+            active = active[node[active] >= 0]
+        return out.reshape(n_rows, n_features) / self.n_trees
+
+    def contributions(self, X, column=1):
+        """Path attribution of the probability of class ``column``.
+
+        Returns ``(expected_value, contributions)``: the mean root probability
+        and one row of per feature contributions per row of ``X``.
+        """
+        # forests flattened before node values existed don't have the attribute
+        if getattr(self, 'node_value', None) is None:
+            raise ValueError('the forest was flattened without node values, use from_sklearn(model, node_values=True)')
+        if hasattr(X, 'to_numpy'):
+            X = X.to_numpy()
+        expected_value = float(self._value(self.roots, column).mean())
+        left_move, right_move = self._moves(column)
+        chunks = []
+        for start in range(0, X.shape[0], self.chunksize):
+            chunk = X[start:start + self.chunksize]
+            chunk = chunk.toarray() if sp.issparse(chunk) else chunk
+            chunks.append(self._contributions_chunk(np.asarray(chunk, dtype=np.float32), left_move, right_move))
+        if not chunks:
+            return expected_value, np.empty((0, X.shape[1]))
+        return expected_value, np.concatenate(chunks)
+
+    def save(self, path):
+        """Write the arrays uncompressed with ``np.savez``."""
+        extra = {}
+        if getattr(self, 'node_value', None) is not None:
+            extra['node_value'] = self.node_value
+        if hasattr(self, 'feature_names_in_'):
+            extra['feature_names_in'] = np.asarray(self.feature_names_in_, dtype=str)
+        np.savez(path, **{name: getattr(self, name) for name in ARRAYS}, classes=self.classes_, **extra)
+        return path
+
+    @classmethod
+    def load(cls, path, chunksize=4096):
+        with np.load(path) as arrays:
+            kwargs = {name: arrays[name] for name in ARRAYS}
+            classes = arrays['classes']
+            names = arrays['feature_names_in'].astype(object) if 'feature_names_in' in arrays else None
+            node_value = arrays['node_value'] if 'node_value' in arrays else None
+        return cls(**kwargs, classes=classes, feature_names_in=names, chunksize=chunksize, node_value=node_value)
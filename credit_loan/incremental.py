@@ -0,0 +1,205 @@
+"""Out-of-core training of the logistic regression, one chunk at a time.
+
+``LogisticRegression().fit`` needs the whole model matrix in memory.
+``StreamingLogisticRegression`` reads the loan file in chunks instead and
+only ever holds one encoded chunk:
+
+1. a statistics pass extends the ``LoanPreprocessor`` vocabulary
+   (``partial_fit``) and the running mean / variance of the numeric features
+   (``StandardScaler.partial_fit``), the one-hot columns are left unscaled;
+2. ``epochs`` training passes feed the standardized chunks, shuffled within
+   the chunk, to ``SGDClassifier(loss='log_loss').partial_fit``. The
+   averaged iterate with a constant step (ASGD) lands within noise of the
+   batch solver on standardized features in a few passes, the default
+   decaying step of ``partial_fit`` needs many more.
+
+After every ``checkpoint_every`` chunks the whole state is written to
+``checkpoint``; ``fit`` resumes from it when it exists and was saved reading
+the same file in the same chunks. The result is a plain
+``LogisticRegression`` with the scaling folded into its coefficients, so it
+drops into ``ScoringModel`` and the voting ensemble like the notebook's ``lr``.
+
+Usage::
+
+    python -m credit_loan.incremental loans.csv lr_stream.joblib --epochs 3 --checkpoint lr.ckpt
+"""
+import argparse
+import os
+
+import joblib
+import numpy as np
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.preprocessing import StandardScaler
+
+from credit_loan import loader, preprocessing, profiling
+from credit_loan.artifact import ScoringModel
+from credit_loan.cache import atomic_write, file_digest
+from credit_loan.preprocessing import NUMERIC_FEATURES, LoanPreprocessor, valid_rows
+
+
+def iter_chunks(filepath, chunksize=100_000):
+    """Resolved loans of ``filepath`` chunk by chunk, ``loan_status`` dropped."""
+    for chunk in loader.iter_loans(filepath, chunksize=chunksize):
+        yield chunk.drop(columns='loan_status')
+
+
+def encode_chunk(preprocessor, chunk):
+    """Dense model matrix and target (1 = good) of the complete rows of ``chunk``."""
+    X = preprocessor.transform(chunk)
+    valid = valid_rows(X)
+    y = np.asarray(chunk['loan_ending'] == 'good', dtype=np.int8)
+    return X[valid], y[valid]
+
+
+class StreamingLogisticRegression:
+    """Logistic regression trained by SGD over a chunked loan file.
+
+    Parameters
+    ----------
+    epochs : int
+        Training passes over the file.
+    chunksize : int
+        Rows read, encoded and fed to the solver at once.
+    alpha : float
+        L2 regularization strength of ``SGDClassifier``.
+    eta0 : float
+        Constant step size of the solver.
+    checkpoint : str, optional
+        File the training state is saved to and resumed from.
+    checkpoint_every : int
+        Chunks between checkpoints.
+    reference_year : int
+        "As of" year of the date features.
+    random_state : int
+    """
+
+    def __init__(self, epochs=3, chunksize=100_000, alpha=1e-4, eta0=0.01, checkpoint=None,
+                 checkpoint_every=1, reference_year=preprocessing.REFERENCE_YEAR, random_state=0):
+        self.epochs = epochs
+        self.chunksize = chunksize
+        self.alpha = alpha
+        self.eta0 = eta0
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.reference_year = reference_year
+        self.random_state = random_state
+
+    def _initial_state(self):
+        return {
+            'preprocessor': LoanPreprocessor(self.reference_year),
+            'scaler': StandardScaler(),
+            'model': SGDClassifier(loss='log_loss', alpha=self.alpha, learning_rate='constant',
+                                   eta0=self.eta0, average=True, random_state=self.random_state),
+            # 0 is the statistics pass, 1..epochs the training passes
+            'epoch': 0,
+            'chunk': 0,
+            'rows': 0,
+        }
+
+    def _header(self, filepath):
+        # the chunk counter only points at the same rows in the same file read in the same chunks
+        return {'input': file_digest(filepath), 'chunksize': self.chunksize}
+
+    def _load_state(self, header):
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return {**self._initial_state(), **header}
+        state = joblib.load(self.checkpoint)
+        found = {key: state.get(key) for key in header}
+        if found != header:
+            raise ValueError(f'{self.checkpoint} holds the training state of another file or chunksize ({found}, '
+                             f'this run has {header}), remove it or give another checkpoint')
+        return state
+
+    def _save_state(self, state):
+        if self.checkpoint is not None:
+            atomic_write(self.checkpoint, lambda path: joblib.dump(state, path))
+
+    def _scale(self, state, X):
+        n_numeric = len(NUMERIC_FEATURES)
+        X[:, :n_numeric] = state['scaler'].transform(X[:, :n_numeric])
+        return X
+
+    def _pass(self, state, filepath, step):
+        for i, chunk in enumerate(iter_chunks(filepath, self.chunksize)):
+            if i < state['chunk']:
+                # done before the checkpoint we resumed from
+                continue
+            with profiling.stage(f'epoch{state["epoch"]}', chunk):
+                step(state, i, chunk)
+            state['chunk'] = i + 1
+            if state['chunk'] % self.checkpoint_every == 0:
+                self._save_state(state)
+        state['epoch'] += 1
+        state['chunk'] = 0
+        self._save_state(state)
+
+    def _statistics_step(self, state, i, chunk):
+        preprocessor = state['preprocessor'].partial_fit(chunk)
+        numeric = preprocessor.transform_numeric(chunk)
+        numeric = numeric[valid_rows(numeric)]
+        if len(numeric):
+            state['scaler'].partial_fit(numeric)
+            state['rows'] += len(numeric)
+
+    def _training_step(self, state, i, chunk):
+        X, y = encode_chunk(state['preprocessor'], chunk)
+        if not len(y):
+            return
+        rng = np.random.default_rng([self.random_state, state['epoch'], i])
+        order = rng.permutation(len(y))
+        state['model'].partial_fit(self._scale(state, X)[order], y[order], classes=[0, 1])
+
+    def fit(self, filepath):
+        state = self._load_state(self._header(filepath))
+        if state['epoch'] == 0:
+            self._pass(state, filepath, self._statistics_step)
+        while state['epoch'] <= self.epochs:
+            self._pass(state, filepath, self._training_step)
+
+        self.preprocessor_ = state['preprocessor']
+        self.n_rows_ = state['rows']
+        self.model_ = self._unscaled(state)
+        return self
+
+    def _unscaled(self, state):
+        """``LogisticRegression`` on raw features equivalent to the SGD model on scaled ones."""
+        sgd, scaler = state['model'], state['scaler']
+        n_numeric = len(NUMERIC_FEATURES)
+        coef = sgd.coef_.copy()
+        intercept = sgd.intercept_.copy()
+        # w . (x - mean) / scale = (w / scale) . x - w . mean / scale
+        coef[:, :n_numeric] /= scaler.scale_
+        intercept -= coef[:, :n_numeric] @ scaler.mean_
+
+        model = LogisticRegression()
+        model.classes_ = sgd.classes_
+        model.coef_ = coef
+        model.intercept_ = intercept
+        model.n_features_in_ = coef.shape[1]
+        model.n_iter_ = np.array([self.epochs])
+        return model
+
+    def scoring_model(self, name='lr_stream'):
+        return ScoringModel(self.preprocessor_, self.model_, name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Train the logistic regression on a loan file chunk by chunk.')
+    parser.add_argument('input', help='loan file (CSV)')
+    parser.add_argument('output', help='where the ScoringModel is saved')
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--chunksize', type=int, default=100_000)
+    parser.add_argument('--alpha', type=float, default=1e-4)
+    parser.add_argument('--eta0', type=float, default=0.01)
+    parser.add_argument('--checkpoint', help='training state file, resumed from when it exists')
+    parser.add_argument('--checkpoint-every', type=int, default=1, help='chunks between checkpoints')
+    parser.add_argument('--as-of', type=int, dest='reference_year', default=preprocessing.REFERENCE_YEAR)
+    args = parser.parse_args(argv)
+
+    trainer = StreamingLogisticRegression(args.epochs, args.chunksize, args.alpha, args.eta0, args.checkpoint,
+                                          args.checkpoint_every, args.reference_year)
+    trainer.fit(args.input).scoring_model().save(args.output)
+
+
+if __name__ == '__main__':
+    main()
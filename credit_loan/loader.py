@@ -0,0 +1,162 @@
+"""Typed, column-pruned CSV loader for the LendingClub loan book.
+
+The raw 2007 - 2014 file has 75 columns, but the pipeline only keeps a couple
+dozen of them. Reading just those, with compact dtypes, and dropping the
+unresolved loans chunk by chunk keeps peak memory close to the size of the
+data we actually use.
+"""
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from credit_loan.profiling import traced
+
+
+# define values
+AMBIGUOUS = ['Current', 'In Grace Period']
+GOOD_LOAN = ['Fully Paid',
+             'Does not meet the credit policy. Status:Fully Paid']
+
+# columns we never read, the first ones are empty and the rest are only known
+# after the loan is issued (data leakage)
+NULL_COLUMNS = ['Unnamed: 0', 'annual_inc_joint', 'dti_joint', 'verification_status_joint',
+                'open_acc_6m', 'open_il_6m', 'open_il_12m', 'open_il_24m',
+                'mths_since_rcnt_il', 'total_bal_il', 'il_util', 'open_rv_12m',
+                'open_rv_24m', 'max_bal_bc', 'all_util', 'inq_fi', 'total_cu_tl',
+                'inq_last_12m']
+LEAKAGE_COLUMNS = ['issue_d', 'pymnt_plan', 'out_prncp', 'out_prncp_inv', 'total_pymnt', 'total_pymnt_inv',
+                   'total_rec_prncp', 'total_rec_int', 'total_rec_late_fee', 'recoveries', 'collection_recovery_fee',
+                   'last_pymnt_d', 'last_pymnt_amnt', 'next_pymnt_d']
+
+# explicit schema of every column worth reading, in file order
+SCHEMA = {
+    'id': 'int32',
+    'member_id': 'int32',
+    'loan_amnt': 'int32',
+    'funded_amnt': 'int32',
+    'funded_amnt_inv': 'float32',
+    'term': 'category',
+    'int_rate': 'float32',
+    'installment': 'float32',
+    'grade': 'category',
+    'sub_grade': 'category',
+    'emp_title': 'object',
+    'emp_length': 'category',
+    'home_ownership': 'category',
+    'annual_inc': 'float32',
+    'verification_status': 'category',
+    'loan_status': 'category',
+    'url': 'object',
+    'desc': 'object',
+    'purpose': 'category',
+    'title': 'object',
+    'zip_code': 'category',
+    'addr_state': 'category',
+    'dti': 'float32',
+    'delinq_2yrs': 'float32',
+    'earliest_cr_line': 'category',
+    'inq_last_6mths': 'float32',
+    'mths_since_last_delinq': 'float32',
+    'mths_since_last_record': 'float32',
+    'open_acc': 'float32',
+    'pub_rec': 'float32',
+    'revol_bal': 'int32',
+    'revol_util': 'float32',
+    'total_acc': 'float32',
+    'initial_list_status': 'category',
+    'last_credit_pull_d': 'category',
+    'collections_12_mths_ex_med': 'float32',
+    'mths_since_last_major_derog': 'float32',
+    'policy_code': 'int8',
+    'application_type': 'category',
+    'acc_now_delinq': 'float32',
+    'tot_coll_amt': 'float32',
+    'tot_cur_bal': 'float32',
+    'total_rev_hi_lim': 'float32',
+}
+
+# columns explored in the notebook but dropped before modelling
+REDUNDANT_COLUMNS = ['funded_amnt', 'funded_amnt_inv', 'id', 'member_id', 'url', 'desc',
+                     'mths_since_last_delinq', 'mths_since_last_record',
+                     'tot_coll_amt', 'tot_cur_bal', 'total_rev_hi_lim',
+                     'policy_code', 'application_type',
+                     'zip_code', 'title', 'emp_title', 'sub_grade']
+
+# columns the modelling pipeline keeps, read by default
+COLUMNS = [col for col in SCHEMA if col not in REDUNDANT_COLUMNS]
+
+
+def filter_status(chunk):
+    """Drop loans with an ambiguous ending and label the rest good/bad."""
+    chunk = chunk[~chunk['loan_status'].isin(AMBIGUOUS)]
+    # assign on a fresh frame so we don't write into a slice of the chunk
+    return chunk.assign(loan_ending=pd.Categorical(
+        np.where(chunk['loan_status'].isin(GOOD_LOAN), 'good', 'bad'),
+        categories=['bad', 'good']))
+
+
+def _read_args(columns, resolved_only):
+    columns = COLUMNS if columns is None else list(columns)
+    if resolved_only and 'loan_status' not in columns:
+        columns = columns + ['loan_status']
+    dtype = {col: SCHEMA[col] for col in columns if col in SCHEMA}
+    return columns, dtype
+
+
+def iter_loans(filepath, columns=None, chunksize=100_000, resolved_only=True):
+    """Yield typed chunks of the loan file.
+
+    Only ``columns`` (default: ``COLUMNS``, the ones the pipeline keeps) are
+    parsed, pass ``list(SCHEMA)`` to get everything the notebook explores. With
+    ``resolved_only`` the still-running loans are dropped from each chunk
+    before it is yielded and a ``loan_ending`` column is added.
+    """
+    columns, dtype = _read_args(columns, resolved_only)
+    reader = pd.read_csv(filepath, usecols=columns, dtype=dtype,
+                         chunksize=chunksize)
+    with reader:
+        for chunk in reader:
+            if resolved_only:
+                chunk = filter_status(chunk)
+            yield chunk
+
+
+def _empty_frame(columns, resolved_only):
+    columns, dtype = _read_args(columns, resolved_only)
+    data = pd.DataFrame({col: pd.Series(dtype=dtype.get(col, object)) for col in columns})
+    return filter_status(data) if resolved_only else data
+
+
+def concat_chunks(chunks, columns=None, resolved_only=True):
+    """Concatenate typed chunks, keeping categoricals categorical.
+
+    Each chunk infers its own categories, and a plain ``pd.concat`` falls back
+    to object dtype when they differ, so categories are unioned first.
+    ``columns`` and ``resolved_only`` are those the chunks were read with
+    (see ``iter_loans``), they give the columns and dtypes of the empty frame
+    returned when there is no chunk.
+    """
+    chunks = list(chunks)
+    if not chunks:
+        return _empty_frame(columns, resolved_only)
+    data = pd.concat(chunks, ignore_index=True)
+    for col in chunks[0].columns:
+        if isinstance(chunks[0][col].dtype, pd.CategoricalDtype) \
+                and not isinstance(data[col].dtype, pd.CategoricalDtype):
+            data[col] = union_categoricals(
+                [chunk[col] for chunk in chunks], sort_categories=True)
+    return data
+
+
+@traced('load_loans')
+def load_loans(filepath, columns=None, chunksize=100_000, resolved_only=True):
+    """Load the loan file as a single typed, pruned frame.
+
+    See ``iter_loans`` for the arguments. ``chunksize=None`` reads the file in
+    one go, which is faster for small files but peaks higher in memory.
+    """
+    if chunksize is None:
+        columns, dtype = _read_args(columns, resolved_only)
+        data = pd.read_csv(filepath, usecols=columns, dtype=dtype)
+        return filter_status(data).reset_index(drop=True) if resolved_only else data
+    return concat_chunks(iter_loans(filepath, columns, chunksize, resolved_only), columns, resolved_only)
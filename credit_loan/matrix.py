@@ -0,0 +1,164 @@
+"""The final feature matrix on disk, memory-mapped by every process that uses it.
+
+``train_X`` / ``val_X`` as pandas frames get converted to float arrays by
+every estimator, and each joblib worker receives its own pickled copy.
+``write_matrix`` materializes the matrix once as a float32 ``.npy`` in column
+order (every feature contiguous, which is how the tree builders scan it) with
+the target next to it and ``schema.json`` listing the columns;
+``open_matrix`` maps it read-only. The pages are shared through the OS page
+cache: a memmap passed to a joblib worker is sent as its file name and
+offset, not its data, and ``FeatureMatrix.frame`` wraps it without a copy.
+The fitted preprocessor can be kept next to it, ``python -m credit_loan
+train`` reads both to fit and save the scoring models.
+
+Usage::
+
+    python -m credit_loan.matrix loan_data_2007_2014.csv final.matrix
+"""
+import argparse
+import json
+import os
+
+import joblib
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from credit_loan import preprocessing, profiling
+from credit_loan.cache import atomic_write, dump_json
+from credit_loan.prepare import features
+
+
+FORMAT_VERSION = 1
+
+
+def _columns(X, columns):
+    if columns is not None:
+        return [str(name) for name in columns]
+    if hasattr(X, 'columns'):
+        return [str(name) for name in X.columns]
+    return [f'x{i}' for i in range(X.shape[1])]
+
+
+def _write_columns(X, path):
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=X.shape, fortran_order=True)
+    if sp.issparse(X):
+        X = X.tocsc()
+        for j in range(X.shape[1]):
+            start, end = X.indptr[j], X.indptr[j + 1]
+            out[:, j] = 0
+            out[X.indices[start:end], j] = X.data[start:end]
+    elif hasattr(X, 'iloc'):
+        for j in range(X.shape[1]):
+            out[:, j] = X.iloc[:, j].to_numpy(dtype=np.float32, na_value=np.nan)
+    else:
+        X = np.asarray(X)
+        for j in range(X.shape[1]):
+            out[:, j] = X[:, j]
+    out.flush()
+    del out
+
+
+def _write_array(values, path):
+    with open(path, 'wb') as f:
+        np.save(f, values)
+
+
+class FeatureMatrix:
+    """A matrix written by ``write_matrix``, opened with ``open_matrix``.
+
+    ``X`` is the (rows, columns) float32 memmap, ``y`` the target memmap or
+    None, ``columns`` the feature names and ``preprocessor`` the
+    ``LoanPreprocessor`` that produced them, or None when it wasn't written.
+    """
+
+    def __init__(self, directory, X, y, columns, preprocessor=None):
+        self.directory = directory
+        self.X = X
+        self.y = y
+        self.columns = columns
+        self.preprocessor = preprocessor
+
+    def __len__(self):
+        return self.X.shape[0]
+
+    @property
+    def shape(self):
+        return self.X.shape
+
+    def frame(self):
+        """``X`` as a DataFrame over the same memory (read-only)."""
+        return pd.DataFrame(self.X, columns=self.columns, copy=False)
+
+
+def write_matrix(directory, X, y=None, columns=None, preprocessor=None):
+    """Write ``X`` (frame, array or sparse matrix) and ``y`` to ``directory``, return it opened.
+
+    The schema is written last, a directory without one is incomplete.
+    """
+    columns = _columns(X, columns)
+    if len(columns) != X.shape[1]:
+        raise ValueError(f'{len(columns)} column names for {X.shape[1]} columns')
+    if y is not None and len(y) != X.shape[0]:
+        raise ValueError(f'y has {len(y)} rows, X has {X.shape[0]}')
+
+    os.makedirs(directory, exist_ok=True)
+    schema_path = os.path.join(directory, 'schema.json')
+    if os.path.exists(schema_path):
+        os.remove(schema_path)
+    with profiling.stage('write_matrix', X):
+        atomic_write(os.path.join(directory, 'X.npy'), lambda path: _write_columns(X, path))
+        if y is not None:
+            atomic_write(os.path.join(directory, 'y.npy'), lambda path: _write_array(np.asarray(y), path))
+        if preprocessor is not None:
+            atomic_write(os.path.join(directory, 'preprocessor.joblib'), lambda path: joblib.dump(preprocessor, path))
+    schema = {
+        'version': FORMAT_VERSION,
+        'rows': int(X.shape[0]),
+        'columns': columns,
+        'dtype': 'float32',
+        'order': 'F',
+        'target': y is not None,
+        'preprocessor': preprocessor is not None,
+    }
+    atomic_write(schema_path, lambda path: dump_json(schema, path))
+    return open_matrix(directory)
+
+
+def open_matrix(directory, mmap_mode='r'):
+    """Map the matrix in ``directory``; nothing is read until it is used."""
+    try:
+        with open(os.path.join(directory, 'schema.json')) as f:
+            schema = json.load(f)
+    except OSError:
+        raise ValueError(f'{directory} has no schema.json, it is not a (complete) feature matrix') from None
+    if schema['version'] != FORMAT_VERSION:
+        raise ValueError(f'{directory} is format version {schema["version"]}, expected {FORMAT_VERSION}')
+
+    X = np.load(os.path.join(directory, 'X.npy'), mmap_mode=mmap_mode)
+    if X.shape != (schema['rows'], len(schema['columns'])):
+        raise ValueError(f'{directory}/X.npy has shape {X.shape}, the schema says '
+                         f'{(schema["rows"], len(schema["columns"]))}')
+    y = np.load(os.path.join(directory, 'y.npy'), mmap_mode=mmap_mode) if schema['target'] else None
+    preprocessor = None
+    if schema.get('preprocessor'):
+        preprocessor = joblib.load(os.path.join(directory, 'preprocessor.joblib'))
+    return FeatureMatrix(directory, X, y, schema['columns'], preprocessor)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write the model matrix of a loan file as a memory-mappable matrix.')
+    parser.add_argument('input', help='loan file (CSV)')
+    parser.add_argument('output', help='matrix directory')
+    parser.add_argument('--cache-dir', help='stage cache of credit_loan.prepare')
+    parser.add_argument('--chunksize', type=int, default=100_000)
+    parser.add_argument('--as-of', type=int, dest='reference_year', default=preprocessing.REFERENCE_YEAR)
+    args = parser.parse_args(argv)
+
+    X, y, preprocessor = features(args.input, args.cache_dir, output='sparse', chunksize=args.chunksize,
+                                  reference_year=args.reference_year)
+    write_matrix(args.output, X, y, preprocessor.get_feature_names_out(), preprocessor)
+
+
+if __name__ == '__main__':
+    main()
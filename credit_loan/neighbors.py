@@ -0,0 +1,201 @@
+"""Approximate nearest-neighbor classifier for low-latency KNN scoring.
+
+The notebook's original ``KNeighborsClassifier()`` searched the raw, unscaled
+~93 columns of the model matrix by brute force, so every prediction scanned
+the whole training set and the dollar amounts dominated the distance. ``ApproxKNeighborsClassifier``
+standardizes the features, projects them onto a few principal components and
+indexes the result, either exactly with a ball tree or approximately with a
+forest of random projection trees (Annoy-style). The index is part of the
+fitted estimator, so it is pickled together with the model.
+"""
+import numpy as np
+import scipy.sparse as sp
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.decomposition import PCA
+from sklearn.neighbors import BallTree
+from sklearn.preprocessing import StandardScaler
+from sklearn.utils.validation import check_is_fitted
+
+
+INDEXES = ['rpforest', 'balltree']
+
+
+def _dense(X):
+    if sp.issparse(X):
+        X = X.toarray()
+    return np.asarray(X, dtype=np.float32)
+
+
+class _RPTree:
+    """One random projection tree, stored as flat arrays.
+
+    Internal node ``i`` sends a point left when ``point @ directions[i] <=
+    thresholds[i]``; a negative child ``c`` is the leaf ``-c - 1`` and
+    ``leaves[leaf]`` holds its training row indices, padded with -1.
+    """
+
+    def __init__(self, Z, leaf_size, rng):
+        self._directions, self._thresholds, self._left, self._right = [], [], [], []
+        self._leaves = []
+        self.root = self._build(Z, np.arange(len(Z)), leaf_size, rng)
+
+        self.directions = np.asarray(self._directions, dtype=np.float32).reshape(-1, Z.shape[1])
+        self.thresholds = np.asarray(self._thresholds, dtype=np.float32)
+        self.left = np.asarray(self._left, dtype=np.int32)
+        self.right = np.asarray(self._right, dtype=np.int32)
+        self.leaves = np.full((len(self._leaves), leaf_size), -1, dtype=np.int32)
+        for i, rows in enumerate(self._leaves):
+            self.leaves[i, :len(rows)] = rows
+        del self._directions, self._thresholds, self._left, self._right, self._leaves
+
+    def _build(self, Z, rows, leaf_size, rng):
+        if len(rows) <= leaf_size:
+            self._leaves.append(rows)
+            return -len(self._leaves)
+
+        # hyperplane between two random points, so splits follow the data
+        a, b = rng.choice(rows, 2, replace=False)
+        direction = Z[a] - Z[b]
+        if not direction.any():
+            direction = rng.standard_normal(Z.shape[1]).astype(np.float32)
+        projection = Z[rows] @ direction
+        order = np.argsort(projection, kind='stable')
+        half = len(rows) // 2
+        # median split, also balanced when many projections are equal
+        threshold = projection[order[half - 1]]
+
+        node = len(self._thresholds)
+        self._directions.append(direction)
+        self._thresholds.append(threshold)
+        self._left.append(0)
+        self._right.append(0)
+        self._left[node] = self._build(Z, rows[order[:half]], leaf_size, rng)
+        self._right[node] = self._build(Z, rows[order[half:]], leaf_size, rng)
+        return node
+
+    def query(self, Q):
+        """Leaf rows reached by every query point, shape (n_queries, leaf_size)."""
+        node = np.full(len(Q), self.root, dtype=np.int32)
+        internal = node >= 0
+        while internal.any():
+            at = node[internal]
+            projection = np.einsum('ij,ij->i', Q[internal], self.directions[at])
+            node[internal] = np.where(projection <= self.thresholds[at], self.left[at], self.right[at])
+            internal = node >= 0
+        return self.leaves[-node - 1]
+
+
+class ApproxKNeighborsClassifier(ClassifierMixin, BaseEstimator):
+    """KNN on standardized, PCA-reduced features with a search index.
+
+    Parameters
+    ----------
+    n_neighbors : int
+        Neighbors voting for each prediction (uniform weights).
+    n_components : int or None
+        Principal components kept after scaling, None keeps every column.
+    index : {'rpforest', 'balltree'}
+        ``'balltree'`` searches the reduced space exactly. ``'rpforest'``
+        only compares each query with the training rows sharing a leaf in one
+        of ``n_trees`` random projection trees, much faster but approximate.
+    n_trees : int
+        Trees of the forest, the recall/latency tradeoff: more trees find more
+        of the true neighbors and cost proportionally more per query.
+    leaf_size : int
+        Training rows per leaf (forest) or ball tree leaf.
+    batch_size : int
+        Query rows searched at once, bounds the memory of a prediction.
+    random_state : int, optional
+    """
+
+    def __init__(self, n_neighbors=5, n_components=16, index='rpforest', n_trees=10,
+                 leaf_size=64, batch_size=1024, random_state=None):
+        self.n_neighbors = n_neighbors
+        self.n_components = n_components
+        self.index = index
+        self.n_trees = n_trees
+        self.leaf_size = leaf_size
+        self.batch_size = batch_size
+        self.random_state = random_state
+
+    def __setstate__(self, state):
+        # models pickled before the fitted rows were public attributes
+        for old, new in [('_y', 'y_'), ('_Z', 'Z_')]:
+            if old in state:
+                state[new] = state.pop(old)
+        super().__setstate__(state)
+
+    def fit(self, X, y):
+        if self.index not in INDEXES:
+            raise ValueError(f'unknown index {self.index!r}, expected one of {INDEXES}')
+        if hasattr(X, 'columns'):
+            self.feature_names_in_ = np.asarray(X.columns, dtype=object)
+        X = _dense(X)
+        self.n_features_in_ = X.shape[1]
+        self.classes_, y = np.unique(np.asarray(y), return_inverse=True)
+        self.y_ = y.astype(np.int32)
+
+        self.scaler_ = StandardScaler().fit(X)
+        Z = self.scaler_.transform(X)
+        if self.n_components is not None and self.n_components < Z.shape[1]:
+            self.pca_ = PCA(self.n_components, random_state=self.random_state).fit(Z)
+            Z = self.pca_.transform(Z)
+        else:
+            self.pca_ = None
+        self.Z_ = np.ascontiguousarray(Z, dtype=np.float32)
+
+        if self.index == 'balltree':
+            self.index_ = BallTree(self.Z_, leaf_size=self.leaf_size)
+        else:
+            rng = np.random.default_rng(self.random_state)
+            self.index_ = [_RPTree(self.Z_, self.leaf_size, rng) for _ in range(self.n_trees)]
+        return self
+
+    def _reduce(self, X):
+        Z = self.scaler_.transform(_dense(X))
+        if self.pca_ is not None:
+            Z = self.pca_.transform(Z)
+        return np.ascontiguousarray(Z, dtype=np.float32)
+
+    def _forest_kneighbors(self, Q):
+        candidates = np.concatenate([tree.query(Q) for tree in self.index_], axis=1)
+        # the same row can sit in the leaves of several trees, count it once
+        candidates.sort(axis=1)
+        invalid = candidates < 0
+        invalid[:, 1:] |= candidates[:, 1:] == candidates[:, :-1]
+
+        diff = self.Z_[np.maximum(candidates, 0)] - Q[:, None, :]
+        distances = np.einsum('ijk,ijk->ij', diff, diff)
+        distances[invalid] = np.inf
+
+        k = min(self.n_neighbors, candidates.shape[1])
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        found = np.isfinite(np.take_along_axis(distances, nearest, axis=1))
+        return np.take_along_axis(candidates, nearest, axis=1), found
+
+    def kneighbors(self, X):
+        """Training row indices of the neighbors of ``X`` and which were found.
+
+        With the forest index a query can reach fewer than ``n_neighbors``
+        distinct rows; the missing slots are flagged False in the mask.
+        """
+        check_is_fitted(self, 'index_')
+        Q = self._reduce(X)
+        if self.index == 'balltree':
+            _, indices = self.index_.query(Q, k=self.n_neighbors)
+            return indices, np.ones(indices.shape, dtype=bool)
+
+        batches = [self._forest_kneighbors(Q[start:start + self.batch_size])
+                   for start in range(0, len(Q), self.batch_size)]
+        if not batches:
+            return np.empty((0, self.n_neighbors), dtype=np.int32), np.empty((0, self.n_neighbors), dtype=bool)
+        return np.concatenate([b[0] for b in batches]), np.concatenate([b[1] for b in batches])
+
+    def predict_proba(self, X):
+        indices, found = self.kneighbors(X)
+        labels = self.y_[indices]
+        proba = np.stack([((labels == c) & found).sum(axis=1) for c in range(len(self.classes_))], axis=1)
+        return proba / np.maximum(found.sum(axis=1, keepdims=True), 1)
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
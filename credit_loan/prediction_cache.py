@@ -0,0 +1,289 @@
+"""Cache of predicted probabilities for applications scored again.
+
+An application is scored on submission, after document verification and on
+resubmission, each time through the full transform and ``predict_proba`` of
+the voting ensemble (KNN search and 100 trees). The transform is cheap, the
+model is not, so the cache sits between them: the key of an application is a
+keyed BLAKE2 hash of its post-transform feature vector (float64 bytes, -0.0
+folded into 0.0), the key of the hash being the model version. Two records
+that encode to the same vector share an entry, and retraining the model
+changes every key, so stale probabilities are never served; they age out.
+
+The model version is the content hash of the saved ``ScoringModel`` file, the
+same in every process loading it. A model built in memory is hashed with
+``joblib.hash``, which isn't stable across processes for forests (the tree
+node arrays pickle their padding bytes), so share a store only between
+processes loading the same file.
+
+Two tiers:
+
+- ``PredictionCache``, in process, LRU bounded by ``maxsize`` entries, with
+  an optional ``ttl`` in seconds;
+- ``PredictionStore``, an optional SQLite file shared by the worker
+  processes of one host (WAL mode, concurrent readers). Entries expire after
+  ``ttl`` and the oldest written are dropped beyond ``maxsize``; reads don't
+  refresh them, which would turn every hit into a write.
+
+Rows missing a feature are NaN without calling the model and never cached.
+
+Usage::
+
+    model = CachedScoringModel('voting_clf.joblib', PredictionCache(100_000, ttl=3600),
+                               store=PredictionStore('/var/tmp/credit-loan-scores.db'))
+    model.score_records([application])
+    model.cache.metrics()
+"""
+import collections
+import hashlib
+import math
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+from credit_loan import profiling
+from credit_loan.artifact import ScoringModel
+from credit_loan.cache import file_digest
+from credit_loan.preprocessing import valid_rows
+
+
+def model_version(model, path=None):
+    """Version of a ``ScoringModel``: the digest of ``path`` if it was loaded from one."""
+    if path is not None:
+        return file_digest(path)
+    import joblib
+
+    return joblib.hash((model.preprocessor, model.model))
+
+
+def row_keys(X, version):
+    """One 16-byte key per row of a transformed matrix (dense or sparse)."""
+    if sp.issparse(X):
+        X = X.toarray()
+    # +0.0 folds -0.0 into 0.0, they would hash differently
+    rows = np.ascontiguousarray(X, dtype=np.float64) + 0.0
+    key = hashlib.blake2b(version.encode(), digest_size=32).digest()
+    return [hashlib.blake2b(row.data, digest_size=16, key=key).digest() for row in rows]
+
+
+class PredictionCache:
+    """In-process LRU cache of probabilities, keyed by ``row_keys``.
+
+    Parameters
+    ----------
+    maxsize : int
+        Entries kept at most, the least recently used are evicted first.
+    ttl : float, optional
+        Seconds an entry is served after it was stored, forever when None.
+    """
+
+    def __init__(self, maxsize=100_000, ttl=None):
+        if maxsize < 1:
+            raise ValueError(f'maxsize must be at least 1, got {maxsize}')
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.store_hits = self.misses = self.evictions = self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_many(self, keys):
+        """Cached probabilities of ``keys``, NaN for the misses."""
+        out = np.full(len(keys), np.nan)
+        now = time.monotonic()
+        with self._lock:
+            for i, key in enumerate(keys):
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                value, expires = entry
+                if expires is not None and expires <= now:
+                    del self._entries[key]
+                    self.expirations += 1
+                    continue
+                self._entries.move_to_end(key)
+                out[i] = value
+        return out
+
+    def put_many(self, keys, values):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            for key, value in zip(keys, values):
+                self._entries[key] = (float(value), expires)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def metrics(self):
+        lookups = self.hits + self.store_hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'store_hits': self.store_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.store_hits) / lookups if lookups else math.nan,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+class PredictionStore:
+    """Probabilities shared by the processes of one host in a SQLite file.
+
+    Parameters
+    ----------
+    path : str
+        Database file, created when missing.
+    maxsize : int
+        Entries kept at most, the oldest written are dropped beyond it.
+    ttl : float, optional
+        Seconds an entry is served after it was written, forever when None.
+    """
+
+    # rows written between two checks of maxsize, counting the table isn't free
+    _TRIM_EVERY = 1000
+    # host parameters per statement, SQLite's limit is 32766 in recent versions
+    _CHUNK = 500
+
+    def __init__(self, path, maxsize=1_000_000, ttl=None, timeout=5.0):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._written = 0
+        # scoring runs in an executor thread, the lock serializes the connection
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS predictions '
+                         '(key BLOB PRIMARY KEY, proba REAL NOT NULL, written REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS predictions_written ON predictions (written)')
+
+    def get_many(self, keys):
+        """Stored probabilities of ``keys``, NaN for the misses and expired ones."""
+        out = np.full(len(keys), np.nan)
+        if not keys:
+            return out
+        oldest = -math.inf if self.ttl is None else time.time() - self.ttl
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), self._CHUNK):
+                chunk = keys[start:start + self._CHUNK]
+                found.update(self._db.execute(
+                    f'SELECT key, proba FROM predictions WHERE written > ? AND key IN ({",".join("?" * len(chunk))})',
+                    [oldest, *chunk]).fetchall())
+        for i, key in enumerate(keys):
+            out[i] = found.get(key, np.nan)
+        return out
+
+    def put_many(self, keys, values):
+        now = time.time()
+        with self._lock:
+            with self._db:
+                self._db.execute('BEGIN')
+                self._db.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)',
+                                     [(key, float(value), now) for key, value in zip(keys, values)])
+            self._written += len(keys)
+            if self._written >= self._TRIM_EVERY:
+                self._written = 0
+                self._trim()
+
+    def _trim(self):
+        if self.ttl is not None:
+            self._db.execute('DELETE FROM predictions WHERE written <= ?', [time.time() - self.ttl])
+        excess = self._db.execute('SELECT count(*) FROM predictions').fetchone()[0] - self.maxsize
+        if excess > 0:
+            self._db.execute('DELETE FROM predictions WHERE key IN '
+                             '(SELECT key FROM predictions ORDER BY written LIMIT ?)', [excess])
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM predictions')
+
+    def close(self):
+        self._db.close()
+
+
+class CachedScoringModel:
+    """A ``ScoringModel`` that looks probabilities up before running the model.
+
+    Scores like the wrapped model (``score``, ``score_records``, ``name``,
+    ``preprocessor``), so it can be given to ``score_file`` or the service.
+
+    Parameters
+    ----------
+    model : ScoringModel or str
+        The model, or the path it was saved to (which gives a version stable
+        across processes).
+    cache : PredictionCache, optional
+        In-process tier, a default ``PredictionCache()`` when None.
+    store : PredictionStore, optional
+        Shared tier, looked up on in-process misses.
+    version : str, optional
+        Overrides the model version ``model_version`` computes.
+    """
+
+    def __init__(self, model, cache=None, store=None, version=None):
+        path = None
+        if isinstance(model, str):
+            path, model = model, ScoringModel.load(model)
+        self.model = model
+        self.cache = PredictionCache() if cache is None else cache
+        self.store = store
+        self.version = version or model_version(model, path)
+
+    @property
+    def name(self):
+        return self.model.name
+
+    @property
+    def preprocessor(self):
+        return self.model.preprocessor
+
+    def _score_matrix(self, X):
+        valid = valid_rows(X)
+        proba = np.full(len(valid), np.nan, dtype=np.float32)
+        rows = np.flatnonzero(valid)
+        if not len(rows):
+            return proba
+        X = X[rows] if len(rows) < len(valid) else X
+        with profiling.stage('cached_score', X) as stage:
+            keys = row_keys(X, self.version)
+            found = self.cache.get_many(keys)
+            missing = np.flatnonzero(np.isnan(found))
+            self.cache.hits += len(keys) - len(missing)
+            if len(missing) and self.store is not None:
+                stored = self.store.get_many([keys[i] for i in missing])
+                in_store = ~np.isnan(stored)
+                found[missing[in_store]] = stored[in_store]
+                self.cache.put_many([keys[i] for i in missing[in_store]], stored[in_store])
+                self.cache.store_hits += int(in_store.sum())
+                missing = missing[~in_store]
+            if len(missing):
+                self.cache.misses += len(missing)
+                computed = self.model.predict_proba_matrix(X[missing])
+                found[missing] = computed
+                new_keys = [keys[i] for i in missing]
+                self.cache.put_many(new_keys, computed)
+                if self.store is not None:
+                    self.store.put_many(new_keys, computed)
+            proba[rows] = found
+            stage.output(proba)
+        return proba
+
+    def score(self, records):
+        return self._score_matrix(self.preprocessor.transform(records))
+
+    def score_records(self, records):
+        """``score`` for a list of application dicts, see ``transform_records``."""
+        return self._score_matrix(self.preprocessor.transform_records(records))
@@ -0,0 +1,117 @@
+"""Batch version of the notebook's data preparation, stage by stage.
+
+The stages match the notebook: ``clean`` (after the leakage drop),
+``engineer`` (after feature engineering) and ``final`` (``final_data``).
+``prepare`` runs them through a ``StageCache`` so reruns start from the
+latest stage already on disk.
+"""
+import numpy as np
+import pandas as pd
+
+from credit_loan import loader, preprocessing
+from credit_loan.cache import StageCache
+from credit_loan.preprocessing import valid_rows
+from credit_loan.profiling import traced
+
+
+# everything that changes the output of the stages, hashed into the cache key
+CONFIG = {
+    'version': 2,
+    'columns': loader.COLUMNS,
+    'schema': loader.SCHEMA,
+    'good_loan': loader.GOOD_LOAN,
+    'ambiguous': loader.AMBIGUOUS,
+    'emp_map': preprocessing.emp_map,
+    'grade_map': preprocessing.grade_map,
+    'reference_year': preprocessing.REFERENCE_YEAR,
+    'to_dummies': preprocessing.to_dummies,
+    'drop_dummies': preprocessing.drop_dummies,
+}
+
+STAGES = ['clean', 'engineer', 'final']
+
+
+@traced('clean')
+def clean(filepath, chunksize=100_000):
+    """Load the resolved loans and drop the leakage columns."""
+    data = loader.load_loans(filepath, chunksize=chunksize)
+    return data.drop(columns='loan_status')
+
+
+@traced('engineer')
+def engineer(data, reference_year=preprocessing.REFERENCE_YEAR):
+    """Replace the raw employment, derogatory and date columns by their features.
+
+    Rows with an invalid earliest credit line are dropped, as in the notebook.
+    """
+    derived = preprocessing.engineer(data, reference_year)
+    raw = ['emp_length', 'mths_since_last_major_derog', 'earliest_cr_line', 'last_credit_pull_d']
+    engineered = data.drop(columns=raw)
+    for name in ['emp_length', 'major_derogatory', 'earliest_cr_yr', 'yr_since_last_inq']:
+        engineered[name] = derived[name]
+    return engineered[~np.isnan(derived['earliest_cr_yr'])]
+
+
+@traced('finalize')
+def finalize(data, preprocessor=None):
+    """Encode ``data`` into ``final_data``, fitting ``preprocessor`` if needed."""
+    if preprocessor is None:
+        preprocessor = preprocessing.LoanPreprocessor().fit(data)
+    final_data = pd.DataFrame(preprocessor.transform(data),
+                              columns=preprocessor.get_feature_names_out())
+    final_data['loan_ending'] = data['loan_ending'].to_numpy()
+    return final_data.dropna().reset_index(drop=True)
+
+
+def _stage_cache(cache_dir, filepath, fmt, reference_year):
+    if cache_dir is None:
+        return None
+    return StageCache(cache_dir, filepath, {**CONFIG, 'reference_year': reference_year}, fmt=fmt)
+
+
+def _engineered(filepath, cache, chunksize, reference_year):
+    if cache is None:
+        return engineer(clean(filepath, chunksize), reference_year)
+    if 'engineer' in cache:
+        return cache.get('engineer')
+    cleaned = cache.cached('clean', lambda: clean(filepath, chunksize))
+    return cache.put('engineer', engineer(cleaned, reference_year))
+
+
+def prepare(filepath, cache_dir=None, chunksize=100_000, fmt='parquet', return_preprocessor=False,
+            reference_year=preprocessing.REFERENCE_YEAR):
+    """Return ``final_data`` for ``filepath``, reusing cached stages.
+
+    With ``return_preprocessor`` the fitted ``LoanPreprocessor`` is returned
+    too, it is refit from the (cached) engineered stage on a final cache hit.
+    ``reference_year`` is the "as of" year of the date features, it is part
+    of the cache key.
+    """
+    cache = _stage_cache(cache_dir, filepath, fmt, reference_year)
+    if cache is not None and 'final' in cache and not return_preprocessor:
+        return cache.get('final')
+
+    engineered = _engineered(filepath, cache, chunksize, reference_year)
+    preprocessor = preprocessing.LoanPreprocessor(reference_year).fit(engineered)
+    if cache is None:
+        final_data = finalize(engineered, preprocessor)
+    else:
+        final_data = cache.cached('final', lambda: finalize(engineered, preprocessor))
+    return (final_data, preprocessor) if return_preprocessor else final_data
+
+
+def features(filepath, cache_dir=None, output='sparse', chunksize=100_000, fmt='parquet',
+             reference_year=preprocessing.REFERENCE_YEAR):
+    """Model matrix, target and fitted preprocessor for ``filepath``.
+
+    Same rows and columns as ``final_data`` but encoded by ``LoanPreprocessor``
+    with the given ``output`` (CSR by default), and ``y`` is 1 for good loans.
+    """
+    cache = _stage_cache(cache_dir, filepath, fmt, reference_year)
+    engineered = _engineered(filepath, cache, chunksize, reference_year)
+    preprocessor = preprocessing.LoanPreprocessor(reference_year, output=output).fit(engineered)
+
+    X = preprocessor.transform(engineered)
+    valid = valid_rows(X)
+    y = np.asarray(engineered['loan_ending'] == 'good', dtype=np.int8)
+    return X[valid], y[valid], preprocessor
@@ -0,0 +1,491 @@
+"""Feature preprocessing of the loan frame as a scikit-learn transformer.
+
+``LoanPreprocessor`` turns loader output into the model matrix of the
+notebook's ``final_data`` (without ``loan_ending``). Its learned state is the
+one-hot vocabulary, so a fitted instance can be pickled with the model and
+reused to score new applications with exactly the same columns.
+
+The encoding itself is ``LoanEncoder``, which doesn't need sklearn.
+``LoanPreprocessor`` adds the estimator API and lives in
+``credit_loan.transformer``; this module imports it on first access, so
+importing the scoring code doesn't import sklearn (a second of every worker
+start).
+
+The string columns (``'Jan-85'`` dates, ``'10+ years'``, ``' 36 months'``,
+grades) only take a few hundred distinct values, so they are parsed through
+``ValueMemo`` lookups: each distinct value is parsed once and the result is
+spread back to the rows by category code. A fitted preprocessor has its own
+memos, pickled with it, so scoring runs start with every value seen in
+training parsed. A memo keeps the ``MEMO_SIZE`` most recently used values, a
+long-running service fed new strings doesn't grow.
+"""
+import collections
+import math
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+emp_map = {
+    '< 1 year': 0,
+    '1 year': 1,
+    '2 years': 2,
+    '3 years': 3,
+    '4 years': 4,
+    '5 years': 5,
+    '6 years': 6,
+    '7 years': 7,
+    '8 years': 8,
+    '9 years': 9,
+    '10+ years': 10,
+}
+
+grade_map = {
+    'A': 1,
+    'B': 2,
+    'C': 3,
+    'D': 4,
+    'E': 5,
+    'F': 6,
+    'G': 7,
+}
+
+# the "as of" year: data is from 2007 - 2014, inquiries are counted back from
+# this year and credit lines opened after it are '%y' parsing artifacts
+# (1968 -> 2068). Scoring newer applications needs a later one.
+REFERENCE_YEAR = 2016
+
+to_dummies = ['home_ownership', 'verification_status',
+              'purpose', 'addr_state', 'initial_list_status']
+
+# only one of the two initial_list_status dummies is needed
+drop_dummies = ['initial_list_status_w']
+
+OUTPUTS = ['dense', 'sparse', 'codes']
+
+# parsed values a ValueMemo keeps, the data has a few hundred distinct ones
+MEMO_SIZE = 10_000
+
+# numeric features in the order of the notebook's final_data
+NUMERIC_FEATURES = ['loan_amnt', 'int_rate', 'installment', 'emp_length', 'annual_inc', 'dti',
+                    'delinq_2yrs', 'inq_last_6mths', 'open_acc', 'pub_rec', 'revol_bal',
+                    'revol_util', 'total_acc', 'collections_12_mths_ex_med', 'acc_now_delinq',
+                    'major_derogatory', 'earliest_cr_yr', 'yr_since_last_inq', 'term', 'grade']
+
+
+def _is_numeric(series):
+    return pd.api.types.is_numeric_dtype(series.dtype)
+
+
+def _missing(value):
+    return value is None or value == '' or (isinstance(value, float) and math.isnan(value))
+
+
+def _number(value):
+    return math.nan if _missing(value) else float(value)
+
+
+def _parse_month_year(value):
+    # same '%y' century pivot as pd.to_datetime: 69 - 99 -> 19xx, 00 - 68 -> 20xx
+    return datetime.strptime(value, '%b-%y').year
+
+
+def _parse_month_index(value):
+    date = datetime.strptime(value, '%b-%y')
+    return date.year * 12 + date.month - 1
+
+
+def _parse_emp_length(value):
+    return emp_map.get(value, 0)
+
+
+def _parse_term(value):
+    try:
+        return float(str(value).replace(' months', ''))
+    except ValueError:
+        return math.nan
+
+
+def _parse_grade(value):
+    return grade_map.get(value, math.nan)
+
+
+class ValueMemo:
+    """Parsed value of every distinct raw value seen so far.
+
+    Parameters
+    ----------
+    parse : callable
+        Raw (non-missing) value -> number. Must be a module-level function so
+        the memo can be pickled.
+    missing : float
+        Result for missing values.
+    maxsize : int
+        Values kept at most, the least recently used are dropped first.
+    """
+
+    def __init__(self, parse, missing=math.nan, maxsize=MEMO_SIZE):
+        self.parse = parse
+        self.missing = missing
+        self.maxsize = maxsize
+        self.values = collections.OrderedDict()
+
+    def __setstate__(self, state):
+        # memos pickled before they were bounded
+        state.setdefault('maxsize', MEMO_SIZE)
+        state['values'] = collections.OrderedDict(state['values'])
+        self.__dict__.update(state)
+
+    def __len__(self):
+        return len(self.values)
+
+    def clear(self):
+        self.values.clear()
+
+    def get(self, value):
+        if _missing(value):
+            return self.missing
+        try:
+            parsed = self.values[value]
+        except KeyError:
+            parsed = self.values[value] = float(self.parse(value))
+            if len(self.values) > self.maxsize:
+                self.values.popitem(last=False)
+        else:
+            self.values.move_to_end(value)
+        return parsed
+
+    def __call__(self, series):
+        """float32 array of the parsed ``series``, one parse per new distinct value."""
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            codes, uniques = series.cat.codes.to_numpy(), series.cat.categories
+        else:
+            codes, uniques = pd.factorize(series)
+        # the extra last slot is what code -1 (missing) picks
+        table = np.empty(len(uniques) + 1, dtype=np.float32)
+        table[:-1] = [self.get(value) for value in uniques]
+        table[-1] = self.missing
+        return table[codes]
+
+
+def memos():
+    """A fresh memo per parsed column kind, both date columns share one."""
+    return {
+        'month_year': ValueMemo(_parse_month_year),
+        'month_index': ValueMemo(_parse_month_index),
+        'emp_length': ValueMemo(_parse_emp_length, missing=0),
+        'term': ValueMemo(_parse_term),
+        'grade': ValueMemo(_parse_grade),
+    }
+
+
+# shared by every call that isn't given its own memos
+MEMOS = memos()
+
+
+def emp_length_years(emp_length, memo=None):
+    """'10+ years' -> 10, unknown or missing -> 0."""
+    if _is_numeric(emp_length):
+        return emp_length.to_numpy(dtype=np.float32)
+    return (MEMOS['emp_length'] if memo is None else memo)(emp_length)
+
+
+def term_months(term, memo=None):
+    """' 36 months' -> 36."""
+    if _is_numeric(term):
+        return term.to_numpy(dtype=np.float32)
+    return (MEMOS['term'] if memo is None else memo)(term)
+
+
+def grade_number(grade, memo=None):
+    """'A' -> 1 ... 'G' -> 7."""
+    if _is_numeric(grade):
+        return grade.to_numpy(dtype=np.float32)
+    return (MEMOS['grade'] if memo is None else memo)(grade)
+
+
+def credit_year(date, memo=None):
+    """Year of a '%b-%y' date such as 'Jan-85'."""
+    return (MEMOS['month_year'] if memo is None else memo)(date)
+
+
+def month_index(date, memo=None):
+    """Months since year 0 of a '%b-%y' date: 'Jan-15' -> 2015 * 12, 'Feb-15' -> 2015 * 12 + 1."""
+    return (MEMOS['month_index'] if memo is None else memo)(date)
+
+
+def engineer(data, reference_year=REFERENCE_YEAR, memos=None):
+    """Derived numeric columns of ``data``, keyed by feature name.
+
+    Accepts raw loader output as well as frames where a feature was already
+    derived (e.g. the notebook's ``data`` after ``emp_length`` was mapped):
+    derived columns are passed through as they are. Credit lines opened in or
+    after ``reference_year`` come out as NaN, like the rows the notebook drops.
+    ``memos`` (see ``memos()``) defaults to the shared ``MEMOS``.
+    """
+    memos = MEMOS if memos is None else memos
+    columns = {}
+    columns['emp_length'] = emp_length_years(data['emp_length'], memos['emp_length'])
+    columns['term'] = term_months(data['term'], memos['term'])
+    columns['grade'] = grade_number(data['grade'], memos['grade'])
+
+    if 'major_derogatory' in data:
+        columns['major_derogatory'] = data['major_derogatory'].to_numpy(dtype=np.float32)
+    else:
+        # ever did a major derogatory? 0 = nope, 1 = yes.
+        columns['major_derogatory'] = data['mths_since_last_major_derog'].notna().to_numpy(dtype=np.float32)
+
+    if 'earliest_cr_line' in data:
+        earliest_cr_yr = credit_year(data['earliest_cr_line'], memos['month_year'])
+    else:
+        # a copy, the column of a float32 frame would be written through
+        earliest_cr_yr = data['earliest_cr_yr'].to_numpy(dtype=np.float32, copy=True)
+    earliest_cr_yr[earliest_cr_yr >= reference_year] = np.nan
+    columns['earliest_cr_yr'] = earliest_cr_yr
+
+    if 'last_credit_pull_d' in data:
+        columns['yr_since_last_inq'] = reference_year - credit_year(data['last_credit_pull_d'], memos['month_year'])
+    else:
+        columns['yr_since_last_inq'] = data['yr_since_last_inq'].to_numpy(dtype=np.float32)
+    return columns
+
+
+def encode_record(record, reference_year=REFERENCE_YEAR, memos=None):
+    """Numeric features of one application given as a dict, in NUMERIC_FEATURES order.
+
+    The per-record counterpart of ``engineer`` for online scoring, plain
+    Python lookups instead of building a one-row DataFrame.
+    """
+    memos = MEMOS if memos is None else memos
+    emp_length = record.get('emp_length')
+    if isinstance(emp_length, str) or _missing(emp_length):
+        emp_length = memos['emp_length'].get(emp_length)
+
+    term = record.get('term')
+    if isinstance(term, str):
+        term = memos['term'].get(term)
+
+    grade = record.get('grade')
+    grade = memos['grade'].get(grade) if isinstance(grade, str) else grade
+
+    if 'major_derogatory' in record:
+        major_derogatory = record['major_derogatory']
+    else:
+        major_derogatory = 0 if _missing(record.get('mths_since_last_major_derog')) else 1
+
+    if 'earliest_cr_line' in record:
+        value = record['earliest_cr_line']
+        earliest_cr_yr = memos['month_year'].get(value)
+    else:
+        earliest_cr_yr = _number(record.get('earliest_cr_yr'))
+    if earliest_cr_yr >= reference_year:
+        earliest_cr_yr = math.nan
+
+    if 'last_credit_pull_d' in record:
+        value = record['last_credit_pull_d']
+        yr_since_last_inq = reference_year - memos['month_year'].get(value)
+    else:
+        yr_since_last_inq = record.get('yr_since_last_inq')
+
+    derived = {
+        'emp_length': emp_length,
+        'term': term,
+        'grade': grade,
+        'major_derogatory': major_derogatory,
+        'earliest_cr_yr': earliest_cr_yr,
+        'yr_since_last_inq': yr_since_last_inq,
+    }
+    return [_number(derived[name] if name in derived else record.get(name)) for name in NUMERIC_FEATURES]
+
+
+class LoanEncoder:
+    """Encode loan records into the float32 model matrix.
+
+    Parameters
+    ----------
+    reference_year : int
+        The "as of" year: "today" for ``yr_since_last_inq`` and the cut-off
+        for invalid ``earliest_cr_yr`` values. The parse memos don't depend
+        on it, it can be changed on a fitted instance.
+    dummies : list of str
+        Categorical columns to one-hot encode. The categories seen by ``fit``
+        become the vocabulary; unseen categories encode as all zeros.
+    output : {'dense', 'sparse', 'codes'}
+        ``'dense'`` is the notebook's ``final_data`` layout as an ndarray.
+        ``'sparse'`` is the same columns as a CSR matrix, which keeps the
+        mostly-zero one-hot block small and is accepted as is by
+        ``LogisticRegression`` and ``RandomForestClassifier``. ``'codes'``
+        replaces each one-hot group by one integer category code column
+        (-1 when unseen), a compact dense input for tree models.
+
+    Rows with a missing feature come out with NaN in that column, which is how
+    the notebook's ``dropna`` rows can be found after ``transform``
+    (see ``valid_rows``).
+    """
+
+    def __init__(self, reference_year=REFERENCE_YEAR, dummies=None, output='dense'):
+        self.reference_year = reference_year
+        self.dummies = dummies
+        self.output = output
+
+    def _check_fitted(self):
+        if not hasattr(self, 'categories_'):
+            raise ValueError(f'this {type(self).__name__} is not fitted yet, call fit first')
+
+    def _dummy_columns(self):
+        return to_dummies if self.dummies is None else list(self.dummies)
+
+    def _categories(self, X):
+        categories = {}
+        for col in self._dummy_columns():
+            values = X[col]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                # categories of loader output may include values absent from X
+                values = values.cat.remove_unused_categories().cat.categories
+            categories[col] = np.sort(pd.unique(values.dropna()).astype(str)).astype(object)
+        return categories
+
+    def fit(self, X, y=None):
+        if self.output not in OUTPUTS:
+            raise ValueError(f'unknown output {self.output!r}, expected one of {OUTPUTS}')
+        self._set_vocabulary(self._categories(X))
+        return self
+
+    def partial_fit(self, X, y=None):
+        """Add the categories of ``X`` to the vocabulary, for data seen in chunks.
+
+        The output columns change when a new category shows up, so finish the
+        vocabulary pass before transforming anything for training.
+        """
+        if not hasattr(self, 'categories_'):
+            return self.fit(X)
+        seen = self._categories(X)
+        self._set_vocabulary({col: np.union1d(categories, seen[col]).astype(object)
+                              for col, categories in self.categories_.items()})
+        return self
+
+    def _set_vocabulary(self, categories):
+        self.categories_ = categories
+        # output column of every category, -1 for the dropped dummies
+        names = list(NUMERIC_FEATURES)
+        self.positions_ = {}
+        for col, categories in self.categories_.items():
+            positions = np.full(len(categories), -1, dtype=np.intp)
+            for i, category in enumerate(categories):
+                name = f'{col}_{category}'
+                if name not in drop_dummies:
+                    positions[i] = len(names)
+                    names.append(name)
+            self.positions_[col] = positions
+        if self.output == 'codes':
+            names = NUMERIC_FEATURES + list(self.categories_)
+        self.feature_names_out_ = np.asarray(names, dtype=object)
+        if not hasattr(self, 'memos_'):
+            # kept when the vocabulary grows, parsing doesn't depend on it
+            self.memos_ = memos()
+
+    def get_feature_names_out(self, input_features=None):
+        self._check_fitted()
+        return self.feature_names_out_
+
+    def _fill_numeric(self, X, out):
+        derived = engineer(X, self.reference_year, getattr(self, 'memos_', None))
+        for i, name in enumerate(NUMERIC_FEATURES):
+            out[:, i] = derived[name] if name in derived else X[name].to_numpy(dtype=np.float32, na_value=np.nan)
+
+    def transform_numeric(self, X):
+        """The ``NUMERIC_FEATURES`` block of ``transform``, works before ``fit``."""
+        out = np.empty((len(X), len(NUMERIC_FEATURES)), dtype=np.float32)
+        self._fill_numeric(X, out)
+        return out
+
+    def _one_hot(self, X):
+        # (row, output column) of every one in the one-hot block
+        rows, positions = [], []
+        for col, categories in self.categories_.items():
+            codes = pd.Categorical(X[col], categories=categories).codes
+            col_positions = np.where(codes >= 0, self.positions_[col][codes], -1)
+            hit = np.flatnonzero(col_positions >= 0)
+            rows.append(hit)
+            positions.append(col_positions[hit])
+        return np.concatenate(rows), np.concatenate(positions)
+
+    def transform(self, X):
+        self._check_fitted()
+        n_rows = len(X)
+        n_numeric = len(NUMERIC_FEATURES)
+
+        if self.output == 'dense':
+            out = np.zeros((n_rows, len(self.feature_names_out_)), dtype=np.float32)
+            self._fill_numeric(X, out)
+            rows, positions = self._one_hot(X)
+            out[rows, positions] = 1
+            return out
+
+        if self.output == 'codes':
+            out = np.empty((n_rows, len(self.feature_names_out_)), dtype=np.float32)
+            self._fill_numeric(X, out)
+            for i, (col, categories) in enumerate(self.categories_.items()):
+                out[:, n_numeric + i] = pd.Categorical(X[col], categories=categories).codes
+            return out
+
+        numeric = np.empty((n_rows, n_numeric), dtype=np.float32)
+        self._fill_numeric(X, numeric)
+        rows, positions = self._one_hot(X)
+        one_hot = sp.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, positions - n_numeric)),
+            shape=(n_rows, len(self.feature_names_out_) - n_numeric))
+        return sp.hstack([sp.csr_matrix(numeric), one_hot], format='csr')
+
+    def transform_records(self, records):
+        """``transform`` for a list of application dicts, without pandas.
+
+        Meant for online scoring of small batches, where building a DataFrame
+        per request costs more than the encoding itself.
+        """
+        self._check_fitted()
+        n_numeric = len(NUMERIC_FEATURES)
+        codes = self.output == 'codes'
+        if codes:
+            lookup = {col: {category: i for i, category in enumerate(categories)}
+                      for col, categories in self.categories_.items()}
+        else:
+            lookup = {col: {category: position for category, position in zip(categories, self.positions_[col])
+                            if position >= 0}
+                      for col, categories in self.categories_.items()}
+
+        memos = getattr(self, 'memos_', None)
+        out = np.zeros((len(records), len(self.feature_names_out_)), dtype=np.float32)
+        for i, record in enumerate(records):
+            out[i, :n_numeric] = encode_record(record, self.reference_year, memos)
+            for j, (col, positions) in enumerate(lookup.items()):
+                position = positions.get(record.get(col), -1)
+                if codes:
+                    out[i, n_numeric + j] = position
+                elif position >= 0:
+                    out[i, position] = 1
+
+        if self.output == 'sparse':
+            return sp.csr_matrix(out)
+        return out
+
+
+def __getattr__(name):
+    if name == 'LoanPreprocessor':
+        from credit_loan.transformer import LoanPreprocessor
+
+        return LoanPreprocessor
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def valid_rows(X):
+    """Boolean mask of the rows of a transformed matrix without missing values."""
+    if sp.issparse(X):
+        X = X.tocsr()
+        has_nan = np.isnan(X.data)
+        bad = np.zeros(X.shape[0], dtype=bool)
+        bad[np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))[has_nan]] = True
+        return ~bad
+    return ~np.isnan(X).any(axis=1)
@@ -0,0 +1,236 @@
+"""Per-stage timing, memory and shape tracing.
+
+Named stages are wrapped with ``stage`` (a context manager) or ``traced`` (a
+decorator). While a ``Tracer`` is active they record the elapsed time, the
+RSS change, the rows and columns going in and out and, optionally, a cProfile
+dump; the trace is saved as JSON or as a Chrome trace-event timeline (open it
+in chrome://tracing or https://ui.perfetto.dev).
+
+Tracing is off by default. A disabled stage is one global lookup returning a
+shared no-op object, so the hooks stay in the batch code for good::
+
+    with profiling.tracing() as tracer:
+        final_data = prepare(filepath)
+    tracer.save('trace.json')
+"""
+import cProfile
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+# the Tracer stages are recorded into, None when tracing is off
+_active = None
+
+
+def rss():
+    """Current resident set size in bytes, 0 where it can't be read (Windows)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        pass
+    if resource is None:
+        return 0
+    # no procfs, the lifetime peak is the best there is: bytes on macOS,
+    # kilobytes elsewhere
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def shape(data):
+    """(rows, columns) of a frame, array, sparse matrix or list, None otherwise."""
+    dims = getattr(data, 'shape', None)
+    if dims is None:
+        return (len(data), None) if isinstance(data, (list, tuple)) else None
+    if len(dims) == 1:
+        return (dims[0], 1)
+    return (dims[0], dims[1])
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def output(self, data):
+        return data
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Stage:
+    """One running stage, call ``output(result)`` to record its output shape."""
+
+    def __init__(self, tracer, name, data):
+        self.tracer = tracer
+        self.record = {'name': name, 'shape_in': shape(data) if data is not None else None,
+                       'shape_out': None}
+        self._profiler = None
+
+    def output(self, data):
+        self.record['shape_out'] = shape(data)
+        return data
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        self.record['parent'] = stack[-1].record['name'] if stack else None
+        self.record['depth'] = len(stack)
+        self.record['thread'] = threading.get_ident()
+        stack.append(self)
+
+        # cProfile can't nest, the outermost stage profiles everything inside
+        if self.tracer.profile_dir is not None and not any(s._profiler for s in stack[:-1]):
+            self._profiler = cProfile.Profile()
+        self._rss = rss()
+        self._start = time.perf_counter()
+        if self._profiler is not None:
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._profiler is not None:
+            self._profiler.disable()
+        end = time.perf_counter()
+        self.tracer._stack().pop()
+
+        self.record['start'] = self._start - self.tracer.origin
+        self.record['seconds'] = end - self._start
+        self.record['memory_delta_mb'] = (rss() - self._rss) / 2 ** 20
+        if exc_type is not None:
+            self.record['error'] = f'{exc_type.__name__}: {exc}'
+        if self._profiler is not None:
+            self.record['profile'] = self.tracer._dump_profile(self._profiler, self.record['name'])
+        self.tracer.records.append(self.record)
+        return False
+
+
+class Tracer:
+    """Collects stage records.
+
+    Parameters
+    ----------
+    profile_dir : str, optional
+        Run outermost stages under cProfile and write one ``.prof`` file per
+        stage there (``python -m pstats`` or snakeviz read them).
+    """
+
+    def __init__(self, profile_dir=None):
+        self.profile_dir = profile_dir
+        self.records = []
+        self.origin = time.perf_counter()
+        self._local = threading.local()
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _dump_profile(self, profiler, name):
+        path = os.path.join(self.profile_dir, f'{len(self.records):03d}-{name}.prof')
+        profiler.dump_stats(path)
+        return path
+
+    def stage(self, name, data=None):
+        return Stage(self, name, data)
+
+    def to_frame(self):
+        import pandas as pd
+
+        frame = pd.DataFrame(self.records)
+        return frame.sort_values('start', ignore_index=True) if len(frame) else frame
+
+    def save(self, path):
+        """Write the records as JSON, reload them with ``Tracer.load``."""
+        with open(path, 'w') as f:
+            json.dump({'records': self.records}, f, indent=1)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            tracer = cls()
+            tracer.records = json.load(f)['records']
+        return tracer
+
+    def save_timeline(self, path):
+        """Write the stages as Chrome trace events."""
+        events = [{
+            'name': record['name'],
+            'ph': 'X',
+            'ts': record['start'] * 1e6,
+            'dur': record['seconds'] * 1e6,
+            'pid': os.getpid(),
+            'tid': record['thread'],
+            'args': {key: record.get(key) for key in ['shape_in', 'shape_out', 'memory_delta_mb', 'error']},
+        } for record in self.records]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        return path
+
+
+def stage(name, data=None):
+    """Context manager timing the stage ``name`` into the active tracer, if any."""
+    if _active is None:
+        return _NULL_STAGE
+    return _active.stage(name, data)
+
+
+def traced(name):
+    """Decorator recording every call as stage ``name``.
+
+    The first argument is taken as the stage input and the return value as
+    its output.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            with _active.stage(name, args[0] if args else None) as s:
+                return s.output(func(*args, **kwargs))
+        return wrapper
+    return decorator
+
+
+def enable(tracer=None, **kwargs):
+    """Activate ``tracer`` until ``disable``, for flat scripts a with block doesn't fit."""
+    global _active
+    _active = tracer if tracer is not None else Tracer(**kwargs)
+    return _active
+
+
+def disable():
+    global _active
+    _active = None
+
+
+class tracing:
+    """Activate ``tracer`` (a new ``Tracer(**kwargs)`` by default) in the block."""
+
+    def __init__(self, tracer=None, **kwargs):
+        self.tracer = tracer if tracer is not None else Tracer(**kwargs)
+
+    def __enter__(self):
+        global _active
+        self._previous, _active = _active, self.tracer
+        return self.tracer
+
+    def __exit__(self, *exc):
+        global _active
+        _active = self._previous
+        return False
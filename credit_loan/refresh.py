@@ -0,0 +1,256 @@
+"""Monthly refresh of the trained models with a new loan vintage.
+
+Instead of rerunning everything from ``pd.read_csv`` to ``voting_clf.fit``:
+
+- only the new file is read and encoded, with the preprocessor persisted in
+  the ``ScoringModel`` (its vocabulary is kept, so the model columns don't
+  change), and appended to a ``TrainingStore``: one Parquet part of model
+  matrix + target per vintage;
+- ``RandomForestClassifier`` gets ``add_trees`` more trees through
+  ``warm_start``, fitted on the store, the existing trees are kept;
+- ``LogisticRegression`` continues its solver from the previous
+  coefficients (``warm_start``), which converges in a few iterations;
+- anything else (KNN, decision tree) is refit on the store, members of a
+  ``PrefitVotingClassifier`` are refreshed one by one.
+
+Each model file holds its own copy of its estimators: ``rf.joblib`` and the
+``rf`` of ``voting_clf.joblib`` are two equal forests. Refreshed together, a
+model named like a member of the voting model (same class and parameters) is
+saved with the refreshed member instead of being refit a second time.
+
+The store records which model files learnt which vintage, once each is saved,
+so rerunning a refresh that failed only finishes it. Model bundles are
+read-only: refresh the joblib model and pack it again.
+
+Usage::
+
+    # once, to seed the store with the original training data
+    python -m credit_loan.refresh store/ 2007-2014 loan_data_2007_2014.csv rf.joblib --append-only
+    # every month
+    python -m credit_loan.refresh store/ 2015-01 loans_2015_01.csv rf.joblib lr.joblib voting_clf.joblib
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from credit_loan import loader, profiling
+from credit_loan.artifact import ScoringModel
+from credit_loan.cache import atomic_write, dump_json, file_digest
+from credit_loan.ensemble import PrefitVotingClassifier
+from credit_loan.forest import FlatForest
+from credit_loan.preprocessing import valid_rows
+
+
+class TrainingStore:
+    """Encoded training rows, one Parquet part per vintage.
+
+    ``manifest.json`` lists the vintages in the order they were added with
+    their row count and source digest, the feature names every part was
+    encoded with and, per model file, the vintages it was refreshed with.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+        try:
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        except OSError:
+            self.manifest = {'feature_names': None, 'vintages': [], 'refreshed': {}}
+
+    @property
+    def vintages(self):
+        return [entry['vintage'] for entry in self.manifest['vintages']]
+
+    def __contains__(self, vintage):
+        return vintage in self.vintages
+
+    def __len__(self):
+        return sum(entry['rows'] for entry in self.manifest['vintages'])
+
+    def _part(self, vintage):
+        return os.path.join(self.directory, f'{vintage}.parquet')
+
+    def append(self, vintage, X, y, source_digest=None):
+        """Store the model matrix ``X`` (dense) and target ``y`` as ``vintage``."""
+        if vintage in self:
+            raise ValueError(f'vintage {vintage!r} is already in the store')
+        names = [str(name) for name in X.columns]
+        if self.manifest['feature_names'] is None:
+            self.manifest['feature_names'] = names
+        elif names != self.manifest['feature_names']:
+            raise ValueError(f'vintage {vintage!r} was encoded with different columns than the store')
+
+        frame = X.reset_index(drop=True)
+        frame['y'] = np.asarray(y, dtype=np.int8)
+        atomic_write(self._part(vintage), frame.to_parquet)
+        self.manifest['vintages'].append({'vintage': vintage, 'rows': len(frame), 'source': source_digest})
+        self._write_manifest()
+
+    def _write_manifest(self):
+        atomic_write(self.manifest_path, lambda path: dump_json(self.manifest, path))
+
+    def refreshed(self, model_path):
+        """Vintages the model saved at ``model_path`` was refreshed with."""
+        refreshed = self.manifest.get('refreshed')
+        if refreshed is None:
+            # stores written before this was tracked only list vintages
+            # their models were refreshed with
+            return self.vintages
+        return refreshed.get(os.path.abspath(model_path), [])
+
+    def mark_refreshed(self, model_path, vintage):
+        """Record that the model saved at ``model_path`` learnt ``vintage``."""
+        refreshed = self.manifest.setdefault('refreshed', {})
+        refreshed.setdefault(os.path.abspath(model_path), []).append(vintage)
+        self._write_manifest()
+
+    def load(self, vintages=None):
+        """``(X, y)`` of ``vintages`` (default: all), in the order they were added."""
+        vintages = self.vintages if vintages is None else list(vintages)
+        if not vintages:
+            raise ValueError('the training store is empty')
+        frame = pd.concat([pd.read_parquet(self._part(v)) for v in vintages], ignore_index=True)
+        return frame.drop(columns='y'), frame['y'].to_numpy()
+
+
+def encode_file(preprocessor, filepath, chunksize=100_000):
+    """Model matrix (DataFrame) and target of the resolved loans of ``filepath``."""
+    frames, targets = [], []
+    names = preprocessor.get_feature_names_out()
+    for chunk in loader.iter_loans(filepath, chunksize=chunksize):
+        X = preprocessor.transform(chunk)
+        valid = valid_rows(X)
+        X = X[valid].toarray() if hasattr(X, 'toarray') else X[valid]
+        frames.append(pd.DataFrame(X, columns=names))
+        targets.append(np.asarray(chunk['loan_ending'] == 'good', dtype=np.int8)[valid])
+    return pd.concat(frames, ignore_index=True), np.concatenate(targets)
+
+
+def add_vintage(store, preprocessor, vintage, filepath, chunksize=100_000):
+    """Encode ``filepath`` and append it as ``vintage``, once: returns False if already there."""
+    if vintage in store:
+        return False
+    with profiling.stage('encode_vintage'):
+        X, y = encode_file(preprocessor, filepath, chunksize)
+    store.append(vintage, X, y, source_digest=file_digest(filepath))
+    return True
+
+
+def refresh_estimator(model, X, y, add_trees=10):
+    """Update ``model`` in place on ``(X, y)``, return it."""
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.linear_model import LogisticRegression
+
+    if isinstance(model, PrefitVotingClassifier):
+        for _, member in model.estimators:
+            refresh_estimator(member, X, y, add_trees)
+        return model
+
+    if isinstance(model, RandomForestClassifier):
+        warm_start = model.warm_start
+        # warm_start keeps the fitted trees and only fits the new ones
+        model.set_params(warm_start=True, n_estimators=len(model.estimators_) + add_trees)
+        model.fit(X, y)
+        model.set_params(warm_start=warm_start)
+        return model
+
+    if isinstance(model, LogisticRegression):
+        warm_start = model.warm_start
+        # the solver starts from the previous coef_ / intercept_
+        model.set_params(warm_start=True)
+        model.fit(X, y)
+        model.set_params(warm_start=warm_start)
+        return model
+
+    if isinstance(model, FlatForest):
+        raise TypeError(f'{type(model).__name__} cannot be refreshed, refresh the model it was built from')
+    return model.fit(X, y)
+
+
+def _copy_of(model, member):
+    return (member is not None and member is not model and type(model) is type(member)
+            and model.get_params() == member.get_params())
+
+
+def refresh(models, store, add_trees=10, vintages=None):
+    """Refresh every ``ScoringModel`` on the store, return the seconds spent per model.
+
+    A model that is a copy of a member of one of the voting models, as
+    ``credit_loan.training`` saves them, takes the refreshed member.
+    """
+    X, y = store.load(vintages)
+    voting = [model for model in models if isinstance(model.model, PrefitVotingClassifier)]
+    members = {name: member for model in voting for name, member in model.model.estimators}
+    # before refreshing, which changes the parameters of forests
+    copies = {model.name for model in models if _copy_of(model.model, members.get(model.name))}
+    times = {}
+    for model in voting + [model for model in models if model not in voting]:
+        start = time.perf_counter()
+        with profiling.stage(f'refresh_{model.name}', X):
+            if model.name in copies:
+                model.model = members[model.name]
+            else:
+                refresh_estimator(model.model, X, y, add_trees)
+        times[model.name] = time.perf_counter() - start
+    return times
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Refresh persisted models with a new loan vintage.')
+    parser.add_argument('store', help='training store directory')
+    parser.add_argument('vintage', help='name of the new vintage, e.g. 2015-01')
+    parser.add_argument('input', help='resolved loans of the vintage (CSV)')
+    parser.add_argument('models', nargs='+', help='ScoringModel files, refreshed in place')
+    parser.add_argument('--add-trees', type=int, default=10, help='trees added to random forests (default: 10)')
+    parser.add_argument('--recent', type=int,
+                        help='train on the last RECENT vintages only (default: every vintage)')
+    parser.add_argument('--append-only', action='store_true',
+                        help='only add the vintage to the store, the models were trained on it')
+    parser.add_argument('--chunksize', type=int, default=100_000)
+    args = parser.parse_args(argv)
+
+    from credit_loan import bundle
+
+    for path in args.models:
+        if bundle.is_bundle(path):
+            parser.error(f'{path} is a model bundle, refresh the model it was packed from and pack it again')
+    models = [ScoringModel.load(path) for path in args.models]
+    names = [list(model.feature_names) for model in models]
+    if any(n != names[0] for n in names):
+        parser.error('the models were trained on different columns')
+    for model, path in zip(models, args.models):
+        model.name = model.name or os.path.splitext(os.path.basename(path))[0]
+
+    store = TrainingStore(args.store)
+    add_vintage(store, models[0].preprocessor, args.vintage, args.input, args.chunksize)
+    # a vintage counts as learnt once the model that learnt it is saved: a
+    # rerun after a failure refreshes the models that weren't, and doesn't
+    # add trees twice to the others
+    pending = [(model, path) for model, path in zip(models, args.models)
+               if args.vintage not in store.refreshed(path)]
+    if args.append_only:
+        # the models were trained on it
+        for _, path in pending:
+            store.mark_refreshed(path, args.vintage)
+        return
+    if not pending:
+        print(f'the models were refreshed with vintage {args.vintage} already, nothing to do', file=sys.stderr)
+        return
+
+    vintages = store.vintages[-args.recent:] if args.recent else None
+    times = refresh([model for model, _ in pending], store, args.add_trees, vintages)
+    for model, path in pending:
+        atomic_write(path, model.save)
+        store.mark_refreshed(path, args.vintage)
+        print(f'{model.name}: refreshed in {times[model.name]:.1f}s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""Stratified and vintage splits, class-balanced downsampling and streaming
+samples of loan books bigger than memory.
+
+The notebook splits ``final_data`` with an unstratified
+``train_test_split`` and always trains on every row. Here:
+
+- ``stratified_split`` keeps the good/bad ratio of both sides;
+- ``vintage_split`` puts the latest issue months (``issue_d``, parsed once
+  per distinct value by ``preprocessing.month_index``) in the test side, so
+  validation looks like scoring next month's loans;
+- ``downsample`` keeps every row of the rare class and a fraction of the
+  others, with a ``sample_weight`` of ``1 / rate`` on the kept ones so
+  weighted counts, rates and fitted probabilities stay those of the book;
+- ``ReservoirSampler`` draws a fixed number of rows per class (or per any
+  stratum) uniformly from a stream of chunks: every row gets a random key and
+  the ``size`` smallest keys of its stratum are kept (bottom-k sampling), so
+  memory is bounded by the sample and the result doesn't depend on the
+  chunking. The kept rows are weighted by population / sample size of their
+  stratum.
+
+Usage::
+
+    python -m credit_loan.sampling loans.csv sample.parquet --per-class 100000 --vintage
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from credit_loan import loader, profiling
+from credit_loan.preprocessing import month_index
+
+
+def stratified_split(y, test_size=0.25, random_state=0):
+    """Train and test row positions with the class proportions of ``y`` on both sides."""
+    y = np.asarray(y)
+    rng = np.random.default_rng(random_state)
+    train, test = [], []
+    for label in np.unique(y):
+        rows = rng.permutation(np.flatnonzero(y == label))
+        n_test = int(round(test_size * len(rows)))
+        test.append(rows[:n_test])
+        train.append(rows[n_test:])
+    return np.sort(np.concatenate(train)), np.sort(np.concatenate(test))
+
+
+def vintage_split(vintages, test_size=0.25, test_from=None):
+    """Train and test row positions, the test side being the latest vintages.
+
+    ``vintages`` are sortable issue months (``month_index``). The first test
+    vintage is ``test_from``, or the latest one that leaves at least
+    ``test_size`` of the rows to test; a vintage is never split.
+    """
+    vintages = np.asarray(vintages, dtype=np.float64)
+    if test_from is None:
+        values, counts = np.unique(vintages[~np.isnan(vintages)], return_counts=True)
+        if not len(values):
+            raise ValueError('no vintage to split on')
+        # rows in this vintage and every later one
+        later = np.cumsum(counts[::-1])[::-1]
+        enough = np.flatnonzero(later >= test_size * len(vintages))
+        test_from = values[enough[-1]] if len(enough) else values[0]
+    test = vintages >= test_from
+    # loans without an issue date can't be placed in time, they train
+    return np.flatnonzero(~test), np.flatnonzero(test)
+
+
+def downsample(y, rate, majority=None, random_state=0):
+    """Rows kept when only ``rate`` of the ``majority`` class is, and their weights.
+
+    ``majority`` defaults to the most frequent label. Returns ``(rows,
+    sample_weight)``, the weight is ``1 / rate`` on kept majority rows and 1
+    on the others.
+    """
+    if not 0 < rate <= 1:
+        raise ValueError(f'rate must be in (0, 1], got {rate}')
+    y = np.asarray(y)
+    if majority is None:
+        labels, counts = np.unique(y, return_counts=True)
+        majority = labels[np.argmax(counts)]
+    is_majority = y == majority
+    keep = ~is_majority | (np.random.default_rng(random_state).random(len(y)) < rate)
+    rows = np.flatnonzero(keep)
+    return rows, np.where(is_majority[rows], 1 / rate, 1.0)
+
+
+class ReservoirSampler:
+    """Uniform sample of at most ``size`` rows per stratum over chunks.
+
+    Parameters
+    ----------
+    size : int or dict
+        Rows kept per stratum, or stratum -> rows (strata not in the dict are
+        not sampled).
+    by : str or list of str
+        Column(s) defining the strata, e.g. ``'loan_ending'`` for a
+        class-balanced sample.
+    random_state : int
+    """
+
+    def __init__(self, size, by='loan_ending', random_state=0):
+        self.size = size
+        self.by = by
+        self.random_state = random_state
+        self._rng = np.random.default_rng(random_state)
+        self._kept = None
+        self.population_ = {}
+
+    def _capacity(self, strata):
+        if isinstance(self.size, dict):
+            return strata.map(lambda s: self.size.get(s, 0)).to_numpy()
+        return np.full(len(strata), self.size)
+
+    def _strata(self, chunk):
+        by = [self.by] if isinstance(self.by, str) else list(self.by)
+        keys = chunk[by].astype(str)
+        return keys.iloc[:, 0] if len(by) == 1 else keys.apply(tuple, axis=1)
+
+    def partial_fit(self, chunk):
+        """Add ``chunk`` to the stream."""
+        strata = self._strata(chunk)
+        for stratum, count in strata.value_counts().items():
+            self.population_[stratum] = self.population_.get(stratum, 0) + int(count)
+        chunk = chunk.assign(_stratum=strata.to_numpy(), _key=self._rng.random(len(chunk)))
+        combined = chunk if self._kept is None else pd.concat([self._kept, chunk], ignore_index=True)
+        # the `size` smallest keys of every stratum
+        combined = combined.sort_values(['_stratum', '_key'], kind='stable', ignore_index=True)
+        rank = combined.groupby('_stratum', sort=False).cumcount().to_numpy()
+        self._kept = combined[rank < self._capacity(combined['_stratum'])].reset_index(drop=True)
+        return self
+
+    def sample(self):
+        """The sample in stream order of the keys, with a ``sample_weight`` column."""
+        if self._kept is None:
+            raise ValueError('no chunk was seen')
+        kept = self._kept.sort_values('_key', ignore_index=True)
+        sampled = kept['_stratum'].value_counts()
+        weight = kept['_stratum'].map(lambda s: self.population_[s] / sampled[s])
+        return kept.drop(columns=['_stratum', '_key']).assign(sample_weight=weight.to_numpy(dtype=np.float64))
+
+
+def sample_loans(filepath, size, by='loan_ending', vintage=False, chunksize=100_000, random_state=0):
+    """Stream ``filepath`` into a ``ReservoirSampler``, return the sample.
+
+    With ``vintage`` the issue month is read too and added as ``vintage``
+    (``month_index`` of ``issue_d``), for ``vintage_split``.
+    """
+    columns = loader.COLUMNS + ['issue_d'] if vintage else None
+    sampler = ReservoirSampler(size, by, random_state)
+    with profiling.stage('sample_loans'):
+        for chunk in loader.iter_loans(filepath, columns, chunksize):
+            if vintage:
+                chunk = chunk.assign(vintage=month_index(chunk['issue_d'])).drop(columns='issue_d')
+            sampler.partial_fit(chunk)
+    sample = sampler.sample()
+    for col, dtype in loader.SCHEMA.items():
+        # chunks infer their own categories, the concatenations fall back to object
+        if dtype == 'category' and col in sample:
+            sample[col] = sample[col].astype('category')
+    if by == 'loan_ending':
+        sample['loan_ending'] = pd.Categorical(sample['loan_ending'], categories=['bad', 'good'])
+    return sample
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Class-balanced streaming sample of a loan file.')
+    parser.add_argument('input', help='loan file (CSV)')
+    parser.add_argument('output', help='sample, .parquet')
+    parser.add_argument('--per-class', type=int, required=True, help='rows kept per loan_ending class')
+    parser.add_argument('--vintage', action='store_true', help='add the issue month and a vintage split column')
+    parser.add_argument('--test-size', type=float, default=0.25)
+    parser.add_argument('--chunksize', type=int, default=100_000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    sample = sample_loans(args.input, args.per_class, vintage=args.vintage, chunksize=args.chunksize,
+                          random_state=args.seed)
+    if args.vintage:
+        _, test = vintage_split(sample['vintage'], args.test_size)
+    else:
+        _, test = stratified_split(sample['loan_ending'], args.test_size, args.seed)
+    sample['split'] = 'train'
+    sample.loc[test, 'split'] = 'test'
+    sample.to_parquet(args.output)
+
+
+if __name__ == '__main__':
+    main()
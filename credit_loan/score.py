@@ -0,0 +1,131 @@
+"""Score a file of loan applications with a persisted ``ScoringModel``.
+
+The input (CSV or Parquet) is streamed in fixed-size chunks; each chunk is
+encoded, scored and appended to the output before the next one is read, so
+memory stays bounded by the chunk size whatever the file size.
+
+Usage::
+
+    python -m credit_loan.score rf.joblib applications.csv scores.csv --chunksize 100000
+"""
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+import pandas as pd
+
+from credit_loan import loader, profiling
+from credit_loan.artifact import ScoringModel
+
+
+# columns a new application needs, loan_status is only known afterwards
+INPUT_COLUMNS = [col for col in loader.COLUMNS if col != 'loan_status']
+
+
+def _is_parquet(path):
+    return os.path.splitext(path)[1].lower() in ('.parquet', '.pq')
+
+
+def iter_applications(path, chunksize=100_000, id_column='id'):
+    """Yield chunks of application records, with ``id_column`` when present."""
+    if _is_parquet(path):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        available = set(parquet_file.schema_arrow.names)
+        columns = INPUT_COLUMNS + ([id_column] if id_column in available else [])
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+        return
+
+    available = set(pd.read_csv(path, nrows=0).columns)
+    columns = INPUT_COLUMNS + ([id_column] if id_column in available else [])
+    yield from loader.iter_loans(path, columns=columns, chunksize=chunksize, resolved_only=False)
+
+
+class _Writer:
+    """Append scored chunks to a CSV or Parquet file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._parquet = None
+        self._first = True
+
+    def write(self, frame):
+        if _is_parquet(self.path):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if self._parquet is None:
+                self._parquet = pq.ParquetWriter(self.path, table.schema)
+            self._parquet.write_table(table)
+        else:
+            frame.to_csv(self.path, mode='w' if self._first else 'a', header=self._first, index=False)
+        self._first = False
+
+    def close(self):
+        if self._parquet is not None:
+            self._parquet.close()
+
+
+def score_file(model, input_path, output_path, chunksize=100_000, id_column='id', reference_year=None):
+    """Score ``input_path`` into ``output_path``, return the number of rows.
+
+    ``reference_year`` overrides the "as of" year the model was trained with.
+    """
+    if isinstance(model, str):
+        model = ScoringModel.load(model)
+    if reference_year is not None:
+        model.preprocessor.set_params(reference_year=reference_year)
+
+    n_rows = 0
+    writer = _Writer(output_path)
+    try:
+        for chunk in iter_applications(input_path, chunksize, id_column):
+            with profiling.stage('score_chunk', chunk) as stage:
+                scores = stage.output(pd.DataFrame({'prob_good': model.score(chunk)}))
+            if id_column in chunk:
+                scores.insert(0, id_column, chunk[id_column].to_numpy())
+            writer.write(scores)
+            n_rows += len(chunk)
+    finally:
+        writer.close()
+    return n_rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('model', help='ScoringModel saved with ScoringModel.save')
+    parser.add_argument('input', help='applications, .csv or .parquet')
+    parser.add_argument('output', help='scores, .csv or .parquet')
+    parser.add_argument('--chunksize', type=int, default=100_000)
+    parser.add_argument('--id-column', default='id',
+                        help='column copied to the output when present (default: id)')
+    parser.add_argument('--as-of', type=int, dest='reference_year',
+                        help='"as of" year of the date features (default: the training one)')
+    parser.add_argument('--trace', help='write a per-stage trace (JSON) to this file')
+    parser.add_argument('--timeline', help='write the trace as Chrome trace events to this file')
+    parser.add_argument('--profile-dir', help='write a cProfile dump of every stage to this directory')
+    args = parser.parse_args(argv)
+
+    tracer = None
+    if args.trace or args.timeline or args.profile_dir:
+        tracer = profiling.Tracer(profile_dir=args.profile_dir)
+    start = time.perf_counter()
+    with profiling.tracing(tracer) if tracer is not None else contextlib.nullcontext():
+        n_rows = score_file(args.model, args.input, args.output, args.chunksize, args.id_column,
+                            args.reference_year)
+    elapsed = time.perf_counter() - start
+    if args.trace:
+        tracer.save(args.trace)
+    if args.timeline:
+        tracer.save_timeline(args.timeline)
+    print(f'scored {n_rows} applications in {elapsed:.1f}s ({n_rows / max(elapsed, 1e-9):.0f} rows/s)',
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
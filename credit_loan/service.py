@@ -0,0 +1,270 @@
+"""Local HTTP scoring service with micro-batching.
+
+Concurrent ``POST /score`` requests are queued and coalesced into one batch
+per ``window_ms`` (or as soon as ``max_batch`` requests are waiting), so the
+model is called on a small NumPy matrix instead of once per application.
+Applications are encoded straight from their JSON dicts with
+``LoanPreprocessor.transform_records``, no DataFrame is built per request.
+With ``--cache-size`` (and ``--cache-store``, shared by the service processes
+of a host) applications scored before are answered from a
+``prediction_cache.CachedScoringModel`` without running the model.
+
+Endpoints::
+
+    POST /score    one application (JSON object) or several (JSON array)
+                   -> {"prob_good": 0.83} or {"prob_good": [...]}
+    GET  /metrics  request count, batch sizes, p50/p99 latency in ms and the
+                   prediction cache hit rate when there is one
+    GET  /health   "ok"
+
+Usage::
+
+    python -m credit_loan.service voting_clf.joblib --port 8080 --window-ms 2
+    python -m credit_loan.service rf.joblib --unix /tmp/credit-loan.sock
+    python -m credit_loan.service voting_clf.joblib --cache-size 100000 --cache-store /var/tmp/scores.db
+"""
+import argparse
+import asyncio
+import collections
+import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from credit_loan.artifact import ScoringModel
+
+
+class MicroBatcher:
+    """Coalesce concurrent scoring calls into batches.
+
+    The model runs in a single background thread, so the event loop keeps
+    accepting requests (and filling the next batch) while a batch is scored.
+    A batch that raises is scored again one request at a time, so a bad
+    application only fails its own request.
+    """
+
+    def __init__(self, model, window_ms=2.0, max_batch=256, latency_window=10_000):
+        self.model = model
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.batch_sizes = collections.deque(maxlen=latency_window)
+        self.n_requests = 0
+        self._queue = None
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='scoring')
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._executor.shutdown()
+
+    async def score(self, records):
+        """Probabilities of a good loan for a list of application dicts."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((records, future, time.perf_counter()))
+        return await future
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        size = len(batch[0][0])
+        deadline = time.perf_counter() + self.window
+        while size < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _score(self, records):
+        return asyncio.get_running_loop().run_in_executor(self._executor, self.model.score_records, records)
+
+    def _finish(self, batch, proba):
+        done = time.perf_counter()
+        self.batch_sizes.append(sum(len(items) for items, _, _ in batch))
+        offset = 0
+        for items, future, start in batch:
+            if not future.done():
+                future.set_result(proba[offset:offset + len(items)])
+            offset += len(items)
+            self.latencies.append(done - start)
+            self.n_requests += 1
+
+    @staticmethod
+    def _fail(item, exc):
+        if not item[1].done():
+            item[1].set_exception(exc)
+
+    async def _score_apart(self, batch):
+        for item in batch:
+            try:
+                proba = await self._score(item[0])
+            except Exception as exc:
+                self._fail(item, exc)
+            else:
+                self._finish([item], proba)
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            records = [record for item in batch for record in item[0]]
+            try:
+                proba = await self._score(records)
+            except Exception as exc:
+                if len(batch) == 1:
+                    self._fail(batch[0], exc)
+                else:
+                    # one bad application fails the whole call, score the
+                    # requests apart so only the one it came with gets the error
+                    await self._score_apart(batch)
+                continue
+            self._finish(batch, proba)
+
+    def metrics(self):
+        latencies = np.asarray(self.latencies) * 1000
+        p50, p99 = np.percentile(latencies, [50, 99]) if len(latencies) else (math.nan, math.nan)
+        metrics = {
+            'model': self.model.name,
+            'requests': self.n_requests,
+            'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+            'p50_ms': float(p50),
+            'p99_ms': float(p99),
+        }
+        if hasattr(self.model, 'cache'):
+            metrics['cache'] = self.model.cache.metrics()
+        return metrics
+
+
+def _probability(value):
+    # NaN (an application missing a feature) isn't valid JSON
+    return None if math.isnan(value) else float(value)
+
+
+class ScoringServer:
+    """Minimal HTTP/1.1 server (keep-alive, JSON bodies) around a ``MicroBatcher``."""
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    async def _respond(self, writer, status, payload):
+        body = json.dumps(payload).encode()
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+        writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n'
+                     f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+        await writer.drain()
+
+    async def _handle_request(self, method, path, body):
+        if method == 'GET' and path == '/health':
+            return 200, 'ok'
+        if method == 'GET' and path == '/metrics':
+            return 200, self.batcher.metrics()
+        if method != 'POST' or path != '/score':
+            return 404, {'error': f'no route {method} {path}'}
+
+        try:
+            payload = json.loads(body)
+        except ValueError as exc:
+            return 400, {'error': f'invalid JSON: {exc}'}
+        single = isinstance(payload, dict)
+        records = [payload] if single else payload
+        if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+            return 400, {'error': 'expected an application object or a list of them'}
+        if not records:
+            return 200, {'prob_good': []}
+
+        try:
+            proba = await self.batcher.score(records)
+        except Exception as exc:
+            return 500, {'error': f'{type(exc).__name__}: {exc}'}
+        if single:
+            return 200, {'prob_good': _probability(proba[0])}
+        return 200, {'prob_good': [_probability(p) for p in proba]}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, payload = await self._handle_request(method, path, body)
+                await self._respond(writer, status, payload)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(model, host='127.0.0.1', port=8080, unix=None, window_ms=2.0, max_batch=256):
+    """Run the service until cancelled, ``model`` can be a ``CachedScoringModel``."""
+    if isinstance(model, str):
+        model = ScoringModel.load(model)
+    batcher = MicroBatcher(model, window_ms, max_batch)
+    batcher.start()
+    server = ScoringServer(batcher)
+    if unix is not None:
+        listener = await asyncio.start_unix_server(server.handle, path=unix)
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        await batcher.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('model', help='ScoringModel saved with ScoringModel.save')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix', help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--window-ms', type=float, default=2.0,
+                        help='how long a batch waits for more requests (default: 2)')
+    parser.add_argument('--max-batch', type=int, default=256,
+                        help='applications per batch at most (default: 256)')
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help='scores kept in memory for repeat applications (default: 0, no cache)')
+    parser.add_argument('--cache-ttl', type=float, help='seconds a cached score is served (default: forever)')
+    parser.add_argument('--cache-store', help='SQLite file of scores shared by the service processes of the host')
+    args = parser.parse_args(argv)
+
+    model = args.model
+    if args.cache_size or args.cache_store:
+        from credit_loan.prediction_cache import CachedScoringModel, PredictionCache, PredictionStore
+
+        store = None if args.cache_store is None else PredictionStore(args.cache_store, ttl=args.cache_ttl)
+        model = CachedScoringModel(model, PredictionCache(max(args.cache_size, 1), args.cache_ttl), store)
+    try:
+        asyncio.run(serve(model, args.host, args.port, args.unix, args.window_ms, args.max_batch))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""Parallel fitting and cross-validation of the notebook's candidate models.
+
+Independent fits (one per model, or one per model and CV fold) run in a
+joblib process pool. Arrays bigger than ``max_nbytes`` are dumped once to a
+temporary memory-mapped file and opened read-only by every worker instead of
+being pickled to each of them; this also covers the arrays inside a CSR matrix.
+
+Neither the estimators nor sklearn are imported by this module, only by the
+functions fitting them: scoring only needs ``PrefitVotingClassifier``
+(``credit_loan.ensemble``, still importable from here) to unpickle an
+ensemble.
+
+Usage::
+
+    python -m credit_loan train final.matrix models/ --params tuning.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+from credit_loan import profiling
+
+
+def make_models(random_state=None):
+    """The notebook's candidates, slowest first so they start first."""
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.tree import DecisionTreeClassifier
+
+    from credit_loan.neighbors import ApproxKNeighborsClassifier
+
+    return {
+        'rf': RandomForestClassifier(random_state=random_state),
+        # the approximate index, brute force scans the training set per prediction
+        'knn': ApproxKNeighborsClassifier(random_state=random_state),
+        'lr': LogisticRegression(),
+        'dt': DecisionTreeClassifier(random_state=random_state),
+    }
+
+
+def _parallel(n_jobs, max_nbytes):
+    return Parallel(n_jobs=n_jobs, max_nbytes=max_nbytes, mmap_mode='r')
+
+
+def _fit(name, model, X, y):
+    start = time.perf_counter()
+    model.fit(X, y)
+    return name, model, time.perf_counter() - start
+
+
+def fit_models(models, X, y, n_jobs=-1, max_nbytes='1M'):
+    """Fit clones of ``models`` (name -> estimator) concurrently.
+
+    Returns ``(fitted, fit_times)``, both dicts keyed by model name, the fit
+    times in seconds.
+    """
+    from sklearn.base import clone
+
+    with profiling.stage('fit_models', X):
+        results = _parallel(n_jobs, max_nbytes)(
+            delayed(_fit)(name, clone(model), X, y) for name, model in models.items())
+    fitted = {name: model for name, model, _ in results}
+    fit_times = {name: elapsed for name, _, elapsed in results}
+    return fitted, fit_times
+
+
+def _take(X, rows):
+    return X.iloc[rows] if hasattr(X, 'iloc') else X[rows]
+
+
+def _fit_and_score(name, fold, model, X, y, train, test, scoring):
+    from sklearn.metrics import get_scorer
+
+    start = time.perf_counter()
+    model.fit(_take(X, train), y[train])
+    fit_time = time.perf_counter() - start
+    X_test = _take(X, test)
+    score = {metric: get_scorer(metric)(model, X_test, y[test]) for metric in scoring}
+    return {'model': name, 'fold': fold, 'fit_time': fit_time, **score}
+
+
+def cross_validate_models(models, X, y, cv=5, scoring=('roc_auc',), n_jobs=-1,
+                          random_state=0, max_nbytes='1M'):
+    """Cross-validate every model on every fold, all fits in one pool.
+
+    The folds are stratified on ``y`` and computed once, so every model is
+    compared on the same splits. Returns one row per (model, fold).
+    """
+    from sklearn.base import clone
+    from sklearn.model_selection import StratifiedKFold
+
+    scoring = [scoring] if isinstance(scoring, str) else list(scoring)
+    y = np.asarray(y)
+    folds = list(StratifiedKFold(cv, shuffle=True, random_state=random_state).split(np.zeros(len(y)), y))
+    with profiling.stage('cross_validate_models', X):
+        rows = _parallel(n_jobs, max_nbytes)(
+            delayed(_fit_and_score)(name, fold, clone(model), X, y, train, test, scoring)
+            for name, model in models.items()
+            for fold, (train, test) in enumerate(folds))
+    return pd.DataFrame(rows)
+
+
+def __getattr__(name):
+    if name == 'PrefitVotingClassifier':
+        from credit_loan.ensemble import PrefitVotingClassifier
+
+        return PrefitVotingClassifier
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fit the models on a feature matrix and save them for scoring.')
+    parser.add_argument('matrix', help='training matrix directory (python -m credit_loan.matrix)')
+    parser.add_argument('output', help='directory of the saved ScoringModels, one <model>.<format> each')
+    parser.add_argument('--models', nargs='+', default=['knn', 'rf', 'lr'], choices=['rf', 'knn', 'lr', 'dt'])
+    parser.add_argument('--params', help='tuning.json of python -m credit_loan.tuning, best parameters and weights')
+    parser.add_argument('--no-voting', dest='voting', action='store_false',
+                        help="don't save the soft voting ensemble of the fitted models")
+    parser.add_argument('--format', choices=['joblib', 'bundle'], default='joblib',
+                        help='ScoringModel.save pickles or memory-mapped model bundles (credit_loan.bundle)')
+    parser.add_argument('--n-jobs', type=int, default=-1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # local, they pull in the preprocessing (and sklearn) only for this command
+    from credit_loan.artifact import ScoringModel
+    from credit_loan.bundle import save_bundle
+    from credit_loan.ensemble import PrefitVotingClassifier
+    from credit_loan.matrix import open_matrix
+
+    def save(model, name):
+        path = os.path.join(args.output, f'{name}.{args.format}')
+        return save_bundle(model, path) if args.format == 'bundle' else model.save(path)
+
+    matrix = open_matrix(args.matrix)
+    if matrix.y is None or matrix.preprocessor is None:
+        parser.error(f'{args.matrix} has no target or no preprocessor, write it with python -m credit_loan.matrix')
+    tuning = {}
+    if args.params:
+        with open(args.params) as f:
+            tuning = json.load(f)
+    candidates = make_models(random_state=args.seed)
+    models = {}
+    for name in args.models:
+        models[name] = candidates[name].set_params(**(tuning.get('best_params') or {}).get(name, {}))
+
+    fitted, fit_times = fit_models(models, matrix.frame(), matrix.y, n_jobs=args.n_jobs)
+    os.makedirs(args.output, exist_ok=True)
+    for name in args.models:
+        save(ScoringModel(matrix.preprocessor, fitted[name], name), name)
+        print(f'{name}: fit in {fit_times[name]:.1f}s', file=sys.stderr)
+    if args.voting and len(args.models) > 1:
+        weights = tuning.get('weights')
+        members = [name for name in args.models if weights is None or name in weights]
+        voting = PrefitVotingClassifier([(name, fitted[name]) for name in members],
+                                        weights=None if weights is None else [weights[name] for name in members])
+        save(ScoringModel(matrix.preprocessor, voting, 'voting'), 'voting')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+"""``LoanPreprocessor``, the ``LoanEncoder`` as a scikit-learn transformer.
+
+Apart from ``preprocessing`` because it imports sklearn, which the scoring
+code only needs once it loads a model. ``preprocessing.LoanPreprocessor``
+imports this module on first access, pickles of either name load.
+"""
+from sklearn.base import BaseEstimator, TransformerMixin
+
+from credit_loan.preprocessing import LoanEncoder
+
+
+class LoanPreprocessor(TransformerMixin, LoanEncoder, BaseEstimator):
+    """``LoanEncoder`` with the estimator API: parameters, ``fit_transform``, ``set_output``, cloning.
+
+    See ``LoanEncoder`` for the parameters.
+    """
+
+    # defined here so TransformerMixin wraps it for set_output
+    def transform(self, X):
+        return super().transform(X)
@@ -0,0 +1,433 @@
+"""Successive halving / Hyperband search of the RF, LR and KNN parameters and
+the voting weights.
+
+The notebook fits every candidate with its defaults. ``HalvingSearch`` samples
+configurations from ``SPACES`` and scores them (ROC AUC, mean over the CV
+folds) on a few training rows first, keeps the best ``1 / eta`` of them and
+gives the survivors ``eta`` times more rows, until the full training folds
+(successive halving). With ``hyperband`` the same is repeated for brackets
+that start with fewer configurations on more rows, which hedges against
+small samples ranking the configurations badly.
+
+- The folds are stratified and computed once. ``FoldCache`` writes every
+  fold's train and test rows as ``credit_loan.matrix`` memmaps, the train rows
+  in a stratified order so the first ``n`` of them are a class-balanced
+  sample: a rung's subsample is a slice, and the trial workers read the same
+  pages without copies. A fold cache is keyed by a hash of X, y, cv and seed.
+- The trials of a rung (configuration x fold) run in one joblib pool.
+- Every score is recorded in ``checkpoint`` (JSON) after each rung; a rerun
+  samples the same configurations and only fits what is missing. The
+  checkpoint is tied to the fold cache key (data, cv and seed), a search on
+  other data refuses it.
+- ``time_budget`` (seconds) is shared equally by the models (unused time
+  goes to the next models). No trial starts past a model's share, and a rung
+  is skipped when the previous one, scaled to its rows and trials, says it
+  won't fit: the best configuration of the largest rung completed is kept.
+  Models without a completed rung are listed in ``summary()['skipped']``.
+
+The voting weights are searched last, on the out-of-fold probabilities of
+the best configuration of each model, over a grid of the simplex, all
+candidates ranked in one ``evaluation.evaluate`` call.
+
+Usage::
+
+    python -m credit_loan.tuning train.matrix -o tuning.json --budget 3600 --checkpoint tuning.ckpt
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.base import clone
+from sklearn.metrics import roc_auc_score
+from sklearn.model_selection import StratifiedKFold
+
+from credit_loan import evaluation, profiling
+from credit_loan.cache import atomic_write, dump_json
+from credit_loan.matrix import open_matrix, write_matrix
+from credit_loan.training import _take, make_models
+
+
+SPACES = {
+    'rf': {
+        'n_estimators': [50, 100, 200],
+        'max_depth': [None, 8, 16, 32],
+        'min_samples_leaf': [1, 5, 20, 50],
+        'max_features': ['sqrt', 0.3, 0.6],
+    },
+    'lr': {
+        'C': [float(c) for c in np.logspace(-3, 2, 11)],
+        'max_iter': [100, 300, 1000],
+    },
+    # the random projection index only, a ball tree can't be bundled
+    'knn': {
+        'n_neighbors': [5, 15, 31, 63, 127],
+        'n_components': [8, 16, 32, None],
+        'n_trees': [5, 10, 20],
+    },
+}
+
+# order of the notebook's voting ensemble
+VOTING = ['knn', 'rf', 'lr']
+
+
+def _key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+def sample_configs(space, n, rng):
+    """``n`` distinct configurations of ``space``, or all of them if there are fewer."""
+    names = sorted(space)
+    grid = [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+    if len(grid) <= n:
+        return grid
+    return [grid[i] for i in rng.choice(len(grid), n, replace=False)]
+
+
+def _stratified_order(y, rng):
+    # rank within the class over the class size: sorting by it interleaves the
+    # classes, so every prefix has the class proportions of the whole fold
+    y = np.asarray(y)
+    position = np.empty(len(y))
+    for label in np.unique(y):
+        rows = np.flatnonzero(y == label)
+        position[rng.permutation(rows)] = (np.arange(len(rows)) + rng.random(len(rows))) / len(rows)
+    return np.argsort(position, kind='stable')
+
+
+def _digest(X, y, cv, random_state):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((X.shape, cv, random_state)).encode())
+    values = X.to_numpy() if hasattr(X, 'to_numpy') else X
+    if hasattr(values, 'tocsr'):
+        values = values.tocsr()
+        for part in [values.indptr, values.indices, values.data]:
+            digest.update(np.ascontiguousarray(part).data)
+    else:
+        digest.update(np.ascontiguousarray(values).data)
+    digest.update(np.ascontiguousarray(y).data)
+    return digest.hexdigest()
+
+
+class FoldCache:
+    """Stratified CV folds of ``(X, y)`` as memory-mapped matrices on disk.
+
+    ``folds`` is a list of ``(train, test)`` ``FeatureMatrix``; the train rows
+    of a fold are in stratified order (see module docstring).
+    """
+
+    def __init__(self, directory, X, y, cv=3, random_state=0):
+        y = np.asarray(y)
+        self.digest = _digest(X, y, cv, random_state)
+        self.directory = os.path.join(directory, self.digest)
+        self.folds = []
+        rng = np.random.default_rng(random_state)
+        splits = StratifiedKFold(cv, shuffle=True, random_state=random_state).split(np.zeros(len(y)), y)
+        for i, (train, test) in enumerate(splits):
+            train = train[_stratified_order(y[train], rng)]
+            fold_dir = os.path.join(self.directory, f'fold{i}')
+            self.folds.append((self._matrix(os.path.join(fold_dir, 'train'), X, y, train),
+                               self._matrix(os.path.join(fold_dir, 'test'), X, y, test)))
+
+    @staticmethod
+    def _matrix(directory, X, y, rows):
+        if os.path.exists(os.path.join(directory, 'schema.json')):
+            return open_matrix(directory)
+        columns = list(X.columns) if hasattr(X, 'columns') else None
+        return write_matrix(directory, _take(X, rows), y[rows], columns)
+
+
+def _score(name, params, train, test, rows, random_state):
+    start = time.perf_counter()
+    model = clone(make_models(random_state)[name]).set_params(**params)
+    model.fit(train.X[:rows], train.y[:rows])
+    score = roc_auc_score(test.y, model.predict_proba(test.X)[:, 1])
+    return score, time.perf_counter() - start
+
+
+def _oof(name, params, train, test, random_state):
+    model = clone(make_models(random_state)[name]).set_params(**params)
+    return model.fit(train.X, train.y).predict_proba(test.X)[:, 1]
+
+
+def simplex(n, step=0.1):
+    """Every weight vector of ``n`` non-negative multiples of ``step`` summing to 1."""
+    units = round(1 / step)
+    return [tuple(c / units for c in combo)
+            for combo in itertools.product(range(units + 1), repeat=n) if sum(combo) == units]
+
+
+def tune_weights(probas, y, step=0.1):
+    """Voting weights (dict name -> weight) with the best AUC of the averaged ``probas``."""
+    names = list(probas)
+    stacked = np.stack([probas[name] for name in names])
+    candidates = {weights: np.tensordot(weights, stacked, axes=1) for weights in simplex(len(names), step)
+                  if any(weights)}
+    scores = evaluation.evaluate(y, candidates)['auc']
+    best = scores.idxmax()
+    return dict(zip(names, best)), float(scores[best])
+
+
+class HalvingSearch:
+    """Successive halving (or Hyperband) over training rows.
+
+    Parameters
+    ----------
+    models : list of str
+        Models of ``SPACES`` to tune.
+    n_candidates : int
+        Configurations the (first) bracket starts with, per model.
+    min_rows : int
+        Training rows per fold of the first rung.
+    eta : int
+        Survivors of a rung are the best ``1 / eta``, with ``eta`` times the rows.
+    cv : int
+        Folds every configuration is scored on.
+    hyperband : bool
+        Run every Hyperband bracket instead of the single halving one.
+    time_budget : float, optional
+        Seconds after which no trial is started, see the module docstring.
+    weights_step : float, optional
+        Grid step of the voting weights, None skips the weight search.
+    cache_dir : str, optional
+        Where the fold matrices are kept. Defaults to ``<checkpoint>.folds``,
+        so a resumed search reuses them, or without a checkpoint to a
+        temporary directory removed at the end of ``fit``.
+    checkpoint : str, optional
+        JSON file every trial score is saved to and resumed from.
+    n_jobs : int
+    random_state : int
+    spaces : dict, optional
+        Parameter spaces, ``SPACES`` by default.
+    """
+
+    def __init__(self, models=('rf', 'lr', 'knn'), n_candidates=27, min_rows=2000, eta=3, cv=3,
+                 hyperband=False, time_budget=None, weights_step=0.1, cache_dir=None, checkpoint=None,
+                 n_jobs=-1, random_state=0, spaces=None):
+        self.models = models
+        self.n_candidates = n_candidates
+        self.min_rows = min_rows
+        self.eta = eta
+        self.cv = cv
+        self.hyperband = hyperband
+        self.time_budget = time_budget
+        self.weights_step = weights_step
+        self.cache_dir = cache_dir
+        self.checkpoint = checkpoint
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.spaces = spaces
+
+    def _checkpoint_header(self, digest):
+        # the scores are only valid for the folds they were computed on
+        return {'folds': digest, 'cv': self.cv, 'random_state': self.random_state}
+
+    def _load_checkpoint(self, digest):
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return {}
+        with open(self.checkpoint) as f:
+            checkpoint = json.load(f)
+        header = self._checkpoint_header(digest)
+        found = {key: checkpoint.get(key) for key in header}
+        if found != header:
+            raise ValueError(f'{self.checkpoint} holds scores of other folds ({found}, this search has {header}), '
+                             f'remove it or give another checkpoint')
+        return checkpoint['scores']
+
+    def _save_checkpoint(self):
+        if self.checkpoint is not None:
+            checkpoint = {**self._header, 'scores': self._scores}
+            atomic_write(self.checkpoint, lambda path: dump_json(checkpoint, path))
+
+    def _out_of_time(self):
+        return self._deadline is not None and time.perf_counter() > self._deadline
+
+    def _fits(self, seconds):
+        """Whether ``seconds`` of trials, spread over the workers, end before the deadline."""
+        if self._deadline is None:
+            return True
+        return time.perf_counter() + seconds / effective_n_jobs(self.n_jobs) <= self._deadline
+
+    def _brackets(self, max_rows):
+        """(configurations, rungs) of every bracket, a bracket of s + 1 rungs starts on max_rows / eta ** s rows."""
+        s_max = max(0, int(math.log(max_rows / self.min_rows, self.eta) + 1e-9))
+        if not self.hyperband:
+            return [(self.n_candidates, s_max)]
+        return [(math.ceil(self.n_candidates * (s_max + 1) / (s + 1) / self.eta ** (s_max - s)), s)
+                for s in range(s_max, -1, -1)]
+
+    def _rung(self, pool, name, configs, rows):
+        """Mean score of every configuration on ``rows`` training rows per fold and
+        the mean seconds of a trial, None when time ran out before every trial ran."""
+        todo = [(params, fold) for params in configs for fold in range(len(self._folds))
+                if f'{name}|{_key(params)}|{rows}|{fold}' not in self._scores]
+
+        def trials():
+            # joblib pulls the trials as workers free up, so the deadline is
+            # checked before each one starts
+            for params, fold in todo:
+                if self._out_of_time():
+                    return
+                yield delayed(_score)(name, params, *self._folds[fold], rows, self.random_state)
+
+        with profiling.stage(f'tune_{name}_{rows}'):
+            results = pool(trials())
+        for (params, fold), (score, seconds) in zip(todo, results):
+            self._scores[f'{name}|{_key(params)}|{rows}|{fold}'] = [score, seconds]
+        self._save_checkpoint()
+        if len(results) < len(todo):
+            # scores of the finished trials are checkpointed, the rung isn't ranked
+            return None
+
+        means, seconds = [], []
+        for params in configs:
+            trials = [self._scores[f'{name}|{_key(params)}|{rows}|{fold}'] for fold in range(len(self._folds))]
+            means.append(float(np.mean([score for score, _ in trials])))
+            seconds += [trial_seconds for _, trial_seconds in trials]
+            self._trials.append({'model': name, 'params': params, 'rows': rows, 'score': means[-1],
+                                 'seconds': float(sum(trial_seconds for _, trial_seconds in trials))})
+        return means, float(np.mean(seconds))
+
+    def _halving(self, pool, name, configs, s, max_rows):
+        for rung in range(s, -1, -1):
+            rows = max_rows // self.eta ** rung
+            # a trial costs about its rows more than one of the previous rung
+            if self._out_of_time() or (
+                    rung < s and not self._fits(trial_seconds * rows / previous_rows * len(configs) * len(self._folds))):
+                self._cut_short = True
+                return
+            ranked = self._rung(pool, name, configs, rows)
+            if ranked is None:
+                self._cut_short = True
+                return
+            if len(configs) == 1:
+                return
+            means, trial_seconds = ranked
+            previous_rows = rows
+            keep = max(1, len(configs) // self.eta)
+            configs = [configs[i] for i in np.argsort(means, kind='stable')[::-1][:keep]]
+
+    def fit(self, X, y):
+        cache_dir = self.cache_dir
+        if cache_dir is None and self.checkpoint is not None:
+            cache_dir = f'{self.checkpoint}.folds'
+        if cache_dir is not None:
+            return self._fit(X, y, cache_dir)
+        cache_dir = tempfile.mkdtemp(prefix='credit-loan-folds-')
+        try:
+            return self._fit(X, y, cache_dir)
+        finally:
+            self._folds = None
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def _fit(self, X, y, cache_dir):
+        spaces = SPACES if self.spaces is None else self.spaces
+        self._start = time.perf_counter()
+        self._trials = []
+        self._cut_short = False
+        for attr in ['weights_', 'weights_score_']:
+            self.__dict__.pop(attr, None)
+        folds = FoldCache(cache_dir, X, y, self.cv, self.random_state)
+        self._folds = folds.folds
+        self._header = self._checkpoint_header(folds.digest)
+        self._scores = self._load_checkpoint(folds.digest)
+        max_rows = min(len(train) for train, _ in self._folds)
+
+        pool = Parallel(n_jobs=self.n_jobs, max_nbytes='1M', mmap_mode='r')
+        for j, name in enumerate(self.models):
+            # an equal share of what is left for every model still to tune
+            self._deadline = None
+            if self.time_budget is not None:
+                left = self.time_budget - (time.perf_counter() - self._start)
+                self._deadline = time.perf_counter() + left / (len(self.models) - j)
+            for i, (n_configs, s) in enumerate(self._brackets(max_rows)):
+                rng = np.random.default_rng([self.random_state, i])
+                self._halving(pool, name, sample_configs(spaces[name], n_configs, rng), s, max_rows)
+
+        self.trials_ = pd.DataFrame(self._trials, columns=['model', 'params', 'rows', 'score', 'seconds'])
+        # the best of the most rows a configuration got to
+        self.best_params_, self.best_scores_, self._oof_seconds = {}, {}, {}
+        for name, trials in self.trials_.groupby('model', sort=False):
+            top = trials[trials['rows'] == trials['rows'].max()]
+            best = top.loc[top['score'].idxmax()]
+            self.best_params_[name] = best['params']
+            self.best_scores_[name] = float(best['score'])
+            # a fit on the full training folds, per fold, from the trials of the best configuration
+            self._oof_seconds[name] = float(best['seconds']) * max_rows / best['rows']
+        # time ran out before any rung of these models completed
+        self.skipped_ = [name for name in self.models if name not in self.best_params_]
+
+        members = [name for name in VOTING if name in self.best_params_]
+        self._deadline = None if self.time_budget is None else self._start + self.time_budget
+        if self.weights_step is not None and len(members) > 1:
+            if self._fits(sum(self._oof_seconds[name] for name in members)):
+                self._tune_weights(pool, members)
+            else:
+                self._cut_short = True
+        self.budget_exhausted_ = self._cut_short
+        return self
+
+    def _tune_weights(self, pool, members):
+        with profiling.stage('tune_voting_weights'):
+            jobs = [(name, fold) for name in members for fold in range(len(self._folds))]
+            probas = pool(delayed(_oof)(name, self.best_params_[name], *self._folds[fold], self.random_state)
+                          for name, fold in jobs)
+            oof = {name: np.concatenate([p for (n, _), p in zip(jobs, probas) if n == name]) for name in members}
+            y = np.concatenate([np.asarray(test.y) for _, test in self._folds])
+            self.weights_, self.weights_score_ = tune_weights(oof, y, self.weights_step)
+
+    def summary(self):
+        """JSON-serializable best parameters, scores and weights."""
+        return {
+            'best_params': self.best_params_,
+            'best_scores': self.best_scores_,
+            'weights': getattr(self, 'weights_', None),
+            'weights_score': getattr(self, 'weights_score_', None),
+            'budget_exhausted': self.budget_exhausted_,
+            'skipped': self.skipped_,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Tune the models and voting weights on a feature matrix.')
+    parser.add_argument('matrix', help='training matrix directory (python -m credit_loan.matrix)')
+    parser.add_argument('-o', '--output', default='tuning.json', help='best parameters and weights (JSON)')
+    parser.add_argument('--models', nargs='+', default=['rf', 'lr', 'knn'], choices=sorted(SPACES))
+    parser.add_argument('--candidates', type=int, default=27, help='configurations per model (default: 27)')
+    parser.add_argument('--min-rows', type=int, default=2000)
+    parser.add_argument('--eta', type=int, default=3)
+    parser.add_argument('--cv', type=int, default=3)
+    parser.add_argument('--hyperband', action='store_true')
+    parser.add_argument('--budget', type=float, help='seconds, no rung starts after it')
+    parser.add_argument('--cache-dir', help='fold matrices, kept for later searches '
+                                            '(default: CHECKPOINT.folds, or a temporary directory)')
+    parser.add_argument('--checkpoint', help='trial scores, resumed from when it exists')
+    parser.add_argument('--n-jobs', type=int, default=-1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    matrix = open_matrix(args.matrix)
+    if matrix.y is None:
+        parser.error(f'{args.matrix} has no target')
+    search = HalvingSearch(args.models, args.candidates, args.min_rows, args.eta, args.cv, args.hyperband,
+                           args.budget, cache_dir=args.cache_dir, checkpoint=args.checkpoint,
+                           n_jobs=args.n_jobs, random_state=args.seed)
+    search.fit(matrix.frame(), matrix.y)
+    atomic_write(args.output, lambda path: dump_json(search.summary(), path))
+    for name, params in search.best_params_.items():
+        print(f'{name}: {search.best_scores_[name]:.4f} {params}', file=sys.stderr)
+    for name in search.skipped_:
+        print(f'{name}: not tuned, the time budget ran out first', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()